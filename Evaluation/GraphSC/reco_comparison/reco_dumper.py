@@ -19,6 +19,40 @@ All windows are created:  seeds inside other windows creates their window
 '''
 
 
+def get_branches(assoc_strategy="sim_fraction", sc_collection="superCluster", reco_collection="none"):
+    '''
+    Branches of the dumper caloTree read by WindowCreator.get_windows with the given 
+    association strategy, SuperCluster and reco collections (ROOT wildcards allowed)
+    '''
+    branches = [
+        "pfCluster_energy", "pfCluster_rawEnergy", "pfCluster_eta", "pfCluster_phi",
+        "pfCluster_ieta", "pfCluster_iphi", "pfCluster_iz", "pfCluster_nXtals",
+        "pfCluster_" + assoc_strategy,
+        "caloParticle_simEnergy", "caloParticle_simEnergyGoodStatus", "caloParticle_genEnergy",
+        "caloParticle_simEta", "caloParticle_simPhi", "caloParticle_genEta", "caloParticle_genPhi",
+        "caloParticle_genPt", "caloParticle_simIz",
+        "nVtx", "rho", "obsPU", "truePU", "eventId", "runId",
+        "genParticle_energy", "genParticle_eta", "genParticle_phi", "genParticle_pt",
+        "superCluster_seedRawId",
+        sc_collection + "_rawEnergy", sc_collection + "_energy", sc_collection + "_eta", sc_collection + "_phi",
+        sc_collection + "_nPFClusters", sc_collection + "_seedIndex", sc_collection + "_pfClustersIndex",
+        sc_collection + "_dR_genScore", "genParticle_" + sc_collection + "_dR_genScore_MatchedIndex",
+    ]
+    if reco_collection != "none":
+        branches.append(reco_collection + "_*")
+    return branches
+
+
+def enable_branches(tree, branches):
+    '''
+    Disable all the branches of the TTree except the given ones, 
+    so that only the baskets of the needed branches are read and decompressed by GetEntry
+    '''
+    tree.SetBranchStatus("*", 0)
+    for branch in branches:
+        tree.SetBranchStatus(branch, 1)
+
+
 def DeltaR(phi1, eta1, phi2, eta2):
     dphi = phi1 - phi2
     if dphi > pi: dphi -= 2*pi
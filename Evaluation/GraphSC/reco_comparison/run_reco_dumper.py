@@ -16,7 +16,7 @@ import argparse
 import pickle
 import pandas as pd
 from multiprocessing import Pool
-from reco_dumper import WindowCreator
+from reco_dumper import WindowCreator, get_branches, enable_branches
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-i","--inputfile", type=str, help="inputfile", required=True)
@@ -30,6 +30,7 @@ parser.add_argument("--min-et-seed", type=float,  help="Min Et of the seeds", de
 parser.add_argument("--loop-on-calo", action="store_true",  help="If true, loop only on calo-seeds, not on all the SC", default=False)
 parser.add_argument("-s","--sc-collection", type=str, help="SuperCluster collection", default="superCluster")
 parser.add_argument("-r","--reco-collection", type=str, help="Reco collection (none/electron/photon)", default="none")
+parser.add_argument("--all-branches", action="store_true", help="Read all the branches of the tree (no branch pruning)", default=False)
 args = parser.parse_args()
 
 if "#_#" in args.inputfile: 
@@ -58,6 +59,9 @@ nocalowNmax = args.maxnocalow
 def run(inputfile):
     f = R.TFile(inputfile);
     tree = f.Get("recosimdumper/caloTree")
+    if not args.all_branches:
+        # Only the baskets of the branches used by the WindowCreator are read
+        enable_branches(tree, get_branches(args.assoc_strategy, args.sc_collection, args.reco_collection))
 
     if args.nevents and len(args.nevents) >= 1:
         nevent = args.nevents[0]
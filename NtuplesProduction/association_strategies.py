@@ -1,55 +1,96 @@
 from __future__ import print_function
 from collections import defaultdict
-from operator import itemgetter, attrgetter
+from operator import itemgetter
 from itertools import chain
-from math import sqrt
-import ROOT as R
+from math import sqrt, pi
+import numpy as np
+
+'''
+Association strategies between clusters and caloparticles based on the shared crystals.
+
+The crystals shared by the clusters and the caloparticles simhits are collected once per event
+in a sparse COO representation: one entry for each (crystal, cluster, calo) triplet with the
+simhit energy of the calo and the energy of the cluster hit.
+The scores of all the strategies are then computed together for all the (cluster, calo) pairs
+with segment reductions (np.bincount) on the COO arrays.
+'''
 
 def DeltaR(phi1, eta1, phi2, eta2):
         dphi = phi1 - phi2
-        if dphi > R.TMath.Pi(): dphi -= 2*R.TMath.Pi()
-        if dphi < -R.TMath.Pi(): dphi += 2*R.TMath.Pi()
+        if dphi > pi: dphi -= 2*pi
+        if dphi < -pi: dphi += 2*pi
         deta = eta1 - eta2
         deltaR = (deta*deta) + (dphi*dphi)
         return sqrt(deltaR)
 
-def get_hits_maps(event, cluster_type="pfCluster", debug=False):
+def get_hits_coo(event, cluster_type="pfCluster", debug=False):
+    '''
+    COO arrays of the (crystal, cluster, calo) triplets of the event:
+    - xtals: list of the (ieta, iphi, iz, iclu, clhit) cluster hits shared with at least one calo
+    - xtal: index in xtals of the entry
+    - cluster, calo: index of the cluster and of the caloparticle
+    - simhit, clhit: simhit energy of the calo and cluster hit energy in the crystal
+    '''
     ncalo = event.caloParticle_simEnergy.size()
-    calo_simE = event.caloParticle_simEnergy
     sim_ieta = event.simHit_ieta
     sim_iphi = event.simHit_iphi
     sim_iz = event.simHit_iz
     sim_en = event.simHit_energy
-    cluster_energy = getattr(event, cluster_type +"_energy")
     cluster_hits_energy = getattr(event, cluster_type +"Hit_energy")
+    # map (ieta, iphi, iz, iclu, clhit): xtal index
+    xtal_index = {}
+    # map (xtal index, icalo): simhit
+    xtal_calo_simhit = {}
+    for icalo in range(ncalo):
+        if debug:
+            print("--- icalo: ", icalo)
+            print ("ieta iphi simhit [ cluster index , cluster hit]")
+        for ieta, iphi, iz, simhit, clhit in zip(sim_ieta[icalo], sim_iphi[icalo], sim_iz[icalo],
+                                                 sim_en[icalo], cluster_hits_energy[icalo]):
+            if debug and clhit.size() > 0:
+                print(ieta, iphi, "{:.5f}".format(simhit), [(hit.first, '{:.5f}'.format(hit.second)) for hit in clhit])
+            for chit in clhit:
+                xtal = xtal_index.setdefault((ieta, iphi, iz, chit.first, chit.second), len(xtal_index))
+                xtal_calo_simhit[(xtal, icalo)] = simhit
+    xtals = list(xtal_index)
+    xtal_cluster_clhit = np.array([ (x[3], x[4]) for x in xtals ], dtype=np.float64).reshape(-1, 2)
+    xtal, calo = np.array(list(xtal_calo_simhit), dtype=np.int64).reshape(-1, 2).T
+    return {
+        "xtals": xtals,
+        "xtal": xtal,
+        "cluster": xtal_cluster_clhit[xtal, 0].astype(np.int64),
+        "calo": calo,
+        "simhit": np.fromiter(xtal_calo_simhit.values(), dtype=np.float64, count=len(xtal_calo_simhit)),
+        "clhit": xtal_cluster_clhit[xtal, 1],
+    }
+
+def get_hits_maps(event, cluster_type="pfCluster", debug=False, coo=None):
+    '''
+    Dictionaries of the shared crystals:
+    - xtal_cluster:  map (ieta, iphi, iz, iclu, clhit):{icalo: simhit}
+    - xtal_calo:  map (ieta, iphi, iz, icalo, simhit):[(iclu, clhit)]
+    - xtal_cluster_noise: list of (ieta, iphi, iz, iclu, noisehit) of the hits not shared with caloparticles
+    '''
+    if coo is None:
+        coo = get_hits_coo(event, cluster_type=cluster_type, debug=debug)
     cluster_hits_nocalo_energy = getattr(event, cluster_type +"Hit_noCaloPart_energy")
     cluster_hits_nocalo_ieta = getattr(event, cluster_type +"Hit_noCaloPart_ieta")
     cluster_hits_nocalo_iphi = getattr(event, cluster_type +"Hit_noCaloPart_iphi")
     cluster_hits_nocalo_iz = getattr(event, cluster_type +"Hit_noCaloPart_iz")
-    # map (ieta,iphi,iz, icalo, simhit):(iclu, clhit)
     xtal_calo = defaultdict(list)
-    # map (ieta, iphi, iz, iclu, clhit):(icalo, simhit)
     xtal_cluster = defaultdict(dict)
-    # map (ieta, iphi,iz, iclu, noisehit)
     xtal_cluster_noise = []
 
-    for icalo in range(ncalo):
-        if debug: 
-            print("--- icalo: ", icalo)
-            print ("ieta iphi simhit [ cluster index , cluster hit]")
-        for i, (ieta, iphi, iz, simhit, clhit) in enumerate(zip(sim_ieta[icalo], sim_iphi[icalo],sim_iz[icalo],
-                        sim_en[icalo], cluster_hits_energy[icalo])):
-            if clhit.size() > 0:
-                if debug: print(ieta, iphi, "{:.5f}".format(simhit), [(hit.first, '{:.5f}'.format(hit.second)) for hit in clhit]) 
-                for chit in clhit:
-                    xtal_cluster[(ieta, iphi, iz, chit.first, chit.second)][icalo] = simhit
-                    xtal_calo[(ieta, iphi,iz, icalo, simhit)].append((chit.first, chit.second))
-        #
+    xtals = coo["xtals"]
+    for xtal, icalo, simhit in zip(coo["xtal"].tolist(), coo["calo"].tolist(), coo["simhit"].tolist()):
+        ieta, iphi, iz, clid, clhit = xtals[xtal]
+        xtal_cluster[xtals[xtal]][icalo] = simhit
+        xtal_calo[(ieta, iphi, iz, icalo, simhit)].append((clid, clhit))
     # Check the noise hits (not overlapping with caloparticle sihimt)
-    for nclus , (energys, ietas,iphis, izs) in enumerate(zip(cluster_hits_nocalo_energy,   
+    for nclus , (energys, ietas,iphis, izs) in enumerate(zip(cluster_hits_nocalo_energy,
                     cluster_hits_nocalo_ieta, cluster_hits_nocalo_iphi, cluster_hits_nocalo_iz)):
         for en, ieta, iphi, iz in zip(energys, ietas, iphis, izs):
-            if debug: 
+            if debug:
                 print("nocalo hits: nclus:",nclus, ieta, iphi, en)
             xtal_cluster_noise.append((ieta, iphi, iz, nclus, en))
 
@@ -58,267 +99,154 @@ def get_hits_maps(event, cluster_type="pfCluster", debug=False):
     return xtal_cluster, xtal_calo, xtal_cluster_noise
 
 ########################################################################
-# Association strategies 
+# Association strategies
 
-def sim_fraction_strategy(xtal_cluster, xtal_calo, event, cluster_type="pfCluster", min_fraction= 0):
+def get_scores(coo, event, cluster_type="pfCluster"):
     '''
-     - Associate to each Cluster the calo with the greatest fraction of 
-       its simEnergy. (save the ordered list of them by fraction)
-    - Save a list of Cluster associated with the method before to 
-       a caloparticle (there can be more than one)
+    Scores of all the strategies for the (cluster, calo) pairs sharing at least one crystal.
+    Returns the arrays of cluster and calo index of the pairs and a dictionary of score arrays:
+     - sim_fraction: sum of the fraction of the calo simEnergy in the cluster crystals
+     - sim_rechit_diff: 1 - mean of |simhit - cluster hit| on the shared crystals
+     - nxtals: number of shared crystals
+     - sim_rechit_fractions: 1 - sum on the cluster crystals of |simhit/calo simEnergy - hit/cluster energy|
+       (|hit/cluster energy| for the crystals not shared with the calo)
+     - sim_rechit_global_fraction: 1 - |sum on the shared crystals of (simhit/calo simEnergy - hit/cluster energy)|
     '''
-    calo_simE = event.caloParticle_simEnergy
-    cluster_energy = getattr(event, cluster_type+"_energy")
-    ####################################################
-   
-    #######################################################
-    cluster_calo_fraction = defaultdict(dict)
-    for (ieta,iphi,iz, clid, clhit), (caloinfo) in xtal_cluster.items():
-        for icalo, simhit in caloinfo.items():
-            if icalo not in cluster_calo_fraction[clid]:
-                cluster_calo_fraction[clid][icalo] = 0.
-            cluster_calo_fraction[clid][icalo] += simhit / calo_simE[icalo]
-    
-    # Filter out calo with less than 5% fraction 
-    clean_cluster_calo_fraction = defaultdict(dict)
-    if min_fraction == 0: 
-        clean_cluster_calo_fraction = cluster_calo_fraction
-    else:
-        for clid, calos in cluster_calo_fraction.items():
-            for icalo, frac in calos.items():
-                if frac > min_fraction:
-                    clean_cluster_calo_fraction[clid][icalo] = frac
-
-    
-    calo_cluster_assoc = defaultdict(list)
-    cluster_calo_assoc = {}
-
-    for clid, calofrac in clean_cluster_calo_fraction.items():
-        # order caloparticle by fraction
-        caloids =  list(sorted(calofrac.items(), key=itemgetter(1), reverse=True))
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        cluster_calo_assoc[clid] = caloids
-        # save for the calocluster in the caloparticle if it is the one with more fraction
-        # This is necessary in case one caloparticle is linked with more than one cluster
-        calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1] ))
-        
-    # Now sort the clusters associated to a caloparticle with the fraction 
-    sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1), reverse=True)))
-
-    # Return cluster:caloparticle and  caloparticle_cluster maps
-    return cluster_calo_assoc, sorted_calo_cluster_assoc
-
-
-
-
-def sim_rechit_fractions_strategy(xtal_cluster, xtal_calo, event, cluster_type="pfCluster"):
-    calo_simE = event.caloParticle_simEnergy
-    cluster_energy = getattr(event, cluster_type+"_energy")
-
-    ncalos_hits = defaultdict(dict)
-    cluster_calo_fraction = defaultdict(dict)
-    for (ieta,iphi,iz,clid, clhit), (caloinfo) in xtal_cluster.items():
-        for icalo in range(len(calo_simE)):
-            if icalo not in cluster_calo_fraction[clid]:
-                cluster_calo_fraction[clid][icalo] = 0.
-                ncalos_hits[clid][icalo] = 0
-            if icalo in caloinfo:
-                cluster_calo_fraction[clid][icalo] += abs( (caloinfo[icalo] / calo_simE[icalo])-(clhit / cluster_energy[clid]) )
-                ncalos_hits[clid][icalo] +=1
-            else:
-                cluster_calo_fraction[clid][icalo] += abs( (clhit / cluster_energy[clid]) )
-
-    calo_cluster_assoc = defaultdict(list)
-    cluster_calo_assoc = {}
-
-    for clid, calofrac in cluster_calo_fraction.items():
-        # order caloparticle. 
-        # calculate new fraction as 1 - fraction
-        caloids =  list(sorted(
-                            map(lambda (k,f): (k, 1-f), 
-                                filter(lambda (k,v): ncalos_hits[clid][k]>0, calofrac.items())
-                            ),
-                        key=itemgetter(1), reverse=True))
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        cluster_calo_assoc[clid] = caloids
-        # save for the calocluster in the caloparticle if it is the one with more fraction
-        # This is necessary in case one caloparticle is linked with more than one cluster
-        calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1] ))
-        
-    # Now sort the clusters associated to a caloparticle with the fraction (greater the better because we have done 1 -frac)
-    sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1), reverse=True)))
-
-    # Return cluster:caloparticle and  caloparticle_cluster maps
-    return cluster_calo_assoc, sorted_calo_cluster_assoc
-
-
-
-def sim_rechit_global_fraction_strategy(xtal_cluster, xtal_calo, event,cluster_type="pfCluster"):
-    calo_simE = event.caloParticle_simEnergy
-    cluster_energy = getattr(event, cluster_type+"_energy")
-
-    ncalos_hits = defaultdict(dict)
-    cluster_calo_fraction = defaultdict(dict)
-    for (ieta,iphi,iz, clid, clhit), (caloinfo) in xtal_cluster.items():
-        for icalo, simhit in caloinfo.items():
-            if icalo not in cluster_calo_fraction[clid]:
-                cluster_calo_fraction[clid][icalo] = 0.
-            cluster_calo_fraction[clid][icalo] +=  (simhit/ calo_simE[icalo])-(clhit / cluster_energy[clid]) 
-            
-
-    calo_cluster_assoc = defaultdict(list)
-    cluster_calo_assoc = {}
-
-    for clid, calofrac in cluster_calo_fraction.items():
-        # order caloparticle. 
-        # calculate new fraction as 1 - fraction
-        caloids =  list(sorted(
-                            map(lambda (k,f): (k, 1-abs(f)), calofrac.items()),
-                        key=itemgetter(1), reverse=True))
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        cluster_calo_assoc[clid] = caloids
-        # save for the calocluster in the caloparticle if it is the one with more fraction
-        # This is necessary in case one caloparticle is linked with more than one cluster
-        calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1] ))
-        
-    # Now sort the clusters associated to a caloparticle with the fraction (greater the better because we have done 1 -frac)
-    sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1), reverse=True)))
-
-    # Return cluster:caloparticle and  caloparticle_cluster maps
-    return cluster_calo_assoc, sorted_calo_cluster_assoc
-
-
-def sim_rechit_diff_strategy(xtal_cluster, xtal_calo, event,cluster_type="pfCluster"):
-    calo_simE = event.caloParticle_simEnergy
-    cluster_energy = getattr(event, cluster_type+"_energy")
-
-    ncalos_hits = defaultdict(dict)
-    cluster_calo_fraction = defaultdict(dict)
-    for (ieta,iphi,iz, clid, clhit), (caloinfo) in xtal_cluster.items():
-        for icalo, simhit in caloinfo.items():
-            if icalo not in cluster_calo_fraction[clid]:
-                cluster_calo_fraction[clid][icalo] = 0.
-                ncalos_hits[clid][icalo] = 0
-            cluster_calo_fraction[clid][icalo] +=  abs(simhit - clhit)
-            ncalos_hits[clid][icalo] += 1
-            
-    mean_cluster_calo_fraction = defaultdict(dict)
-    for clid, calos in cluster_calo_fraction.items():
-        for icalo, frac in calos.items():
-            mean_cluster_calo_fraction[clid][icalo] = frac / ncalos_hits[clid][icalo]
-        
-    calo_cluster_assoc = defaultdict(list)
-    cluster_calo_assoc = {}
-
-    for clid, calofrac in mean_cluster_calo_fraction.items():
-        # order caloparticle. 
-        # The score is 1 - abs(fraction). fraction = simhit / cluster energy
-        caloids =  list(sorted(
-                            map (lambda (k,v): (k, 1- v), calofrac.items()),
-                         key=itemgetter(1), reverse=True))
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        cluster_calo_assoc[clid] = caloids
-        # save for the calocluster in the caloparticle if it is the one with more fraction
-        # This is necessary in case one caloparticle is linked with more than one cluster
-        calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1] ))
-        
-    # Now sort the clusters associated to a caloparticle with the fraction 
-    sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1), reverse=True)))
-
-    # Return cluster:caloparticle and  caloparticle_cluster maps
-    return cluster_calo_assoc, sorted_calo_cluster_assoc
-
-def nxtals_strategy(xtal_cluster, xtal_calo, event, cluster_type="pfCluster"):
+    calo_simE = np.asarray(event.caloParticle_simEnergy, dtype=np.float64)
+    cluster_energy = np.asarray(getattr(event, cluster_type+"_energy"), dtype=np.float64)
+    cluster, calo, xtal = coo["cluster"], coo["calo"], coo["xtal"]
+    ncalo = max(len(calo_simE), 1)
+    # Segments of the (cluster, calo) pairs
+    pairs, pair_index = np.unique(cluster * ncalo + calo, return_inverse=True)
+    pair_index = pair_index.reshape(-1)
+    pair_cluster, pair_calo = pairs // ncalo, pairs % ncalo
+    npairs = len(pairs)
+
+    def segment_sum(values):
+        return np.bincount(pair_index, weights=values, minlength=npairs)
+
+    sim_fraction = coo["simhit"] / calo_simE[calo]
+    clhit_fraction = coo["clhit"] / cluster_energy[cluster]
+    nxtals = np.bincount(pair_index, minlength=npairs)
+    # Sum on all the crystals of the cluster (each crystal only once)
+    _, first_xtal = np.unique(xtal, return_index=True)
+    cluster_clhit_fraction = np.bincount(cluster[first_xtal], weights=np.abs(clhit_fraction[first_xtal]),
+                                         minlength=len(cluster_energy))
+    scores = {
+        "sim_fraction": segment_sum(sim_fraction),
+        "sim_rechit_diff": 1 - segment_sum(np.abs(coo["simhit"] - coo["clhit"])) / nxtals,
+        "nxtals": nxtals,
+        "sim_rechit_fractions": 1 - (cluster_clhit_fraction[pair_cluster] +
+                                     segment_sum(np.abs(sim_fraction - clhit_fraction) - np.abs(clhit_fraction))),
+        "sim_rechit_global_fraction": 1 - np.abs(segment_sum(sim_fraction - clhit_fraction)),
+    }
+    return pair_cluster, pair_calo, scores
+
+
+def get_deltaR_pairs(event, cluster_type="pfCluster", max_deltaR=0.1):
+    '''
+    (cluster, calo) pairs with deltaR between the cluster and the calo gen direction < max_deltaR
+    Returns the arrays of cluster and calo index of the pairs and the deltaR
+    '''
+    gen_eta = np.asarray(event.caloParticle_genEta, dtype=np.float64)
+    gen_phi = np.asarray(event.caloParticle_genPhi, dtype=np.float64)
+    cl_eta = np.asarray(getattr(event, cluster_type +"_eta"), dtype=np.float64)
+    cl_phi = np.asarray(getattr(event, cluster_type +"_phi"), dtype=np.float64)
+    dphi = cl_phi[:, None] - gen_phi[None, :]
+    dphi = np.where(dphi > pi, dphi - 2*pi, dphi)
+    dphi = np.where(dphi < -pi, dphi + 2*pi, dphi)
+    deltaR = np.sqrt((cl_eta[:, None] - gen_eta[None, :])**2 + dphi**2)
+    pair_cluster, pair_calo = np.nonzero(deltaR < max_deltaR)
+    return pair_cluster, pair_calo, deltaR[pair_cluster, pair_calo]
+
+
+def segments_start(values):
+    '''
+    Start indices of the segments of equal values in the sorted array
+    '''
+    return np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]])) if len(values) else np.zeros(0, dtype=np.int64)
 
-    nxtals_cluster_calo = defaultdict(dict)
-    for (ieta,iphi,iz, clid, clhit), (caloinfo) in xtal_cluster.items():
-        for icalo, simhit in caloinfo.items():
-            if icalo not in nxtals_cluster_calo[clid]:
-                nxtals_cluster_calo[clid][icalo] = 0
-        nxtals_cluster_calo[clid][icalo] +=  1
 
-    calo_cluster_assoc = defaultdict(list)
+def get_association_maps(pair_cluster, pair_calo, scores, reverse=True):
+    '''
+    Association maps from the scores of the (cluster, calo) pairs:
+    - cluster_calo_assoc: for each cluster the list of (calo, score) ordered by score
+    - sorted_calo_cluster_assoc: for each calo the list of the clusters for which it has the best score,
+      ordered by score
+    The scores are ordered in decreasing order (increasing if reverse=False).
+    '''
+    sort_scores = -scores if reverse else scores
+    # By cluster and score (the order of the pairs is kept for equal scores)
+    order = np.lexsort((sort_scores, pair_cluster))
+    first = segments_start(pair_cluster[order])
     cluster_calo_assoc = {}
-
-    for clid, caloinfo in nxtals_cluster_calo.items():
-        # order caloparticle. 
-        # The score is the number of xtals
-        caloids =  list(sorted(caloinfo.items(), key=itemgetter(1), reverse=True))
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        cluster_calo_assoc[clid] = caloids
-        # save for the calocluster in the caloparticle if it is the one with bigger score
-        # This is necessary in case one caloparticle is linked with more than one cluster
-        calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1] ))
-
-    # Now sort the clusters associated to a caloparticle with the fraction 
+    calos, calo_scores = pair_calo[order].tolist(), scores[order].tolist()
+    for clid, start, stop in zip(pair_cluster[order][first].tolist(), first.tolist(), first[1:].tolist() + [len(order)]):
+        cluster_calo_assoc[clid] = list(zip(calos[start:stop], calo_scores[start:stop]))
+    # Best calo of each cluster
+    best = order[first]
+    best = best[np.lexsort((sort_scores[best], pair_calo[best]))]
+    first = segments_start(pair_calo[best])
     sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1), reverse=True)))
+    clusters = pair_cluster[best].tolist()
+    for caloid, start, stop in zip(pair_calo[best][first].tolist(), first.tolist(), first[1:].tolist() + [len(best)]):
+        sorted_calo_cluster_assoc[caloid] = clusters[start:stop]
 
     # Return cluster:caloparticle and  caloparticle_cluster maps
     return cluster_calo_assoc, sorted_calo_cluster_assoc
 
 
-def deltaR_strategy(xtal_cluster, xtal_calo, event, cluster_type="pfCluster", min_deltaR = 0.1):
-    gen_eta = event.caloParticle_genEta
-    gen_phi = event.caloParticle_genPhi
-    cl_eta = getattr(event, cluster_type +"_eta")
-    cl_phi = getattr(event, cluster_type +"_phi")
-    
-    calo_cluster_assoc = defaultdict(list)
-    cluster_calo_assoc = {}
-
-    for clid in range(len(cl_eta)):
-        deltaRs = []
-        for calo in range(len(gen_eta)):
-            dr = DeltaR(cl_phi[clid], cl_eta[clid], gen_phi[calo], gen_eta[calo])
-            if dr < 0.1:
-                deltaRs.append((calo, dr))
-
-        caloids = list(sorted(deltaRs, key=itemgetter(1)))
-        cluster_calo_assoc[clid] = caloids
-
-        if len(caloids) != 0:
-            calo_cluster_assoc[caloids[0][0]].append((clid, caloids[0][1]))
-
-    sorted_calo_cluster_assoc = {}
-    for caloid, clinfo in calo_cluster_assoc.items():
-        sorted_calo_cluster_assoc[caloid] = list(map(itemgetter(0), sorted(clinfo, key=itemgetter(1))))
-    
-    # Return cluster:caloparticle and  caloparticle_cluster maps
-    return cluster_calo_assoc, sorted_calo_cluster_assoc
-
-
 ####################################################################################
 
-
+# Strategy: (score, minimum score). The deltaR strategy is computed separately
 strategies = {
-    "sim_fraction": sim_fraction_strategy,
-    "sim_rechit_diff": sim_rechit_diff_strategy,
-    "nxtals": nxtals_strategy,
-    "sim_rechit_fractions": sim_rechit_fractions_strategy,
-    "deltaR": lambda xtal_cluster, xtal_calo, event, cluster_type: deltaR_strategy(xtal_cluster, xtal_calo, event, cluster_type, min_deltaR=0.1),
-    "sim_fraction_min1":  lambda xtal_cluster, xtal_calo, event, cluster_type: sim_fraction_strategy(xtal_cluster, xtal_calo, event, cluster_type, min_fraction=0.01),
-    "sim_fraction_min3":  lambda xtal_cluster, xtal_calo, event, cluster_type: sim_fraction_strategy(xtal_cluster, xtal_calo, event, cluster_type, min_fraction=0.03),
-    "sim_rechit_global_fraction": sim_rechit_global_fraction_strategy,
+    "sim_fraction": ("sim_fraction", None),
+    "sim_rechit_diff": ("sim_rechit_diff", None),
+    "nxtals": ("nxtals", None),
+    "sim_rechit_fractions": ("sim_rechit_fractions", None),
+    "deltaR": ("deltaR", None),
+    "sim_fraction_min1":  ("sim_fraction", 0.01),
+    "sim_fraction_min3":  ("sim_fraction", 0.03),
+    "sim_rechit_global_fraction": ("sim_rechit_global_fraction", None),
 }
 
-def get_association(event, strategy, cluster_type="pfCluster", debug=False):
-    xtal_cluster, xtal_calo, xtal_cluster_noise = get_hits_maps(event, cluster_type=cluster_type, debug=debug)
-    assoc = strategies[strategy](xtal_cluster, xtal_calo, event, cluster_type=cluster_type)
-    return assoc, (xtal_cluster, xtal_calo, xtal_cluster_noise)
-
-def get_all_associations(event, cluster_type="pfCluster", debug=False):
-    xtal_cluster, xtal_calo, xtal_cluster_noise = get_hits_maps(event, cluster_type=cluster_type, debug=debug)
+def get_strategy_association(strategy, event, pair_cluster, pair_calo, scores, cluster_type="pfCluster"):
+    score, min_score = strategies[strategy]
+    if score == "deltaR":
+        deltaR_cluster, deltaR_calo, deltaR = get_deltaR_pairs(event, cluster_type=cluster_type, max_deltaR=0.1)
+        cluster_calo_assoc, calo_cluster_assoc = get_association_maps(deltaR_cluster, deltaR_calo, deltaR, reverse=False)
+        # All the clusters are saved, also without calos
+        ncl = len(getattr(event, cluster_type +"_eta"))
+        return { clid: cluster_calo_assoc.get(clid, []) for clid in range(ncl) }, calo_cluster_assoc
+    values = scores[score]
+    if min_score is not None:
+        sel = values > min_score
+        return get_association_maps(pair_cluster[sel], pair_calo[sel], values[sel])
+    return get_association_maps(pair_cluster, pair_calo, values)
+
+def get_association(event, strategy, cluster_type="pfCluster", debug=False, hits_maps=True):
+    '''
+    Association of the strategy. Returns also the shared crystals maps (get_hits_maps),
+    or the COO arrays if hits_maps=False (faster).
+    '''
+    coo = get_hits_coo(event, cluster_type=cluster_type, debug=debug)
+    pair_cluster, pair_calo, scores = get_scores(coo, event, cluster_type=cluster_type)
+    assoc = get_strategy_association(strategy, event, pair_cluster, pair_calo, scores, cluster_type=cluster_type)
+    if not hits_maps:
+        return assoc, coo
+    return assoc, get_hits_maps(event, cluster_type=cluster_type, debug=debug, coo=coo)
+
+def get_all_associations(event, cluster_type="pfCluster", debug=False, hits_maps=True):
+    '''
+    Association of all the strategies. Returns also the shared crystals maps (get_hits_maps),
+    or the COO arrays if hits_maps=False (faster).
+    '''
+    coo = get_hits_coo(event, cluster_type=cluster_type, debug=debug)
+    # The scores of all the strategies are computed together
+    pair_cluster, pair_calo, scores = get_scores(coo, event, cluster_type=cluster_type)
     assoc = {}
-    for strategy, f in strategies.items():
-        assoc[strategy] = f(xtal_cluster, xtal_calo, event, cluster_type=cluster_type)
-    return assoc, (xtal_cluster, xtal_calo, xtal_cluster_noise)
\ No newline at end of file
+    for strategy in strategies:
+        assoc[strategy] = get_strategy_association(strategy, event, pair_cluster, pair_calo, scores, cluster_type=cluster_type)
+    if not hits_maps:
+        return assoc, coo
+    return assoc, get_hits_maps(event, cluster_type=cluster_type, debug=debug, coo=coo)
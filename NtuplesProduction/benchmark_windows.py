@@ -0,0 +1,115 @@
+from __future__ import print_function
+import argparse
+import tracemalloc
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from windows_creator_general import WindowCreator
+from simfraction_thresholds import SimfractionThresholds
+from synthetic_events import generate_event, PU_CLUSTERS_PER_INTERACTION
+
+'''
+Benchmark of WindowCreator.get_windows on synthetic events (synthetic_events.py),
+in overlapping and non-overlapping mode for different pileup levels (occupancies).
+
+For each configuration the events are generated once, then:
+- the events/s (and windows/s) are measured on a loop on all the events, with the time spent in each stage
+  of the windows creation (WindowCreator timing mode)
+- the peak of the python memory allocated by get_windows is measured with tracemalloc in a second loop
+
+    python benchmark_windows.py --pileup 0 60 140 200 -n 50
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n","--nevents", type=int, help="Number of events for each configuration", default=50)
+parser.add_argument("--pileup", type=float, nargs="+", help="Pileup levels", default=[0, 60, 140, 200])
+parser.add_argument("--pu-clusters", type=float, help="Average number of PU clusters per pileup interaction", default=PU_CLUSTERS_PER_INTERACTION)
+parser.add_argument("--n-signal", type=int, help="Number of signal caloparticles per event", default=2)
+parser.add_argument("--mode", type=str, nargs="+", choices=["overlap","nooverlap"], help="Windows modes", default=["nooverlap","overlap"])
+parser.add_argument("--backend", type=str, choices=["root","columnar"], help="WindowCreator implementation: per-event python (root) or numpy on chunks of events (columnar)", default="root")
+parser.add_argument("--chunk-size", type=int, help="Number of events per chunk of the columnar backend", default=1000)
+parser.add_argument("--wp-file", type=str,  help="File with sim fraction thresholds (read with uproot), otherwise a flat threshold is used")
+parser.add_argument("--simfraction-threshold", type=float, help="Flat simfraction threshold (without --wp-file)", default=0.05)
+parser.add_argument("--maxnocalow", type=int,  help="Number of no calo window per event", default=15)
+parser.add_argument("--min-et-seed", type=float,  help="Min Et of the seeds", default=1.)
+parser.add_argument("--no-json", action="store_true", help="Do not serialize the windows in json", default=False)
+parser.add_argument("--seed", type=int, help="Random seed of the events generation and of the windows sampling", default=0)
+parser.add_argument("-o","--outputfile", type=str, help="Save the results in a csv file")
+args = parser.parse_args()
+
+if args.backend == "columnar":
+    from windows_creator_columnar import ColumnarWindowCreator as WindowCreator, events_chunk
+
+if args.wp_file:
+    simfraction_thresholds = SimfractionThresholds.from_file(args.wp_file)
+else:
+    simfraction_thresholds = SimfractionThresholds([0., 1e6], [0., 5.], [[args.simfraction_threshold]])
+
+
+def get_windows_events(windows_creator, events):
+    '''
+    List of (windows, metadata) of the events: event by event, or by chunks of events for the columnar backend
+    (the events are converted to awkward arrays before, as read by uproot)
+    '''
+    if args.backend == "columnar":
+        return [ result for chunk in events for result in windows_creator.get_windows_chunk(chunk, dump_json=not args.no_json) ]
+    return [ windows_creator.get_windows(event, dump_json=not args.no_json) for event in events ]
+
+
+def run_benchmark(events, overlap):
+    windows_creator = WindowCreator(simfraction_thresholds, 1e-2,
+                                    cl_min_fraction=1e-4,
+                                    min_et_seed=args.min_et_seed,
+                                    overlapping_window=overlap,
+                                    nocalowNmax=args.maxnocalow,
+                                    random_seed=args.seed,
+                                    timing=True)
+    # Time
+    if args.backend == "columnar":
+        events = [ events_chunk(events[i:i+args.chunk_size], windows_creator.branches)
+                   for i in range(0, len(events), args.chunk_size) ]
+    t0 = perf_counter()
+    results = get_windows_events(windows_creator, events)
+    elapsed = perf_counter() - t0
+    nwindows = sum(len(windows) for windows, _ in results)
+    # Memory: peak of the allocations during each event (each chunk for the columnar backend)
+    peak = 0
+    tracemalloc.start()
+    for event in events:
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        get_windows_events(windows_creator, [event])
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - current)
+    tracemalloc.stop()
+
+    meta = pd.DataFrame([ metadata for _, metadata in results ])
+    result = {
+        "events_s": len(meta) / elapsed,
+        "windows_s": nwindows / elapsed,
+        "ms_event": 1e3 * elapsed / len(meta),
+        "peak_MB": peak / 1024**2,
+        "n_pfclusters": meta.n_pfclusters.mean(),
+        "n_windows": nwindows / len(meta),
+    }
+    for stage in [ c for c in meta.columns if c.startswith("t_") ]:
+        result["ms_" + stage[2:]] = 1e3 * meta[stage].mean()
+    return result
+
+
+results = []
+rng = np.random.default_rng(args.seed)
+for pileup in args.pileup:
+    events = [ generate_event(rng, pileup=pileup, n_signal=args.n_signal, pu_clusters_per_interaction=args.pu_clusters)
+               for _ in range(args.nevents) ]
+    for mode in args.mode:
+        result = {"pileup": pileup, "mode": mode}
+        result.update(run_benchmark(events, overlap=(mode == "overlap")))
+        print("PU {:>5.0f} | {:<9} | {:6.1f} pfClusters {:6.1f} windows | {:8.1f} events/s {:9.1f} windows/s | peak {:7.2f} MB".format(
+                pileup, mode, result["n_pfclusters"], result["n_windows"], result["events_s"], result["windows_s"], result["peak_MB"]))
+        results.append(result)
+
+results = pd.DataFrame(results)
+print()
+print(results.to_string(index=False, float_format="{:.3f}".format))
+if args.outputfile:
+    results.to_csv(args.outputfile, index=False)
@@ -1,40 +1,112 @@
 from collections import defaultdict
-from operator import itemgetter
+import numpy as np
 
 
-def get_calo_association(clusters_scores, sort_calo_cl=False, min_sim_fraction=1e-5, debug=False):
+def get_scores_matrix(clusters_scores, fill_value=-np.inf):
     '''
-    pfCluster_scores is a list. For each pfCluster, there is a list of scores for each calo. 
-    Each cluster is associated with the calo with the highest score (with a minumum score of 1e-5). 
-    Each calo is assocciated with the list of cluster for which it has the highest score.
+    (ncl x ncalo) matrix of the scores from the list of scores of each pfCluster
+    (e.g. the pfCluster_sim_fraction branch of one event). 
+    The missing scores are filled with fill_value, lower than any score.
+    '''
+    if isinstance(clusters_scores, np.ndarray) and clusters_scores.ndim == 2:
+        return clusters_scores.astype(np.float64, copy=False)
+    lengths = [ len(scores) for scores in clusters_scores ]
+    matrix = np.full((len(lengths), max(lengths, default=0)), fill_value, dtype=np.float64)
+    for clid, (scores, n) in enumerate(zip(clusters_scores, lengths)):
+        if n: matrix[clid, :n] = scores
+    return matrix
+
+
+def get_calo_association_array(clusters_scores, min_sim_fraction=1e-5, calo_mask=None):
+    '''
+    Array version of get_calo_association for one event. 
+    clusters_scores is the (ncl x ncalo) matrix of scores (or the list of scores of each pfCluster).
+    Each cluster is associated with the calo with the highest score (if higher than min_sim_fraction).
+    If calo_mask (ncalo,) is given only the selected calos are considered (e.g. the signal caloparticles).
+
+    Returns:
+    - cluster_calo: (ncl,) array of the associated calo index (-1 if absent)
+    - cluster_score: (ncl,) array of the score of the associated calo (-1 if absent)
+    - calo_clusters: list with, for each calo, the array of the associated clusters sorted by decreasing score
+    '''
+    matrix = get_scores_matrix(clusters_scores)
+    ncl, ncalo = matrix.shape
+    if ncalo == 0:
+        return np.full(ncl, -1, dtype=np.int64), np.full(ncl, -1., dtype=np.float64), []
+    if calo_mask is not None:
+        matrix = np.where(np.asarray(calo_mask, dtype=bool)[:ncalo], matrix, -np.inf)
+    # The first calo is taken in case of equal scores, as in the sorting of get_calo_association
+    best = np.argmax(matrix, axis=1)
+    best_score = matrix[np.arange(ncl), best]
+    assoc = best_score > min_sim_fraction
+    cluster_calo = np.where(assoc, best, -1)
+    cluster_score = np.where(assoc, best_score, -1.)
+    # Clusters sorted by calo and decreasing score (stable: equal scores in the clusters order)
+    clids = np.nonzero(assoc)[0]
+    clids = clids[np.argsort(-best_score[clids], kind="stable")]
+    clids = clids[np.argsort(best[clids], kind="stable")]
+    counts = np.bincount(best[clids], minlength=ncalo)
+    calo_clusters = np.split(clids, np.cumsum(counts)[:-1])
+    return cluster_calo, cluster_score, calo_clusters
+
+
+def get_calo_association_chunk(clusters_scores, min_sim_fraction=1e-5, calo_mask=None):
+    '''
+    Array version of get_calo_association for a chunk of events.
+    clusters_scores is the awkward array (events, clusters, calos) of the scores (e.g. pfCluster_sim_fraction read with uproot).
+    If calo_mask (events, calos) is given only the selected calos are considered.
+
+    Returns awkward arrays:
+    - cluster_calo: (events, clusters) index of the associated calo (-1 if absent)
+    - cluster_score: (events, clusters) score of the associated calo (-1 if absent)
+    - calo_clusters: (events, calos, clusters) associated clusters of each calo sorted by decreasing score
     '''
-    calo_cluster_assoc_scores = defaultdict(list)
-    calo_cluster_assoc_map = defaultdict(list)
-    cluster_calo_assoc = {}
-    cluster_calo_assoc_score = {}
-
-    for clid, scores in enumerate(clusters_scores):
-        # order caloparticle by fraction
-        caloids =  list(sorted( enumerate(scores), key=itemgetter(1), reverse=True))
-    
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        if caloids and caloids[0][1]> min_sim_fraction:
-            cluster_calo_assoc[clid] = caloids[0][0]
-            cluster_calo_assoc_score[clid] = caloids[0][1]
-            # save for the calocluster in the caloparticle if it is the one with more fraction
-            # This is necessary in case one caloparticle is linked with more than one cluster
-            calo_cluster_assoc_map[caloids[0][0]].append(clid)
-            if sort_calo_cl:  calo_cluster_assoc_scores[caloids[0][0]].append((clid, caloids[0][1]))
-        else:
-            # Save -1 index for caloparticle absent
-            cluster_calo_assoc[clid] = -1
-            cluster_calo_assoc_score[clid] = -1
-        
-    # Now sort the clusters associated to a caloparticle with the fraction 
+    import awkward as ak
+    ncalos = ak.to_numpy(ak.fill_none(ak.max(ak.num(clusters_scores, axis=2), axis=1), 0))
+    if calo_mask is not None:
+        clusters_scores = ak.where(calo_mask[:, np.newaxis], clusters_scores, -np.inf)
+    best = ak.argmax(clusters_scores, axis=-1)
+    best_score = ak.max(clusters_scores, axis=-1)
+    assoc = ak.fill_none(best_score > min_sim_fraction, False)
+    cluster_calo = ak.values_astype(ak.where(assoc, ak.fill_none(best, -1), -1), np.int64)
+    cluster_score = ak.values_astype(ak.where(assoc, ak.fill_none(best_score, -1.), -1.), np.float64)
+
+    # Flat arrays of (event, calo, score, cluster) of the associated clusters
+    ncls = ak.to_numpy(ak.num(cluster_calo, axis=1))
+    flat_calo = ak.to_numpy(ak.flatten(cluster_calo))
+    flat_score = ak.to_numpy(ak.flatten(cluster_score))
+    flat_event = np.repeat(np.arange(len(ncls)), ncls)
+    flat_clid = np.arange(len(flat_calo)) - np.repeat(np.cumsum(ncls) - ncls, ncls)
+    sel = flat_calo != -1
+    flat_event, flat_calo, flat_score, flat_clid = flat_event[sel], flat_calo[sel], flat_score[sel], flat_clid[sel]
+    # Sort by event, calo and decreasing score (lexsort is stable)
+    order = np.lexsort((-flat_score, flat_calo, flat_event))
+    calo_slot = (np.cumsum(ncalos) - ncalos)[flat_event] + flat_calo
+    counts = np.bincount(calo_slot, minlength=int(ncalos.sum()))
+    calo_clusters = ak.unflatten(ak.unflatten(flat_clid[order], counts), ncalos)
+    return cluster_calo, cluster_score, calo_clusters
+
+
+def get_association_dicts(cluster_calo, cluster_score, calo_clusters, sort_calo_cl=False, debug=False):
+    '''
+    Dictionaries of the association (cluster -> calo, cluster -> score, calo -> clusters) 
+    from the output of get_calo_association_array
+    '''
+    cluster_calo_list = cluster_calo.tolist()
+    cluster_score_list = cluster_score.tolist()
+    # Save -1 index (and score) for caloparticle absent
+    cluster_calo_assoc = { clid: calo for clid, calo in enumerate(cluster_calo_list) }
+    cluster_calo_assoc_score = { clid: (score if calo != -1 else -1)
+                                 for clid, (calo, score) in enumerate(zip(cluster_calo_list, cluster_score_list)) }
+    # Calo keys in the order of the first associated cluster
+    calos, first_cluster = np.unique(cluster_calo[cluster_calo != -1], return_index=True)
+    calos = calos[np.argsort(first_cluster)].tolist()
+
+    # The clusters associated to a caloparticle are sorted with the fraction 
     if sort_calo_cl:
         sorted_calo_cluster_assoc = {}
-        for caloid, clinfo in calo_cluster_assoc_scores.items():
-            sorted_calo_cluster_assoc[caloid] = sorted(clinfo, key=itemgetter(1), reverse=True)
+        for caloid in calos:
+            sorted_calo_cluster_assoc[caloid] = [ (clid, cluster_score_list[clid]) for clid in calo_clusters[caloid].tolist() ]
 
         if debug:
             for calo, cls in sorted_calo_cluster_assoc.items():
@@ -44,65 +116,89 @@ def get_calo_association(clusters_scores, sort_calo_cl=False, min_sim_fraction=1
 
         return cluster_calo_assoc, cluster_calo_assoc_score, sorted_calo_cluster_assoc
     else: 
+        # Clusters in the original order
+        calo_cluster_assoc_map = defaultdict(list)
+        for caloid in calos:
+            calo_cluster_assoc_map[caloid] = sorted(calo_clusters[caloid].tolist())
         return cluster_calo_assoc, cluster_calo_assoc_score, calo_cluster_assoc_map
 
 
-
-
-def get_calo_association_withpu(clusters_scores, calo_ispu, calo_isootpu,calo_simenergy,sort_calo_cl=False, min_sim_fraction=1e-5, debug=False):
+def get_calo_association(clusters_scores, sort_calo_cl=False, min_sim_fraction=1e-5, debug=False):
     '''
     pfCluster_scores is a list. For each pfCluster, there is a list of scores for each calo. 
     Each cluster is associated with the calo with the highest score (with a minumum score of 1e-5). 
     Each calo is assocciated with the list of cluster for which it has the highest score.
+    The association is computed by get_calo_association_array and returned as dictionaries.
     '''
-    calo_cluster_assoc_scores = defaultdict(list)
-    calo_cluster_assoc_map = defaultdict(list)
-    cluster_calo_assoc = {}
-    cluster_calo_assoc_score = {}
-    cluster_PU_simenergy = defaultdict(float)
-
-    for clid, scores in enumerate(clusters_scores):
-        # order caloparticle by fraction
-        caloids =  list(sorted( enumerate(scores), key=itemgetter(1), reverse=True))
-        caloids_signal = [ ] 
-        calois_pu = [ ]
-
-        for (caloid, score) in caloids:
-            # Separate caloparticles from PU and OOT Pu from 
-            if not calo_ispu[caloid] and not calo_isootpu[caloid]:
-                caloids_signal.append((caloid, score))
-            elif calo_ispu[caloid] and not calo_isootpu[caloid]:
-                calois_pu.append((caloid, score))
-                if score > min_sim_fraction:
-                    cluster_PU_simenergy[clid] += calo_simenergy[caloid] * score
-    
-        # Associate to che cluster the list of caloparticles ordered by fraction 
-        if caloids_signal and caloids_signal[0][1]> min_sim_fraction:
-            cluster_calo_assoc[clid] = caloids_signal[0][0]
-            cluster_calo_assoc_score[clid] = caloids_signal[0][1]
-            # save for the calocluster in the caloparticle if it is the one with more fraction
-            # This is necessary in case one caloparticle is linked with more than one cluster
-            calo_cluster_assoc_map[caloids_signal[0][0]].append(clid)
-            if sort_calo_cl:  calo_cluster_assoc_scores[caloids_signal[0][0]].append((clid, caloids_signal[0][1]))
-        else:
-            # Save -1 index for caloparticle absent
-            cluster_calo_assoc[clid] = -1
-            cluster_calo_assoc_score[clid] = -1
-
-    # Now sort the clusters associated to a caloparticle with the fraction 
-    if sort_calo_cl:
-        sorted_calo_cluster_assoc = {}
-        for caloid, clinfo in calo_cluster_assoc_scores.items():
-            sorted_calo_cluster_assoc[caloid] = sorted(clinfo, key=itemgetter(1), reverse=True)
+    return get_association_dicts(*get_calo_association_array(clusters_scores, min_sim_fraction),
+                                 sort_calo_cl=sort_calo_cl, debug=debug)
 
-        if debug:
-            for calo, cls in sorted_calo_cluster_assoc.items():
-                print("Calo: ", calo)
-                for cl in cls:
-                    print("\tCluster: {} , fraction: {}".format(cl[0], cl[1]))
 
-        return cluster_calo_assoc, cluster_calo_assoc_score, sorted_calo_cluster_assoc, cluster_PU_simenergy
-    else: 
-        return cluster_calo_assoc, cluster_calo_assoc_score, calo_cluster_assoc_map, cluster_PU_simenergy
+def get_pu_simenergy_array(clusters_scores, calo_ispu, calo_isootpu, calo_simenergy, min_sim_fraction=1e-5):
+    '''
+    PU simenergy of each cluster of one event: sum of simenergy * score of the in-time PU caloparticles 
+    (OOT PU excluded) with score higher than min_sim_fraction.
+    Returns the (ncl,) array of the PU simenergy and the (ncl,) mask of the clusters with at least one PU calo.
+    '''
+    matrix = get_scores_matrix(clusters_scores)
+    ncl, ncalo = matrix.shape
+    if ncalo == 0:
+        return np.zeros(ncl, dtype=np.float64), np.zeros(ncl, dtype=bool)
+    calo_pu = (np.asarray(calo_ispu, dtype=bool) & ~np.asarray(calo_isootpu, dtype=bool))[:ncalo]
+    pu_mask = calo_pu & (matrix > min_sim_fraction)
+    contributions = np.where(pu_mask, np.asarray(calo_simenergy, dtype=np.float64)[:ncalo] * matrix, 0.)
+    # Summed in the order of decreasing score
+    order = np.argsort(-matrix, axis=1, kind="stable")
+    pu_simenergy = np.cumsum(np.take_along_axis(contributions, order, axis=1), axis=1)[:, -1]
+    return pu_simenergy, pu_mask.any(axis=1)
+
+
+def get_calo_association_withpu_array(clusters_scores, calo_ispu, calo_isootpu, calo_simenergy, min_sim_fraction=1e-5):
+    '''
+    Array version of get_calo_association_withpu for one event: the clusters are associated only 
+    with the signal caloparticles (not PU or OOT PU) and the PU simenergy of each cluster is computed.
+    Returns cluster_calo, cluster_score, calo_clusters (as get_calo_association_array) and the (ncl,) PU simenergy.
+    '''
+    matrix = get_scores_matrix(clusters_scores)
+    calo_signal = ~np.asarray(calo_ispu, dtype=bool) & ~np.asarray(calo_isootpu, dtype=bool)
+    cluster_calo, cluster_score, calo_clusters = get_calo_association_array(matrix, min_sim_fraction, calo_mask=calo_signal)
+    pu_simenergy, _ = get_pu_simenergy_array(matrix, calo_ispu, calo_isootpu, calo_simenergy, min_sim_fraction)
+    return cluster_calo, cluster_score, calo_clusters, pu_simenergy
 
 
+def get_calo_association_withpu_chunk(clusters_scores, calo_ispu, calo_isootpu, calo_simenergy, min_sim_fraction=1e-5):
+    '''
+    Array version of get_calo_association_withpu for a chunk of events.
+    clusters_scores is the awkward array (events, clusters, calos) of the scores, calo_ispu, calo_isootpu 
+    and calo_simenergy the awkward arrays (events, calos) of the caloparticles.
+    Returns cluster_calo, cluster_score, calo_clusters (as get_calo_association_chunk) 
+    and the (events, clusters) PU simenergy.
+    '''
+    import awkward as ak
+    calo_ispu = ak.values_astype(calo_ispu, bool)
+    calo_isootpu = ak.values_astype(calo_isootpu, bool)
+    calo_signal = ~calo_ispu & ~calo_isootpu
+    cluster_calo, cluster_score, calo_clusters = get_calo_association_chunk(clusters_scores, min_sim_fraction,
+                                                                            calo_mask=calo_signal)
+    calo_pu = (calo_ispu & ~calo_isootpu)[:, np.newaxis]
+    pu_mask = calo_pu & (clusters_scores > min_sim_fraction)
+    pu_simenergy = ak.sum(ak.where(pu_mask, calo_simenergy[:, np.newaxis] * clusters_scores, 0.), axis=-1)
+    return cluster_calo, cluster_score, calo_clusters, pu_simenergy
+
+
+def get_calo_association_withpu(clusters_scores, calo_ispu, calo_isootpu,calo_simenergy,sort_calo_cl=False, min_sim_fraction=1e-5, debug=False):
+    '''
+    pfCluster_scores is a list. For each pfCluster, there is a list of scores for each calo. 
+    Each cluster is associated with the calo with the highest score (with a minumum score of 1e-5). 
+    Each calo is assocciated with the list of cluster for which it has the highest score.
+    Only the signal caloparticles are associated, the simenergy of the in-time PU caloparticles is summed
+    for each cluster (cluster_PU_simenergy). Computed on the masked scores matrix by get_calo_association_withpu_array.
+    '''
+    matrix = get_scores_matrix(clusters_scores)
+    calo_signal = ~np.asarray(calo_ispu, dtype=bool) & ~np.asarray(calo_isootpu, dtype=bool)
+    association = get_association_dicts(*get_calo_association_array(matrix, min_sim_fraction, calo_mask=calo_signal),
+                                        sort_calo_cl=sort_calo_cl, debug=debug)
+    pu_simenergy, has_pu = get_pu_simenergy_array(matrix, calo_ispu, calo_isootpu, calo_simenergy, min_sim_fraction)
+    # Only the clusters with PU caloparticles are saved
+    cluster_PU_simenergy = defaultdict(float, zip(np.nonzero(has_pu)[0].tolist(), pu_simenergy[has_pu].tolist()))
+    return association + (cluster_PU_simenergy,)
@@ -14,8 +14,15 @@ from pprint import pprint as pp
 import numpy as np
 import argparse
 import pickle
+import json
+import random
+import shutil
+from time import perf_counter
+import multiprocessing as mp
 import pandas as pd
-from windows_creator_general import WindowCreator
+from windows_creator_general import WindowCreator, enable_branches
+from simfraction_thresholds import SimfractionThresholds, WP_HISTO
+from ndjson_io import WindowsNdjsonWriter, COMPRESSIONS, ENCODERS
 
 parser = argparse.ArgumentParser()
 parser.add_argument("-i","--inputfile", type=str, help="inputfile", required=True)
@@ -28,6 +35,20 @@ parser.add_argument("-ov","--overlap", action="store_true",  help="Overlapping w
 parser.add_argument("--maxnocalow", type=int,  help="Number of no calo window per event", default=15)
 parser.add_argument("--min-et-seed", type=float,  help="Min Et of the seeds", default=1.)
 parser.add_argument("--pu-limit", type=float,  help="SimEnergy PU limit", default=1e6)
+parser.add_argument("--backend", type=str, choices=["root","columnar"], help="Events reading backend: PyROOT event by event, or uproot chunks with the windows of each chunk created with numpy (columnar)", default="root")
+parser.add_argument("--chunk-size", type=int,  help="Number of events per chunk in the columnar backend", default=1000)
+parser.add_argument("--output-format", type=str, choices=["ndjson","parquet","parquet_events"], 
+                    help="Output format: windows as json lines, parquet file with the features definition layout or event-level parquet file (clusters table + windows cluster indices)", default="ndjson")
+parser.add_argument("--compression", type=str, choices=COMPRESSIONS, help="Compression of the ndjson output, applied while writing", default="none")
+parser.add_argument("--encoder", type=str, choices=ENCODERS, help="Encoder of the windows in the ndjson output (msgpack: binary stream)", default="json")
+parser.add_argument("--float-digits", type=int, help="Round the floats of the ndjson output to N significant digits", default=None)
+parser.add_argument("-f","--features-def", type=str, help="Features definition file (parquet output and branches to read)", default="features_definition.json")
+parser.add_argument("--all-branches", action="store_true", help="Read the branches of all the features, not only of the ones in the features definition", default=False)
+parser.add_argument("--flavour", type=int, help="PdgID flavor to add to the dataset (parquet output)", default=11)
+parser.add_argument("--row-group-size", type=int, help="Number of windows (events for parquet_events) per parquet row group", default=None)
+parser.add_argument("--seed", type=int, help="Random seed of the windows ids and of the sampling of the no calo-matched windows (seeded for each event from input file and entry: same output for any -j)", default=None)
+parser.add_argument("--timing", action="store_true", help="Save the time spent in each stage of the windows creation in output.meta.csv and print a summary", default=False)
+parser.add_argument("-j","--workers", type=int, help="Number of parallel processes: the input files (or ranges of events) are split in shards", default=1)
 args = parser.parse_args()
 
 if "#_#" in args.inputfile: 
@@ -35,9 +56,6 @@ if "#_#" in args.inputfile:
 else:
     inputfiles = [args.inputfile]
 
-simfraction_thresholds_file = R.TFile(args.wp_file)
-simfraction_thresholds = simfraction_thresholds_file.Get("h2_Minimum_simScore_seedBins")
-
 # Parameters controlling the creation of the window
 # min simFraction for the seed with a signal caloparticle
 SEED_MIN_FRACTION=1e-2
@@ -46,37 +64,232 @@ CL_MIN_FRACION=1e-4
 # threshold of simEnergy PU / simEnergy signal for each cluster and seed to be matched with a caloparticle
 SIMENERGY_PU_LIMIT= args.pu_limit
 
-windows_creator = WindowCreator(simfraction_thresholds, SEED_MIN_FRACTION,
+if args.backend == "columnar":
+    from windows_creator_columnar import ColumnarWindowCreator as WindowCreator, CALOTREE
+    import uproot
+else:
+    CALOTREE = "recosimdumper/caloTree"
+
+if args.output_format != "ndjson":
+    from parquet_writer import WindowsParquetWriter, EventsParquetWriter
+    import pyarrow.parquet as pq
+if args.output_format != "ndjson" or not args.all_branches:
+    features_dict = json.load(open(args.features_def))["features_dict"]
+
+debug = args.debug
+nocalowNmax = args.maxnocalow
+
+
+def get_windows_creator(random_seed=None):
+    if args.backend == "columnar":
+        # Read with uproot: no ROOT needed
+        simfraction_thresholds = SimfractionThresholds.from_file(args.wp_file)
+    else:
+        simfraction_thresholds_file = R.TFile(args.wp_file)
+        simfraction_thresholds = SimfractionThresholds.from_TH2(simfraction_thresholds_file.Get(WP_HISTO))
+        simfraction_thresholds_file.Close()
+
+    return WindowCreator(simfraction_thresholds, SEED_MIN_FRACTION,
                                 cl_min_fraction=CL_MIN_FRACION,
                                 simenergy_pu_limit = SIMENERGY_PU_LIMIT,
                                 min_et_seed=args.min_et_seed,
                                 assoc_strategy=args.assoc_strategy,
                                 overlapping_window=args.overlap,
-                                nocalowNmax=args.maxnocalow)
+                                nocalowNmax=args.maxnocalow,
+                                random_seed=random_seed,
+                                # The branches not needed by the features definition are not read
+                                features_dict=None if args.all_branches else features_dict,
+                                timing=args.timing)
 
-debug = args.debug
-nocalowNmax = args.maxnocalow
 
-energies_maps = []
-metadata = []
-windows_files = open(args.outputfile, "w")
+def root_events(inputfiles, entry_start=None, entry_stop=None, branches=None):
+    for inputfile in inputfiles:
+        f = R.TFile(inputfile);
+        tree = f.Get(CALOTREE)
+        if branches is not None:
+            # Only the baskets of the needed branches are read
+            enable_branches(tree, branches)
+        print ("Starting")
+        if entry_start is None and entry_stop is None:
+            for event in tree:
+                yield event
+        else:
+            # Range of events of the shard
+            nentries = tree.GetEntries()
+            for ientry in range(entry_start or 0, min(entry_stop or nentries, nentries)):
+                tree.GetEntry(ientry)
+                yield tree
+        f.Close()
+
+
+def get_entries(inputfile):
+    if args.backend == "columnar":
+        with uproot.open(inputfile) as f:
+            return f[CALOTREE].num_entries
+    else:
+        f = R.TFile(inputfile)
+        nentries = f.Get(CALOTREE).GetEntries()
+        f.Close()
+        return nentries
+
 
-all_metadata = [ ] 
+def events_windows(windows_creator, inputfiles, entry_start=None, entry_stop=None):
+    '''
+    Generator of the (windows, metadata, reading time) of the events of the input files (optionally in the range of entries).
+    With --seed the random generator is seeded for each event from the seed, the input file and the entry,
+    so that the windows ids and sampling depend only on the event, not on the split of the events in shards.
+    '''
+    for inputfile in inputfiles:
+        if args.backend == "columnar":
+            # The windows of all the events of a chunk are created at once: the reading time is shared by the events
+            ientry = entry_start or 0
+            t_last = perf_counter()
+            for chunk in windows_creator.iterate_chunks(inputfile, step_size=args.chunk_size,
+                                                        entry_start=entry_start, entry_stop=entry_stop):
+                t_read = (perf_counter() - t_last) / max(len(chunk), 1)
+                keys = [ (args.seed, os.path.basename(inputfile), i) for i in range(ientry, ientry + len(chunk)) ]
+                ientry += len(chunk)
+                for windows_data, debug_metadata in windows_creator.get_windows_chunk(chunk,
+                                                            keys if args.seed is not None else None, dump_json=False):
+                    yield windows_data, debug_metadata, t_read
+                t_last = perf_counter()
+        else:
+            t_last = perf_counter()
+            for ientry, event in enumerate(root_events([inputfile], entry_start, entry_stop, windows_creator.branches),
+                                           start=entry_start or 0):
+                # Reading of the entry (the baskets are read when the next event is requested)
+                t_read = perf_counter() - t_last
+                if args.seed is not None:
+                    windows_creator.seed_event(args.seed, os.path.basename(inputfile), ientry)
+                windows_data, debug_metadata = windows_creator.get_windows(event, debug= args.debug, dump_json=False)
+                yield windows_data, debug_metadata, t_read
+                t_last = perf_counter()
 
-for inputfile in inputfiles:
-    f = R.TFile(inputfile);
-    tree = f.Get("recosimdumper/caloTree")
 
-    print ("Starting")
-    for iev, event in enumerate(tree):
+def run_windows(windows_creator, inputfiles, outputfile, entry_start=None, entry_stop=None):
+    '''
+    Runs the window creation on the events of the input files (optionally in the range of entries)
+    and writes the windows in the outputfile. Returns the list of metadata of the events.
+    '''
+    all_metadata = [ ] 
+    if args.output_format == "parquet":
+        windows_writer = WindowsParquetWriter(outputfile, features_dict, flavour=args.flavour,
+                                              row_group_size=args.row_group_size or 5000)
+    elif args.output_format == "parquet_events":
+        windows_writer = EventsParquetWriter(outputfile, features_dict, flavour=args.flavour,
+                                             row_group_size=args.row_group_size or 500)
+    else:
+        windows_writer = WindowsNdjsonWriter(outputfile, compression=args.compression, encoder=args.encoder,
+                                             float_digits=args.float_digits)
+
+    for iev, (windows_data, debug_metadata, t_read) in enumerate(events_windows(windows_creator, inputfiles,
+                                                                                entry_start, entry_stop)):
         if iev % 10 == 0: print(".",end="")
-        windows_data, debug_metadata = windows_creator.get_windows(event, debug= args.debug )
         all_metadata.append(debug_metadata)
-        for w in windows_data:
-            windows_files.write(w)
-            windows_files.write('\n')           
-    f.Close()
+        t_write = perf_counter()
+        if args.output_format == "parquet_events":
+            # All the windows of the event together
+            windows_writer.write(windows_data)
+        elif args.output_format == "ndjson":
+            # The serialization (json/orjson/msgpack encoding) is timed separately from the compression and file I/O
+            records = [ windows_writer.serialize(w) for w in windows_data ]
+            t_json = perf_counter() - t_write
+            t_write = perf_counter()
+            for record in records:
+                windows_writer.write_record(record)
+        else:
+            for w in windows_data:
+                windows_writer.write(w)
+        t_last = perf_counter()
+        if args.timing:
+            debug_metadata["t_read"] = t_read
+            if args.output_format == "ndjson":
+                debug_metadata["t_json"] = t_json
+            debug_metadata["t_write"] = t_last - t_write
+
+    windows_writer.close()
+    return all_metadata
+
+
+def print_timing_summary(meta):
+    '''
+    Summary of the time spent in each stage (t_* columns of the events metadata)
+    '''
+    stages = [ c for c in meta.columns if c.startswith("t_") ]
+    total = meta[stages].sum()
+    print("\nTiming summary: {} events, {:.1f} events/s (windows creation, single process)".format(
+                len(meta), len(meta) / total.sum()))
+    print("{:<16} {:>10} {:>14} {:>8}".format("stage", "total [s]", "mean [ms/ev]", "frac"))
+    for stage in stages:
+        print("{:<16} {:>10.2f} {:>14.3f} {:>8.1%}".format(stage[2:], total[stage],
+                    1e3 * meta[stage].mean(), total[stage] / total.sum()))
+    print("Mean event size: {:.1f} pfClusters, {:.1f} caloparticles, {:.1f} windows".format(
+                meta.n_pfclusters.mean(), meta.n_caloparticles.mean(), (meta.n_windows_matched + meta.n_windows_nomatched).mean()))
+
+
+def get_shards(inputfiles, nworkers):
+    '''
+    Splits the input files in (inputfile, entry_start, entry_stop) shards.
+    If there are less files than workers the files are split in ranges of events.
+    '''
+    nsplits = -(-nworkers // len(inputfiles))  # ceil
+    shards = []
+    for inputfile in inputfiles:
+        if nsplits == 1:
+            shards.append((inputfile, None, None))
+            continue
+        nentries = get_entries(inputfile)
+        step = max(1, -(-nentries // nsplits))
+        for entry_start in range(0, nentries, step):
+            shards.append((inputfile, entry_start, min(entry_start + step, nentries)))
+    return shards
+
+
+def run_shard(ishard_shard):
+    ishard, (inputfile, entry_start, entry_stop) = ishard_shard
+    # Each worker has its own WindowCreator and random state: with --seed the random generator 
+    # is seeded for each event from the input file and entry (see run_windows), independently of the shards
+    windows_creator = get_windows_creator(args.seed)
+    outputfile = "{}.shard{}".format(args.outputfile, ishard)
+    metadata = run_windows(windows_creator, [inputfile], outputfile, entry_start, entry_stop)
+    return outputfile, metadata
+
+
+def merge_shards(outputfiles, outputfile):
+    if args.output_format != "ndjson":
+        writer = None
+        for shardfile in outputfiles:
+            pf = pq.ParquetFile(shardfile)
+            if writer is None:
+                writer = pq.ParquetWriter(outputfile, pf.schema_arrow)
+            for irg in range(pf.num_row_groups):
+                writer.write_table(pf.read_row_group(irg))
+        writer.close()
+    else:
+        # The gzip members, zstd frames and msgpack streams can be concatenated
+        with open(outputfile, "wb") as out:
+            for shardfile in outputfiles:
+                with open(shardfile, "rb") as shard:
+                    shutil.copyfileobj(shard, out)
+    for shardfile in outputfiles:
+        os.remove(shardfile)
+
+
+if args.workers > 1:
+    shards = get_shards(inputfiles, args.workers)
+    print("Processing {} shards with {} workers".format(len(shards), args.workers))
+    all_metadata = []
+    outputfiles = []
+    # fork: the workers inherit the configuration of the script
+    with mp.get_context("fork").Pool(args.workers) as pool:
+        for outputfile, metadata in pool.imap(run_shard, enumerate(shards)):
+            outputfiles.append(outputfile)
+            all_metadata += metadata
+    merge_shards(outputfiles, args.outputfile)
+else:
+    all_metadata = run_windows(get_windows_creator(args.seed), inputfiles, args.outputfile)
  
 meta = pd.DataFrame(all_metadata)
 meta.to_csv("output.meta.csv", sep=';', index=False)
-        
+if args.timing:
+    print_timing_summary(meta)
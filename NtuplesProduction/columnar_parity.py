@@ -0,0 +1,96 @@
+from __future__ import print_function
+import json
+import argparse
+import numpy as np
+import awkward as ak
+from windows_creator_general import WindowCreator
+from windows_creator_columnar import ColumnarWindowCreator, events_chunk
+from simfraction_thresholds import SimfractionThresholds
+from synthetic_events import generate_event
+
+'''
+Parity check between the per-event WindowCreator (PyROOT path) and the ColumnarWindowCreator
+working on chunks of events, on synthetic events (synthetic_events.py).
+
+The events are processed one by one by the WindowCreator and in chunks by ColumnarWindowCreator.get_windows_chunk
+(with the branches converted to the float32/int32 types read by uproot): the json of all the windows
+(values, types and keys order) and the events metadata must be identical.
+The check is done in overlapping and non-overlapping mode, with all the branches or only the branches
+of the features definition, and with the random generator seeded once or for each event (--seed of cluster_ndjson_general.py).
+Run it from the NtuplesProduction folder:
+
+    python columnar_parity.py -n 50 --pileup 60 --chunk-size 20
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n","--nevents", type=int, help="Number of synthetic events", default=50)
+parser.add_argument("--pileup", type=float, help="Pileup level of the events", default=60)
+parser.add_argument("--chunk-size", type=int, help="Number of events per chunk", default=20)
+parser.add_argument("-f","--features-def", type=str, help="Features definition file", default="features_definition.json")
+parser.add_argument("-s", "--seed", type=int, help="Random seed", default=0)
+args = parser.parse_args()
+
+
+def uproot_types(chunk):
+    '''
+    Branches with the types read by uproot (the float values of the synthetic events are already rounded at float32)
+    '''
+    fields = {}
+    for br in chunk.fields:
+        dtype = ak.to_numpy(ak.flatten(chunk[br], axis=None)).dtype if chunk[br].ndim > 1 else ak.to_numpy(chunk[br]).dtype
+        if dtype.kind == "f":
+            fields[br] = ak.values_astype(chunk[br], np.float32)
+        elif dtype.kind == "i":
+            fields[br] = ak.values_astype(chunk[br], np.int32)
+        else:
+            fields[br] = chunk[br]
+    return ak.zip(fields, depth_limit=1)
+
+
+def metadata_values(metadata):
+    return { k: v for k, v in metadata.items() if not k.startswith("t_") }
+
+
+rng = np.random.default_rng(args.seed)
+events = [ generate_event(rng, pileup=args.pileup) for _ in range(args.nevents) ]
+features_dict = json.load(open(args.features_def))["features_dict"]
+simfraction_thresholds = SimfractionThresholds([0., 10., 1e6], [0., 1.479, 5.], [[0.05, 0.1], [0.02, 0.03]])
+
+ok = True
+for overlap in [False, True]:
+    for features in [None, features_dict]:
+        for per_event_seed in [False, True]:
+            options = dict(cl_min_fraction=1e-4, overlapping_window=overlap, nocalowNmax=5, random_seed=args.seed,
+                           features_dict=features, timing=True)
+            reference = WindowCreator(simfraction_thresholds, 1e-2, **options)
+            columnar = ColumnarWindowCreator(simfraction_thresholds, 1e-2, **options)
+            keys = [ (args.seed, "synthetic.root", ientry) for ientry in range(len(events)) ]
+            windows_ref, meta_ref = [], []
+            for ientry, event in enumerate(events):
+                if per_event_seed:
+                    reference.seed_event(*keys[ientry])
+                windows, metadata = reference.get_windows(event, dump_json=True)
+                windows_ref.append(windows)
+                meta_ref.append(metadata_values(metadata))
+            windows_col, meta_col = [], []
+            for start in range(0, len(events), args.chunk_size):
+                chunk = uproot_types(events_chunk(events[start:start+args.chunk_size], columnar.branches))
+                for windows, metadata in columnar.get_windows_chunk(chunk, keys[start:start+args.chunk_size] if per_event_seed else None,
+                                                                    dump_json=True):
+                    windows_col.append(windows)
+                    meta_col.append(metadata_values(metadata))
+            errors = [ "event {}: {} windows instead of {}".format(i, len(c), len(r))
+                       for i, (r, c) in enumerate(zip(windows_ref, windows_col)) if len(r) != len(c) ]
+            errors += [ "event {} window {}: different json".format(i, j)
+                        for i, (r, c) in enumerate(zip(windows_ref, windows_col)) if len(r) == len(c)
+                        for j, (wr, wc) in enumerate(zip(r, c)) if wr != wc ]
+            errors += [ "event {}: different metadata".format(i) for i, (r, c) in enumerate(zip(meta_ref, meta_col)) if r != c ]
+            print("overlap={:<5} features_def={:<5} seed_per_event={:<5}: {} windows, {}".format(str(overlap), str(features is not None),
+                    str(per_event_seed), sum(len(w) for w in windows_ref), "OK" if not errors else "{} differences".format(len(errors))))
+            for e in errors[:10]:
+                print("   " + e)
+            ok = ok and not errors
+
+if not ok:
+    raise SystemExit(1)
+print("Parity OK")
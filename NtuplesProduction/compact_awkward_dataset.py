@@ -0,0 +1,188 @@
+import os
+import json
+import argparse
+from glob import glob
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from parquet_writer import FeaturesStats, STATS_EXTENSION
+
+# source /cvmfs/sft.cern.ch/lcg/views/LCG_101/x86_64-centos7-gcc11-opt/setup.sh
+
+'''
+Compaction of a parquet windows dataset made of many parts of different sizes (e.g. records_<jobid>.parquet of the condor jobs).
+
+The windows are rewritten in files of about `--target-size` MB, all made of row groups of `--row-group-size` windows
+(only the last row groups of each cluster are smaller), with the same schema of the input files.
+The windows of different flavours (window_metadata.flavour) are never written in the same file,
+otherwise the windows keep their order: optionally they can be clustered in the row groups by `--cluster-by`
+and sorted by `--sort-by` as done by convert_awkward_dataset.py.
+The input is streamed one row group at the time.
+
+The output folder contains the statistics sidecars of the files (merged by finalize_awkward_dataset.py)
+and the manifest (manifest.json) with the number of windows of each file, used by the training loader (awk_data.py)
+to balance the files between the workers.
+
+    python compact_awkward_dataset.py -i DATASET_DIR -o COMPACTED_DIR --target-size 512 --row-group-size 5000
+'''
+
+MANIFEST_NAME = "manifest.json"
+FLAVOUR_FIELD = "window_metadata.flavour"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i","--inputdir", type=str, help="Dataset directory",required=True)
+parser.add_argument("-o","--outputdir", type=str, help="Output directory of the compacted dataset",required=True)
+parser.add_argument("-n","--name", type=str, help="Name of the output files", default="records")
+parser.add_argument("--target-size", type=float, help="Target size of the output files (MB)", default=512)
+parser.add_argument("--row-group-size", type=int, help="Number of windows of each row group", default=5000)
+parser.add_argument("--cluster-by", type=str, nargs="*", help="Fields (group.field) clustering the windows in the row groups, e.g. seed_features.seed_iz (default: windows order kept)",
+                    default=[])
+parser.add_argument("--sort-by", type=str, help="Field (group.field) sorting the windows of each row group, e.g. seed_features.et_seed (default: no sorting)", default=None)
+parser.add_argument("--compression", type=str, help="Parquet compression codec", default="snappy",
+                    choices=["snappy", "zstd", "gzip", "lz4", "brotli", "none"])
+args = parser.parse_args()
+
+
+def get_rows_per_file(bytes_per_window):
+    '''
+    Number of windows of the files of the target size: a multiple of the row group size
+    '''
+    rows_per_file = args.target_size * 1024**2 / max(bytes_per_window, 1)
+    return max(1, round(rows_per_file / args.row_group_size)) * args.row_group_size
+
+
+def get_field(table, field):
+    group, name = field.split(".")
+    return pc.struct_field(table.column(group).combine_chunks(), [table.schema.field(group).type.get_field_index(name)])
+
+
+def has_field(schema, field):
+    group, name = field.split(".")
+    return group in schema.names and pa.types.is_struct(schema.field(group).type) and schema.field(group).type.get_field_index(name) >= 0
+
+
+def split_table(table, fields):
+    '''
+    Split the table in the tables of the windows with the same values of the fields
+    '''
+    if not fields:
+        return [ ((), table) ]
+    values = np.stack([ get_field(table, f).to_numpy(zero_copy_only=False).astype(np.float64) for f in fields ], axis=1)
+    keys, inverse = np.unique(values, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    return [ (tuple(key), table.take(np.nonzero(inverse == i)[0])) for i, key in enumerate(keys) ]
+
+
+class CompactedWriter():
+    '''
+    Writer of the compacted files of a flavour: the windows are buffered for each cluster
+    and written in row groups of `row_group_size` windows, a new file is opened every `rows_per_file` windows.
+    '''
+    def __init__(self, schema, flavour, rows_per_file):
+        self.schema = schema
+        self.flavour = flavour
+        self.rows_per_file = rows_per_file
+        self.buffers = {}
+        self.writer = None
+        self.files = []
+
+    def open(self):
+        filename = "{}_{}.{:04d}.parquet".format(args.name, self.flavour, len(self.files))
+        self.writer = pq.ParquetWriter(os.path.join(args.outputdir, filename), self.schema,
+                                       compression=args.compression, write_statistics=True)
+        self.stats = FeaturesStats()
+        self.files.append({"file": filename, "flavour": self.flavour, "nwindows": 0, "row_groups": 0})
+
+    def close_file(self):
+        self.writer.close()
+        self.stats.save(os.path.join(args.outputdir, self.files[-1]["file"]) + STATS_EXTENSION)
+        self.files[-1]["size"] = os.path.getsize(os.path.join(args.outputdir, self.files[-1]["file"]))
+        self.writer = None
+        # The windows are compressed better in the compacted files: updating the estimate of their size
+        written = [ f for f in self.files if "size" in f ]
+        self.rows_per_file = get_rows_per_file(sum(f["size"] for f in written) / sum(f["nwindows"] for f in written))
+
+    def write(self, key, table):
+        buffer = self.buffers.setdefault(key, [])
+        buffer.append(table)
+        nrows = sum(t.num_rows for t in buffer)
+        if nrows >= args.row_group_size:
+            table = pa.concat_tables(buffer)
+            nfull = (nrows // args.row_group_size) * args.row_group_size
+            for i in range(0, nfull, args.row_group_size):
+                self.write_row_group(table.slice(i, args.row_group_size))
+            self.buffers[key] = [ table.slice(nfull) ] if nfull < nrows else []
+
+    def write_row_group(self, table):
+        if args.sort_by and has_field(self.schema, args.sort_by):
+            table = table.take(pc.sort_indices(get_field(table, args.sort_by)))
+        if self.writer is None:
+            self.open()
+        self.writer.write_table(table, row_group_size=table.num_rows)
+        self.stats.fill(table)
+        self.files[-1]["nwindows"] += table.num_rows
+        self.files[-1]["row_groups"] += 1
+        if self.files[-1]["nwindows"] >= self.rows_per_file:
+            self.close_file()
+
+    def close(self):
+        for key in list(self.buffers):
+            if self.buffers[key]:
+                self.write_row_group(pa.concat_tables(self.buffers.pop(key)))
+        if self.writer is not None:
+            self.close_file()
+
+
+if __name__ == "__main__":
+
+    inputfiles = sorted(glob(args.inputdir + "/*.parquet"))
+    if not inputfiles:
+        raise Exception(f"No parquet files in {args.inputdir}")
+    if os.path.abspath(args.outputdir) == os.path.abspath(args.inputdir):
+        raise Exception("The output directory must be different from the input directory")
+    os.makedirs(args.outputdir, exist_ok=True)
+
+    # Checking the schema and estimating the size of the windows from the metadata of the files
+    schema = pq.read_schema(inputfiles[0])
+    nwindows, nbytes = 0, 0
+    for file in inputfiles:
+        pfile = pq.ParquetFile(file)
+        if not pfile.schema_arrow.equals(schema):
+            raise Exception(f"The schema of {file} is different from the schema of {inputfiles[0]}")
+        for i in range(pfile.metadata.num_row_groups):
+            row_group = pfile.metadata.row_group(i)
+            nwindows += row_group.num_rows
+            nbytes += sum(row_group.column(j).total_compressed_size for j in range(row_group.num_columns))
+    if not has_field(schema, FLAVOUR_FIELD):
+        raise Exception(f"{FLAVOUR_FIELD} not available: only the windows datasets can be compacted")
+    # Uniform row groups: the number of windows of each file is a multiple of the row group size
+    rows_per_file = get_rows_per_file(nbytes / max(nwindows, 1))
+    cluster_by = [ f for f in args.cluster_by if has_field(schema, f) ]
+    print("Compacting {} windows ({:.1f} MB) of {} files: {} windows per file".format(nwindows, nbytes / 1024**2, len(inputfiles), rows_per_file))
+
+    writers = {}
+    for file in inputfiles:
+        pfile = pq.ParquetFile(file)
+        for i in range(pfile.metadata.num_row_groups):
+            for (flavour,), table_flavour in split_table(pfile.read_row_group(i), [FLAVOUR_FIELD]):
+                flavour = int(flavour)
+                if flavour not in writers:
+                    writers[flavour] = CompactedWriter(schema, flavour, rows_per_file)
+                for key, table in split_table(table_flavour, cluster_by):
+                    writers[flavour].write(key, table)
+
+    files = []
+    for flavour in sorted(writers):
+        writers[flavour].close()
+        files += writers[flavour].files
+
+    manifest = {
+        "nwindows": sum(f["nwindows"] for f in files),
+        "row_group_size": args.row_group_size,
+        "target_size": args.target_size,
+        "files": files,
+    }
+    with open(os.path.join(args.outputdir, MANIFEST_NAME), "w") as o:
+        json.dump(manifest, o, indent=2)
+    print("Written {} windows in {} files in {}".format(manifest["nwindows"], len(files), args.outputdir))
@@ -20,6 +20,9 @@ parser.add_argument("-q", "--queue", type=str, help="Condor queue", default="lon
 parser.add_argument("-f","--features-def", type=str, help="Features definition file", default="features_definition.json")
 parser.add_argument("-cf","--condor-folder", type=str,  help="Condor folder", default="condor_ndjson")
 parser.add_argument("--flavour", type=int, help="PdgID flavor to add to the dataset", default=11)
+parser.add_argument("--compact", action="store_true", help="Compact schema: float32 features and int16/int8 detector indices")
+parser.add_argument("--compression", type=str, help="Parquet compression codec", default="snappy",
+                    choices=["snappy", "zstd", "gzip", "lz4", "brotli", "none"])
 args = parser.parse_args()
 
 
@@ -35,7 +38,7 @@ condor = '''executable              = run_awkward.sh
 output                  = output/strips.$(ClusterId).$(ProcId).out
 error                   = error/strips.$(ClusterId).$(ProcId).err
 log                     = log/strips.$(ClusterId).log
-transfer_input_files    = ../convert_awkward_dataset.py, ../{features_def}
+transfer_input_files    = ../convert_awkward_dataset.py, ../ndjson_io.py, ../parquet_writer.py, ../{features_def}
 
 +JobFlavour             = "{queue}"
 queue arguments from arguments.txt
@@ -59,7 +62,7 @@ echo -e "Running Awkward dumper.."
 
 mkdir output;
 python convert_awkward_dataset.py -i ${INPUTFILE} -o ./output -n records_${JOBID}.parquet \
-                 -g ${NFILES} -f {features_def} --flavour ${FLAVOUR};
+                 -g ${NFILES} -f {features_def} --flavour ${FLAVOUR} {options};
 
 echo -e "Copying result to: $OUTPUTDIR";
 rsync -avz output/ ${OUTPUTDIR}
@@ -68,6 +71,10 @@ echo -e "DONE";
 '''
 
 script = script.replace("{features_def}", args.features_def)
+options = "--compression {}".format(args.compression)
+if args.compact:
+    options += " --compact"
+script = script.replace("{options}", options)
 condor = condor.replace("{features_def}", args.features_def)
 
 
@@ -75,7 +82,8 @@ arguments= []
 if not os.path.exists(args.outputdir):
     os.makedirs(args.outputdir)
 
-inputfiles = glob(args.inputdir + "/**.ndjson.tar.gz", recursive=True)
+# Windows files in all the formats (ndjson.tar.gz, ndjson[.gz|.zst], msgpack[.gz|.zst])
+inputfiles = glob(args.inputdir + "/**.ndjson*", recursive=True) + glob(args.inputdir + "/**.msgpack*", recursive=True)
 ninputfiles = len(inputfiles)
 
 print("N input files: ", ninputfiles)
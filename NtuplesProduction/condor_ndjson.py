@@ -4,6 +4,7 @@ import argparse
 import random
 from math import *
 from glob import glob
+from ndjson_io import output_extension, ENCODERS
 
 with open("command.txt", "w") as of:
     of.write(" ".join(["python"]+sys.argv))
@@ -26,7 +27,11 @@ parser.add_argument("--maxnocalow", type=int,  help="Number of no calo window pe
 parser.add_argument("--min-et-seed", type=float,  help="Min Et of the seeds", default=1)
 parser.add_argument("-ov","--overlap", action="store_true",  help="Overlapping window mode", default=False)
 parser.add_argument("--pu-limit", type=float,  help="SimEnergy PU limit", default=1e6)
-parser.add_argument('-c', "--compress", action="store_true",  help="Compress output")
+parser.add_argument('-c', "--compress", type=str, nargs="?", const="gzip", choices=["gzip","zstd"], help="Compress the output while writing it (default gzip)")
+parser.add_argument("--encoder", type=str, choices=ENCODERS, help="Encoder of the windows in the ndjson output", default="json")
+parser.add_argument("--float-digits", type=int, help="Round the floats of the ndjson output to N significant digits", default=None)
+parser.add_argument("--parquet", action="store_true",  help="Write directly the parquet dataset instead of ndjson")
+parser.add_argument("--flavour", type=int, help="PdgID flavor to add to the dataset (parquet output)", default=11)
 parser.add_argument("--redo", action="store_true", default=False, help="Redo all files")
 parser.add_argument("-d","--debug", action="store_true",  help="debug", default=False)
 parser.add_argument("-cf","--condor-folder", type=str,  help="Condor folder", default="condor_ndjson")
@@ -43,7 +48,7 @@ condor = '''executable              = run_ndjson_script.sh
 output                  = output/strips.$(ClusterId).$(ProcId).out
 error                   = error/strips.$(ClusterId).$(ProcId).err
 log                     = log/strips.$(ClusterId).log
-transfer_input_files    = ../cluster_ndjson_general.py, ../windows_creator_general.py, ../calo_association.py, ../simScore_WP/{wp_file}, ../Mustache.C
+transfer_input_files    = ../cluster_ndjson_general.py, ../windows_creator_general.py, ../simfraction_thresholds.py, ../calo_association.py, ../simScore_WP/{wp_file}, ../mustache.py, ../parquet_writer.py, ../ndjson_io.py, ../window_features.py, ../features_definition.json
 
 +JobFlavour             = "{queue}"
 queue arguments from arguments.txt
@@ -70,11 +75,10 @@ PULIM=$8;
 
 echo -e "Running ndjson dumper.."
 
-python cluster_ndjson_general.py -i ${INPUTFILE} -o output.ndjson \
+python cluster_ndjson_general.py -i ${INPUTFILE} -o output.{output_format} \
             -a ${ASSOC} --wp-file ${WPFILE} --min-et-seed ${ET_SEED} --maxnocalow $MAXNOCALO \
-          {overlap} --pu-limit ${PULIM} {debug};
+          {overlap} --pu-limit ${PULIM} {debug} {parquet};
 
-{compress}
 echo -e "Copying result to: $OUTPUTDIR";
 xrdcp -f --nopbar  output.{output_ext} root://eos{eosinstance}.cern.ch/${OUTPUTDIR}/clusters_data_${JOBID}.{output_ext};
 xrdcp -f --nopbar  output.meta.csv root://eos{eosinstance}.cern.ch/${OUTPUTDIR}/clusters_data_${JOBID}.meta.csv;
@@ -83,12 +87,20 @@ echo -e "DONE";
 '''
 
 script = script.replace("{eosinstance}", args.eos)
-if args.compress:
-    script = script.replace("{compress}", 'tar -zcf output.ndjson.tar.gz output.ndjson')
-    script = script.replace("{output_ext}", 'ndjson.tar.gz')
+if args.parquet:
+    # The parquet file is already compressed
+    script = script.replace("{output_format}", 'parquet')
+    script = script.replace("{parquet}", "--output-format parquet --flavour {}".format(args.flavour))
+    script = script.replace("{output_ext}", 'parquet')
 else:
-    script = script.replace("{compress}", '')
-    script = script.replace("{output_ext}", 'ndjson')
+    # The output is compressed and encoded directly by the ndjson writer
+    output_ext = output_extension(args.compress or "none", args.encoder)
+    ndjson_options = "--compression {} --encoder {}".format(args.compress or "none", args.encoder)
+    if args.float_digits is not None:
+        ndjson_options += " --float-digits {}".format(args.float_digits)
+    script = script.replace("{output_format}", output_ext)
+    script = script.replace("{output_ext}", output_ext)
+    script = script.replace("{parquet}", ndjson_options)
 if args.debug:
     script = script.replace("{debug}", "--debug")
 else: 
@@ -21,6 +21,7 @@ parser.add_argument("-w", "--weights", type=str, help="Weights file", required=F
 parser.add_argument("-o", "--outputdir", type=str, help="Outputdir", required=True)
 parser.add_argument("-f", "--flag", type=str, help="Flag",required=True )
 parser.add_argument("-q", "--queue", type=str, help="Condor queue", default="longlunch", required=True)
+parser.add_argument("--ext", type=str, help="Extension of the windows files (ndjson.tar.gz, ndjson.gz, ndjson.zst, msgpack.zst, ...)", default="ndjson.tar.gz")
 args = parser.parse_args()
 
 
@@ -29,7 +30,7 @@ condor = '''executable              = run_tfrecord_script.sh
 output                  = output/strips.$(ClusterId).$(ProcId).out
 error                   = error/strips.$(ClusterId).$(ProcId).err
 log                     = log/strips.$(ClusterId).log
-transfer_input_files    = ../convert_tfrecord_dataset_allinfo.py {WEIGHTS}
+transfer_input_files    = ../convert_tfrecord_dataset_allinfo.py, ../ndjson_io.py, ../tfrecord_writer.py {WEIGHTS}
 
 +JobFlavour             = "{queue}"
 queue arguments from arguments.txt
@@ -74,9 +75,9 @@ else:
     script = script.replace("{WEIGHTS}","")
     condor = condor.replace("{WEIGHTS}","")
 
-inputfiles = [ f for f in os.listdir(args.inputdir) if 'tar.gz' in f]
+inputfiles = [ f for f in os.listdir(args.inputdir) if f.endswith(args.ext)]
 ninputfiles = len(inputfiles)
-template_inputfile = "clusters_data_{}.ndjson.tar.gz"
+template_inputfile = "clusters_data_{}." + args.ext
 
 
 print("N input files: ", ninputfiles)
@@ -5,8 +5,11 @@ import sys
 import glob
 import gzip
 import argparse 
-import awkward as ak
+import time
+import multiprocessing as mp
 from glob import glob
+import ndjson_io
+from parquet_writer import WindowsParquetWriter, STATS_EXTENSION
 
 # source /cvmfs/sft.cern.ch/lcg/views/LCG_101/x86_64-centos7-gcc11-opt/setup.sh
 
@@ -18,46 +21,74 @@ parser.add_argument("-f","--features-def", type=str, help="Features definition f
 parser.add_argument("-g","--groupfiles", type=int, help="N. input file for each output file",default=1)
 parser.add_argument("-s","--standalone", action="store_true", help="Run without condor")
 parser.add_argument("--flavour", type=int, help="PdgID flavor to add to the dataset", default=11)
+parser.add_argument("-j","--workers", type=int, help="Number of processes converting groups of files in parallel", default=1)
+parser.add_argument("--cluster-by", type=str, nargs="*", help="Window fields clustering the windows in the row groups, e.g. seed_iz is_seed_calo_matched (default: windows order kept)", 
+                    default=[])
+parser.add_argument("--sort-by", type=str, help="Window field sorting the windows in each cluster, e.g. et_seed (default: no sorting)", default=None)
+parser.add_argument("--sort-row-groups", type=int, help="Number of row groups of each cluster sorted together", default=1)
+parser.add_argument("--compact", action="store_true", help="Compact schema: float32 features and int16/int8 detector indices")
+parser.add_argument("--compression", type=str, help="Parquet compression codec", default="snappy",
+                    choices=["snappy", "zstd", "gzip", "lz4", "brotli", "none"])
+parser.add_argument("--compression-level", type=int, help="Level of the parquet compression (codec default if not given)", default=None)
+parser.add_argument("--no-stats", action="store_true", help="Do not save the statistics sidecar of the output files")
+parser.add_argument("--batch-size", type=int, help="Number of windows parsed and written in each parquet row group", default=1000)
 args = parser.parse_args()
 
 features_dict = json.load(open(args.features_def))["features_dict"]
 
 def load_iter(files):
+    '''
+    Generator of the windows of the files, parsed one record at the time (the NaN are parsed as float NaN).
+    Any compression (old tar.gz, gzip, zstd, plain) and encoding of the windows files is accepted.
+    '''
     for filename in files:
-        with gzip.open(filename, "rt") as file:
-            lines = []
-            for line in file.readlines():
-                line = line[line.rfind('{"window_index"'):]
-                if "}" in line:
-                    line = line.replace("NaN", "-999")
-                    lines.append(line)
-            yield "[{}]".format(",".join(lines))
-                                   
+        for window in ndjson_io.iter_windows(filename):
+            yield window
 
-def convert_to_features_awkward(file, flavour):
-    df = ak.from_json(file)
-    out = {}
-    for k,v in features_dict.items():
-        if k != "hits_indices":
-            if "cl_" in k:
-                out[k] = df.clusters[v]
-            else:
-                out[k] = df[v]
-    # Getting a subset of the hits array
-    hits_index = ak.local_index(df.clusters.cl_hits)
-    mask_hits_index = (hits_index < 0) # all false
-    for i in features_dict["hits_indices"]:
-        mask_hits_index = mask_hits_index | (hits_index == i)
-    out["cl_h"] = df.clusters.cl_hits[mask_hits_index]
-    # add the flavour info to each line    
-    flavour = ak.ones_like(df.en_seed) * flavour
-    out["window_metadata"] = ak.with_field(out["window_metadata"], flavour, "flavour")
-    return ak.Array(out)
 
-def finalize_output(arrays, directory, name):
-    totA = ak.concatenate(arrays)
-    ak.to_parquet(totA, name)
-    #ak.to_parquet.dataset(directory) --> to be done externally at the end
+def convert_files(files, outputfile, flavour):
+    '''
+    Convert the windows of the files in a parquet file with the features definition layout.
+    The windows are written in row groups of `--batch-size` windows while they are parsed, 
+    so that the memory used does not depend on the size of the files. The NaN are saved as -999.
+    If requested the windows are clustered by the `--cluster-by` fields and sorted by `--sort-by` in the row groups,
+    so that filtered reads can skip row groups using their statistics.
+    The statistics of the windows are saved in the sidecar OUTPUTFILE.stats.json, merged by finalize_awkward_dataset.py.
+    Returns the list of (input file, n windows, time, size) of each file.
+    '''
+    writer = WindowsParquetWriter(outputfile, features_dict, flavour=flavour, row_group_size=args.batch_size,
+                                  cluster_by=args.cluster_by, sort_by=args.sort_by, sort_row_groups=args.sort_row_groups,
+                                  compact=args.compact, compression=args.compression, compression_level=args.compression_level,
+                                  stats_file=None if args.no_stats else outputfile + STATS_EXTENSION)
+    stats = []
+    for filename in files:
+        t0 = time.time()
+        nwindows = 0
+        for window in load_iter([filename]):
+            writer.write(window)
+            nwindows += 1
+        stats.append((filename, nwindows, time.time() - t0, os.path.getsize(filename)))
+    writer.close()
+    return stats
+
+
+def get_outputfile(iG, ngroups):
+    '''
+    Output part of the group of files: the parts are numbered by group
+    '''
+    if args.standalone:
+        return args.outputdir + "/"+args.name + ".{}.parquet".format(iG)
+    if ngroups == 1:
+        return args.outputdir + "/"+args.name
+    name = args.name[:-len(".parquet")] if args.name.endswith(".parquet") else args.name
+    return args.outputdir + "/" + name + ".{}.parquet".format(iG)
+
+
+def convert_group(iG_files):
+    iG, files, ngroups = iG_files
+    outputfile = get_outputfile(iG, ngroups)
+    return outputfile, convert_files(files, outputfile, args.flavour)
+
     
 if __name__ == "__main__":
     
@@ -66,7 +97,7 @@ if __name__ == "__main__":
     os.makedirs(outputdir, exist_ok=True)
 
     if args.standalone:
-        inputfiles = glob(args.input + "/**.ndjson.tar.gz", recursive=True)
+        inputfiles = glob(args.input + "/**.ndjson*", recursive=True) + glob(args.input + "/**.msgpack*", recursive=True)
     else:
         if "#_#" in args.input: 
             inputfiles = args.input.split("#_#")
@@ -76,28 +107,27 @@ if __name__ == "__main__":
         
     print("Start reading files")
         
-    ig = 0
-    iG = 1
-    arrays = []
-    for file in load_iter(inputfiles):
-        print("Processing file {}, in group {}".format(ig, iG))
-        arrays.append(convert_to_features_awkward(file, args.flavour))
-        ig +=1
-        if ig == args.groupfiles:
-            if args.standalone:
-                finalize_output(arrays, args.outputdir, args.outputdir + "/"+args.name + ".{}.parquet".format(iG) )
-            else:
-                finalize_output(arrays, args.outputdir, args.outputdir + "/"+args.name )
-            iG+=1
-            ig = 0
-            arrays.clear()
-        
+    # Groups of files converted in the same output file
+    groups = [ inputfiles[i:i+args.groupfiles] for i in range(0, ninputfiles, args.groupfiles) ]
+    jobs = [ (iG, files, len(groups)) for iG, files in enumerate(groups, start=1) ]
+    print("Converting {} files in {} groups with {} workers".format(ninputfiles, len(groups), args.workers))
 
-    if len(arrays):
-        if args.standalone:
-            finalize_output(arrays, args.outputdir, args.outputdir + "/"+args.name + ".{}.parquet".format(iG) )
-        else:
-            finalize_output(arrays, args.outputdir, args.outputdir + "/"+args.name )
-        arrays.clear()
-        
+    t0 = time.time()
+    tot_windows, tot_size = 0, 0
+    pool = mp.get_context("fork").Pool(args.workers) if args.workers > 1 else None
+    # The parts are reported as soon as they are done
+    results = pool.imap_unordered(convert_group, jobs) if pool else map(convert_group, jobs)
+    for outputfile, stats in results:
+        for filename, nwindows, elapsed, size in stats:
+            print("{}: {} windows in {:.1f} s ({:.0f} windows/s, {:.1f} MB/s)".format(
+                    filename, nwindows, elapsed, nwindows / max(elapsed, 1e-9), size / 1024**2 / max(elapsed, 1e-9)))
+            tot_windows += nwindows
+            tot_size += size
+        print("Written {} windows in {}".format(sum(st[1] for st in stats), outputfile))
+    if pool:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - t0
+    print("Total: {} windows in {:.1f} s ({:.0f} windows/s, {:.1f} MB/s)".format(
+            tot_windows, elapsed, tot_windows / max(elapsed, 1e-9), tot_size / 1024**2 / max(elapsed, 1e-9)))
     print("DONE!")
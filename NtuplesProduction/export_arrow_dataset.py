@@ -0,0 +1,86 @@
+import os
+import json
+import shutil
+import argparse
+from glob import glob
+import pyarrow as pa
+import pyarrow.parquet as pq
+from parquet_writer import STATS_EXTENSION
+
+# source /cvmfs/sft.cern.ch/lcg/views/LCG_101/x86_64-centos7-gcc11-opt/setup.sh
+
+'''
+One-time export of a parquet windows dataset to uncompressed Arrow IPC files (Feather v2, `.arrow`).
+
+The files have the same schema and order of the windows of the parquet files (one record batch for each row group):
+the training loader (awk_data.py, `LoaderConfig(file_format="arrow")`) memory maps them and converts the chunks
+one at the time (without copies for the chunks inside a record batch), so the parquet decoding is skipped.
+The files are several times larger than the parquet files: the format is meant for datasets fitting in a local SSD.
+
+The manifest (written also if not available in the input folder), the statistics sidecars and the normalization factors
+of the dataset are copied in the output folder.
+
+    python export_arrow_dataset.py -i DATASET_DIR -o ARROW_DIR
+'''
+
+MANIFEST_NAME = "manifest.json"
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-i","--inputdir", type=str, help="Parquet dataset directory",required=True)
+parser.add_argument("-o","--outputdir", type=str, help="Output directory of the Arrow IPC files",required=True)
+args = parser.parse_args()
+
+
+def export_file(inputfile, outputfile):
+    '''
+    Convert the parquet file in an uncompressed Arrow IPC file, one row group at the time.
+    Returns the number of windows.
+    '''
+    pfile = pq.ParquetFile(inputfile)
+    nwindows = 0
+    with pa.OSFile(outputfile, "wb") as sink:
+        with pa.ipc.new_file(sink, pfile.schema_arrow, options=pa.ipc.IpcWriteOptions(compression=None)) as writer:
+            for i in range(pfile.metadata.num_row_groups):
+                table = pfile.read_row_group(i)
+                writer.write_table(table)
+                nwindows += table.num_rows
+    return nwindows
+
+
+if __name__ == "__main__":
+
+    inputfiles = sorted(glob(args.inputdir + "/*.parquet"))
+    if not inputfiles:
+        raise Exception(f"No parquet files in {args.inputdir}")
+    os.makedirs(args.outputdir, exist_ok=True)
+
+    manifest_file = os.path.join(args.inputdir, MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {"files": [ {"file": os.path.basename(file)} for file in inputfiles ]}
+    files_info = { f["file"]: f for f in manifest["files"] }
+
+    files = []
+    for file in inputfiles:
+        name = os.path.basename(file)
+        arrow_name = name[:-len(".parquet")] + ".arrow"
+        outputfile = os.path.join(args.outputdir, arrow_name)
+        nwindows = export_file(file, outputfile)
+        if os.path.exists(file + STATS_EXTENSION):
+            shutil.copy(file + STATS_EXTENSION, outputfile + STATS_EXTENSION)
+        info = dict(files_info.get(name, {}))
+        info.update({"file": arrow_name, "nwindows": nwindows, "size": os.path.getsize(outputfile)})
+        files.append(info)
+        print("{}: {} windows, {:.1f} MB".format(outputfile, nwindows, info["size"] / 1024**2))
+
+    manifest["files"] = files
+    manifest["nwindows"] = sum(f["nwindows"] for f in files)
+    manifest["format"] = "arrow"
+    with open(os.path.join(args.outputdir, MANIFEST_NAME), "w") as o:
+        json.dump(manifest, o, indent=2)
+    for metadata in ["dataset_metadata.txt", "dataset_stats.json", "normalization_factors.json"]:
+        if os.path.exists(os.path.join(args.inputdir, metadata)):
+            shutil.copy(os.path.join(args.inputdir, metadata), os.path.join(args.outputdir, metadata))
+    print("Exported {} windows in {} files in {}".format(manifest["nwindows"], len(files), args.outputdir))
@@ -1,20 +1,61 @@
 import os
-import argparse 
+import json
+import argparse
+from glob import glob
 import awkward as ak
+from parquet_writer import FeaturesStats, STATS_EXTENSION
 
 # source /cvmfs/sft.cern.ch/lcg/views/LCG_101/x86_64-centos7-gcc11-opt/setup.sh
 
+'''
+Write the metadata of the parquet dataset.
+The statistics sidecars of the parts (written by convert_awkward_dataset.py) are merged in:
+- dataset_stats.json: number of windows of each part and of the dataset, histograms of the number of clusters and hits,
+                      count/mean/M2/min/max of all the fields
+- the normalization factors of the cluster and window features (same format of awk_normalize_features.py)
+without reading the dataset again.
+'''
+
 parser = argparse.ArgumentParser()
 parser.add_argument("-i","--inputdir", type=str, help="Dataset directory",required=True)
+parser.add_argument("--norm-factors", type=str, help="Output file of the normalization factors (default INPUTDIR/normalization_factors.json)")
 args = parser.parse_args()
 
 print(f"Finalizing awkward parquet dataset in folder: {args.inputdir}")
 
 ak.to_parquet.dataset(args.inputdir)
 
+# Merging the statistics of the parts
+files = sorted(glob(f"{args.inputdir}/*.parquet"))
+stats = FeaturesStats()
+nwindows_parts = {}
+missing = []
+for file in files:
+    if not os.path.exists(file + STATS_EXTENSION):
+        missing.append(file)
+        continue
+    part = FeaturesStats.load(file + STATS_EXTENSION)
+    stats.merge(part)
+    nwindows_parts[os.path.basename(file)] = part.nwindows
+
 # Getting the metadata
-df = ak.from_parquet(args.inputdir, lazy=True)
 with open(f"{args.inputdir}/dataset_metadata.txt","w") as o:
-    o.write(str(df.type))
+    if missing:
+        df = ak.from_parquet(args.inputdir, lazy=True)
+        o.write(str(df.type))
+    else:
+        # The type of the records is the same in all the parts
+        df = ak.from_parquet(files[0], lazy=True)
+        o.write(f"{stats.nwindows} * " + str(df.type).split(" * ", 1)[1])
+
+if missing:
+    print(f"Statistics not available for {len(missing)} files (e.g. {missing[0]}): dataset statistics and normalization factors not saved")
+else:
+    with open(f"{args.inputdir}/dataset_stats.json", "w") as o:
+        json.dump({"files": nwindows_parts, **stats.to_dict()}, o, indent=2)
+    norm_file = args.norm_factors or f"{args.inputdir}/normalization_factors.json"
+    with open(norm_file, "w") as o:
+        json.dump(stats.get_norm_factors(), o, indent=2)
+    print(f"Windows: {stats.nwindows} in {len(files)} files. Normalization factors saved in {norm_file}")
 
 print("Done!")
@@ -0,0 +1,137 @@
+from __future__ import print_function
+import numpy as np
+
+'''
+NumPy port of the `inMustache` and `inDynamicDPhiWindow` functions of Mustache.C.
+
+The functions accept arrays (or scalars) of seed and cluster (eta, phi, energy)
+broadcastable together and return the boolean masks for all the pairs at once,
+without crossing the python/C++ boundary for each (window, cluster) pair.
+
+The C++ functions take `const float` arguments and do most of the computation in
+single precision: the same float/double promotions are reproduced here in order
+to have exactly the same decisions of the ROOT version (see mustache_parity.py).
+'''
+
+f32 = np.float32
+
+# inMustache parameters
+log10EMin = f32(-3.)
+etaMin = f32(0.)
+sqrtLogClustETuning = f32(1.1)
+pUp = [f32(-0.107537), f32(0.590969), f32(-0.076494)]
+pLow = [f32(-0.0268843), f32(0.147742), f32(-0.0191235)]
+w0Up = [f32(-0.00681785), f32(-0.00239516)]
+w1Up = [f32(0.000699995), f32(-0.00554331)]
+w0Low = [f32(-0.00681785), f32(-0.00239516)]
+w1Low = [f32(0.000699995), f32(-0.00554331)]
+half_crystal_width = f32(0.0087)
+
+# inDynamicDPhiWindow parameters by |seed eta| bin:
+# EB, 1.479 -> 1.75, 1.75 -> 2.0, 2.0 and up
+dynamic_dphi_eta_bins = np.array([1.479, 1.75, 2.0])
+dynamic_dphi_params = {
+    "yoffset": np.array([0.0280506, 0.0497038, 0.05643, 0.0928887]),
+    "scale": np.array([0.946048, 0.975707, 1.60429, 1.22321]),
+    "xoffset": np.array([-0.101172, -0.18149, -0.642352, -0.260256]),
+    "width": np.array([0.432767, 0.431729, 0.458106, 0.345852]),
+    "saturation": np.array([0.14, 0.14, 0.12, 0.12]),
+    "cutoff": np.array([0.6, 0.55, 0.45, 0.3]),
+}
+
+
+def phi_mpi_pi(x):
+    '''
+    Vectorized Phi_mpi_pi: brings the angles (double precision) in [-pi, pi)
+    '''
+    x = np.array(x, dtype=np.float64)
+    while True:
+        above = x >= np.pi
+        below = x < -np.pi
+        if not (above.any() or below.any()):
+            return x
+        x = np.where(above, x - 2*np.pi, np.where(below, x + 2*np.pi, x))
+
+
+def in_mustache(seed_eta, seed_phi, cl_en, cl_eta, cl_phi):
+    '''
+    Vectorized inMustache(maxEta, maxPhi, ClustE, ClusEta, ClusPhi).
+    All the arguments are broadcasted together: e.g. seed arrays of shape (nwindows, 1)
+    and cluster arrays of shape (nclusters,) give the (nwindows, nclusters) mask.
+    '''
+    maxEta = np.asarray(seed_eta, dtype=f32)
+    maxPhi = np.asarray(seed_phi, dtype=f32)
+    ClustE = np.asarray(cl_en, dtype=f32)
+    ClusEta = np.asarray(cl_eta, dtype=f32)
+    ClusPhi = np.asarray(cl_phi, dtype=f32)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log10ClustE = np.log10(ClustE)
+        valid = ~((log10ClustE < log10EMin) | (np.abs(ClusEta) < etaMin))
+
+        sineta0 = np.sin(maxEta)
+        eta0xsineta0 = maxEta * sineta0
+
+        sqrt_log10_clustE = np.sqrt(log10ClustE + sqrtLogClustETuning)
+        # The 0.5 factor is a double in the C++: the difference is done in double precision
+        b_upper = (w1Up[0] * eta0xsineta0 + w1Up[1] / sqrt_log10_clustE).astype(np.float64) - \
+            0.5 * (w1Up[0] * eta0xsineta0 + w1Up[1] / sqrt_log10_clustE +
+                   w0Up[0] * eta0xsineta0 + w0Up[1] / sqrt_log10_clustE).astype(np.float64)
+        b_lower = (w0Low[0] * eta0xsineta0 + w0Low[1] / sqrt_log10_clustE).astype(np.float64) - \
+            0.5 * (w1Low[0] * eta0xsineta0 + w1Low[1] / sqrt_log10_clustE +
+                   w0Low[0] * eta0xsineta0 + w0Low[1] / sqrt_log10_clustE).astype(np.float64)
+        b_upper = b_upper.astype(f32)
+        b_lower = b_lower.astype(f32)
+
+        curv_up = eta0xsineta0 * (pUp[0] * eta0xsineta0 + pUp[1]) + pUp[2]
+        curv_low = eta0xsineta0 * (pLow[0] * eta0xsineta0 + pLow[1]) + pLow[2]
+
+        a_upper = ((1. / (4. * curv_up.astype(np.float64))) - np.abs(b_upper).astype(np.float64)).astype(f32)
+        a_lower = ((1. / (4. * curv_low.astype(np.float64))) - np.abs(b_lower).astype(np.float64)).astype(f32)
+
+        dphi = phi_mpi_pi((ClusPhi - maxPhi).astype(np.float64))
+        dphi2 = dphi * dphi
+
+        upper_cut = (np.maximum(1. / (4. * a_upper.astype(np.float64)), 0.0) * dphi2 +
+                     np.maximum(b_upper, half_crystal_width).astype(np.float64)) + np.float64(half_crystal_width)
+        lower_cut = (np.maximum(1. / (4. * a_lower.astype(np.float64)), 0.0) * dphi2 +
+                     np.minimum(b_lower, -half_crystal_width).astype(np.float64))
+        upper_cut = upper_cut.astype(f32)
+        lower_cut = lower_cut.astype(f32)
+
+        deta = np.where(maxEta < 0, f32(-1), f32(1)) * (ClusEta - maxEta)
+        return valid & (deta < upper_cut) & (deta > lower_cut)
+
+
+def in_dynamic_dphi_window(seed_eta, seed_phi, cl_en, cl_eta, cl_phi):
+    '''
+    Vectorized inDynamicDPhiWindow(seedEta, seedPhi, ClustE, ClusEta, ClusPhi).
+    The arguments are broadcasted together as in `in_mustache`.
+    '''
+    seedEta = np.asarray(seed_eta, dtype=f32)
+    seedPhi = np.asarray(seed_phi, dtype=f32)
+    ClustE = np.asarray(cl_en, dtype=f32)
+    ClusEta = np.asarray(cl_eta, dtype=f32)
+    ClusPhi = np.asarray(cl_phi, dtype=f32)
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        absSeedEta = np.abs(seedEta).astype(np.float64)
+        logClustEt = np.log10(ClustE / np.cosh(ClusEta)).astype(np.float64)
+        clusDphi = np.abs(phi_mpi_pi((seedPhi - ClusPhi).astype(np.float64)))
+
+        etaBin = np.searchsorted(dynamic_dphi_eta_bins, absSeedEta, side="right")
+        p = { k: v[etaBin] for k, v in dynamic_dphi_params.items() }
+
+        maxdphi = p["yoffset"] + p["scale"] / (1 + np.exp((logClustEt - p["xoffset"]) * p["width"]))
+        maxdphi = np.minimum(maxdphi, p["cutoff"])
+        maxdphi = np.maximum(maxdphi, p["saturation"])
+
+        return ~(ClustE < 0.) & (clusDphi < maxdphi)
+
+
+def in_geom_mustache(seed_eta, seed_phi, cl_eta, cl_phi, cl_en):
+    '''
+    Mask of the clusters geometrically inside the mustache and the dynamic dphi window of the seed
+    '''
+    return in_mustache(seed_eta, seed_phi, cl_en, cl_eta, cl_phi) & \
+        in_dynamic_dphi_window(seed_eta, seed_phi, cl_en, cl_eta, cl_phi)
@@ -0,0 +1,61 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+import ROOT as R
+R.gROOT.ProcessLine(".L Mustache.C+")
+import mustache
+
+'''
+Parity check between the numpy port of the mustache functions (mustache.py)
+and the C++ implementation in Mustache.C, on random (seed, cluster) pairs.
+Run it from the NtuplesProduction folder:
+
+    python mustache_parity.py -n 100000
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--npairs", type=int, help="Number of random (seed, cluster) pairs", default=100000)
+parser.add_argument("-s", "--seed", type=int, help="Random seed", default=0)
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+N = args.npairs
+seed_eta = rng.uniform(-3, 3, N)
+seed_phi = rng.uniform(-np.pi, np.pi, N)
+cl_eta = seed_eta + rng.normal(0, 0.15, N)
+cl_phi = seed_phi + rng.normal(0, 0.4, N)
+cl_phi = np.where(cl_phi > np.pi, cl_phi - 2*np.pi, cl_phi)
+cl_phi = np.where(cl_phi < -np.pi, cl_phi + 2*np.pi, cl_phi)
+cl_en = 10**rng.uniform(-3.5, 3, N)
+# Edge cases: null and negative energies, seeds on the dynamic dphi eta bins edges
+cl_en[:N//100] = 0.
+cl_en[N//100:N//50] = -1.
+seed_eta[N//50:3*N//100] = rng.choice([1.479, 1.75, 2.0, -1.479, -1.75, -2.0], N//100)
+
+# Same precision of the values read from the TTree
+seed_eta, seed_phi, cl_eta, cl_phi, cl_en = [ a.astype(np.float32).astype(np.float64)
+                                             for a in (seed_eta, seed_phi, cl_eta, cl_phi, cl_en) ]
+
+np_mustache = mustache.in_mustache(seed_eta, seed_phi, cl_en, cl_eta, cl_phi)
+np_dphi = mustache.in_dynamic_dphi_window(seed_eta, seed_phi, cl_en, cl_eta, cl_phi)
+
+root_mustache = np.zeros(N, dtype=bool)
+root_dphi = np.zeros(N, dtype=bool)
+for i, (se, sp, ce, cp, en) in enumerate(zip(seed_eta.tolist(), seed_phi.tolist(), cl_eta.tolist(),
+                                             cl_phi.tolist(), cl_en.tolist())):
+    root_mustache[i] = R.inMustache(se, sp, en, ce, cp)
+    root_dphi[i] = R.inDynamicDPhiWindow(se, sp, en, ce, cp)
+
+ok = True
+for name, a, b in [("inMustache", np_mustache, root_mustache), ("inDynamicDPhiWindow", np_dphi, root_dphi)]:
+    ndiff = int((a != b).sum())
+    print("{}: {} pairs, {} passing, {} differences".format(name, N, int(b.sum()), ndiff))
+    if ndiff:
+        ok = False
+        for i in np.nonzero(a != b)[0][:10]:
+            print("   seed_eta={} seed_phi={} cl_eta={} cl_phi={} cl_en={} root={} numpy={}".format(
+                seed_eta[i], seed_phi[i], cl_eta[i], cl_phi[i], cl_en[i], b[i], a[i]))
+
+if not ok:
+    raise SystemExit(1)
+print("Parity OK")
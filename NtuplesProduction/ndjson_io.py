@@ -0,0 +1,188 @@
+import io
+import gzip
+import json
+
+'''
+Writer and readers of the windows files (one window per record).
+
+The WindowsNdjsonWriter compresses the output on the fly (gzip or zstd, no separate `tar -zcf` pass)
+and encodes the windows with a pluggable encoder:
+- json: one json line per window, same output of json.dumps
+- orjson: one json line per window, faster encoding (NaN are written as null, read back as None:
+          the parquet conversion saves them as the NaN floats)
+- msgpack: binary stream of msgpack maps (one per window)
+The floats can be rounded to a number of significant digits to reduce the size of the files.
+
+The readers detect the compression from the magic number of the file and the encoding from
+the first byte of the content, so that the old `.ndjson.tar.gz` files, the plain ndjson files and
+all the new formats are read in the same way, whatever the file extension.
+'''
+
+COMPRESSIONS = ["none", "gzip", "zstd"]
+ENCODERS = ["json", "orjson", "msgpack"]
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# The first line of the old tar.gz files starts with the tar header:
+# the window starts at the first window_index key
+WINDOW_START = b'{"window_index"'
+
+
+def output_extension(compression="none", encoder="json"):
+    '''
+    Conventional extension of the output files, e.g. ndjson.gz, msgpack.zst
+    '''
+    ext = "msgpack" if encoder == "msgpack" else "ndjson"
+    if compression == "gzip":
+        ext += ".gz"
+    elif compression == "zstd":
+        ext += ".zst"
+    return ext
+
+
+def round_floats(obj, digits):
+    '''
+    Round all the floats in the nested dicts/lists to `digits` significant digits
+    '''
+    if isinstance(obj, float):
+        return float("{:.{}g}".format(obj, digits))
+    if isinstance(obj, dict):
+        return { k: round_floats(v, digits) for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return [ round_floats(v, digits) for v in obj ]
+    return obj
+
+
+def replace_nan(obj, value):
+    '''
+    Replace the NaN floats in the nested dicts/lists
+    '''
+    if isinstance(obj, float):
+        return value if obj != obj else obj
+    if isinstance(obj, dict):
+        return { k: replace_nan(v, value) for k, v in obj.items() }
+    if isinstance(obj, (list, tuple)):
+        return [ replace_nan(v, value) for v in obj ]
+    return obj
+
+
+def get_encoder(encoder):
+    '''
+    Function encoding a window dictionary in bytes
+    '''
+    if encoder == "json":
+        return lambda obj: json.dumps(obj).encode() + b"\n"
+    if encoder == "orjson":
+        import orjson
+        return lambda obj: orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+    if encoder == "msgpack":
+        import msgpack
+        packer = msgpack.Packer(use_bin_type=True)
+        return packer.pack
+    raise ValueError("Encoder {} not available: {}".format(encoder, ENCODERS))
+
+
+class WindowsNdjsonWriter():
+    '''
+    Write the windows dictionaries in a (compressed) file, one record per window.
+    '''
+    def __init__(self, outputfile, compression="none", encoder="json", float_digits=None, compression_level=None):
+        '''
+        compression: none, gzip or zstd
+        encoder: json, orjson or msgpack
+        float_digits: number of significant digits of the floats (None: no rounding)
+        compression_level: level of the gzip (default 6) or zstd (default 3) compression
+        '''
+        self.outputfile = outputfile
+        self.encode = get_encoder(encoder)
+        self.float_digits = float_digits
+        if compression == "gzip":
+            self.file = gzip.open(outputfile, "wb", compresslevel=compression_level or 6)
+        elif compression == "zstd":
+            import zstandard
+            self.file = zstandard.ZstdCompressor(level=compression_level or 3).stream_writer(open(outputfile, "wb"))
+        elif compression in ("none", None):
+            self.file = open(outputfile, "wb")
+        else:
+            raise ValueError("Compression {} not available: {}".format(compression, COMPRESSIONS))
+
+    def serialize(self, window):
+        '''
+        Encoded record of the window (float rounding and encoding, without writing it)
+        '''
+        if self.float_digits is not None:
+            window = round_floats(window, self.float_digits)
+        return self.encode(window)
+
+    def write_record(self, record):
+        '''
+        Write a record returned by `serialize` (compression and file I/O)
+        '''
+        self.file.write(record)
+
+    def write(self, window):
+        self.write_record(self.serialize(window))
+
+    def close(self):
+        self.file.close()
+
+
+def open_windows_file(filename):
+    '''
+    Open a windows file in binary mode, decompressing gzip or zstd files
+    '''
+    with open(filename, "rb") as f:
+        magic = f.read(4)
+    if magic[:2] == GZIP_MAGIC:
+        return gzip.open(filename, "rb")
+    if magic == ZSTD_MAGIC:
+        import zstandard
+        reader = zstandard.ZstdDecompressor().stream_reader(open(filename, "rb"), read_across_frames=True, closefd=True)
+        return io.BufferedReader(reader)
+    return open(filename, "rb")
+
+
+def is_msgpack(file):
+    # A window is a msgpack map (fixmap, map16 or map32), a json line starts with a printable character
+    first = file.peek(1)[:1]
+    return len(first) > 0 and (0x80 <= first[0] <= 0x8f or first[0] in (0xde, 0xdf))
+
+
+def get_encoding(filename):
+    '''
+    Encoding of the windows file: json or msgpack
+    '''
+    with open_windows_file(filename) as file:
+        return "msgpack" if is_msgpack(file) else "json"
+
+
+def iter_lines(filename):
+    '''
+    Generator of the json lines (bytes) of the windows of a json-encoded file
+    '''
+    with open_windows_file(filename) as file:
+        for line in file:
+            if not line.startswith(b"{"):
+                # Tar header of the old tar.gz files or tar padding
+                line = line[line.rfind(WINDOW_START):]
+                if not line.startswith(WINDOW_START): continue
+            if b"}" in line:
+                yield line
+
+
+def iter_windows(filename, nan_value=None):
+    '''
+    Generator of the windows dictionaries of a file in any of the supported formats.
+    If nan_value is given the NaN floats are replaced.
+    '''
+    with open_windows_file(filename) as file:
+        msgpack_file = is_msgpack(file)
+    if msgpack_file:
+        import msgpack
+        with open_windows_file(filename) as file:
+            for window in msgpack.Unpacker(file, raw=False):
+                yield window if nan_value is None else replace_nan(window, nan_value)
+    else:
+        for line in iter_lines(filename):
+            window = json.loads(line)
+            yield window if nan_value is None else replace_nan(window, nan_value)
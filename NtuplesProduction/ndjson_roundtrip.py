@@ -0,0 +1,125 @@
+from __future__ import print_function
+import os
+import json
+import argparse
+import tempfile
+import importlib
+import numpy as np
+import pyarrow.parquet as pq
+import ndjson_io
+from parquet_writer import WindowsParquetWriter
+from windows_creator_general import WindowCreator
+from simfraction_thresholds import SimfractionThresholds
+from synthetic_events import generate_event
+
+'''
+Round-trip check of the windows files encoders (ndjson_io.py): the windows of synthetic events (synthetic_events.py),
+with some NaN features, are written with each encoder and compression, read back with ndjson_io.iter_windows
+and converted in parquet with the WindowsParquetWriter.
+The windows read back must be equal to the original ones (the NaN written as null by orjson are accepted as None)
+and the parquet tables must be equal to the table of the original windows.
+The encoders whose package is not installed are skipped. Run it from the NtuplesProduction folder:
+
+    python ndjson_roundtrip.py -n 20 --pileup 60
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n","--nevents", type=int, help="Number of synthetic events", default=20)
+parser.add_argument("--pileup", type=float, help="Pileup level of the events", default=60)
+parser.add_argument("-f","--features-def", type=str, help="Features definition file", default="features_definition.json")
+parser.add_argument("--compression", type=str, nargs="+", choices=ndjson_io.COMPRESSIONS, help="Compressions to check", default=["none","gzip"])
+parser.add_argument("-s", "--seed", type=int, help="Random seed", default=0)
+args = parser.parse_args()
+
+ENCODERS_PACKAGES = {"json": "json", "orjson": "orjson", "msgpack": "msgpack"}
+NAN_FEATURES = ["seed_PUfrac", "wtot_simen_PU", "max_deta_cluster_insc"]
+NAN_CL_FEATURES = ["cluster_PUfrac", "calo_score", "cl_etaWidth"]
+
+
+def get_windows():
+    rng = np.random.default_rng(args.seed)
+    windows_creator = WindowCreator(SimfractionThresholds([0., 1e6], [0., 5.], [[0.05]]), 1e-2,
+                                    cl_min_fraction=1e-4, nocalowNmax=5, random_seed=args.seed)
+    windows = []
+    for _ in range(args.nevents):
+        windows += windows_creator.get_windows(generate_event(rng, pileup=args.pileup), dump_json=False)[0]
+    # NaN features (e.g. PU fraction of the clusters without simenergy) in half of the windows
+    for window in windows[::2]:
+        for f in NAN_FEATURES:
+            window[f] = float("nan")
+        for cl in window["clusters"][::2]:
+            for f in NAN_CL_FEATURES:
+                cl[f] = float("nan")
+    return windows
+
+
+def is_nan(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def diff(original, read, path=""):
+    '''
+    First difference between the original and the read window (None if equal)
+    '''
+    if isinstance(original, float) and original != original:
+        return None if is_nan(read) else path
+    if isinstance(original, dict):
+        if not isinstance(read, dict) or set(original) != set(read):
+            return path
+        return next(( d for k in original for d in [diff(original[k], read[k], path + "/" + k)] if d ), None)
+    if isinstance(original, (list, tuple)):
+        if not isinstance(read, (list, tuple)) or len(original) != len(read):
+            return path
+        return next(( d for i, v in enumerate(original) for d in [diff(v, read[i], path + "/" + str(i))] if d ), None)
+    return None if original == read else path
+
+
+def to_parquet(windows, outputfile, features_dict):
+    writer = WindowsParquetWriter(outputfile, features_dict)
+    for window in windows:
+        writer.write(window)
+    writer.close()
+    return pq.read_table(outputfile)
+
+
+features_dict = json.load(open(args.features_def))["features_dict"]
+windows = get_windows()
+print("{} windows of {} events".format(len(windows), args.nevents))
+
+ok = True
+with tempfile.TemporaryDirectory() as tmpdir:
+    reference = to_parquet(windows, os.path.join(tmpdir, "reference.parquet"), features_dict)
+    for encoder in ndjson_io.ENCODERS:
+        try:
+            importlib.import_module(ENCODERS_PACKAGES[encoder])
+        except ImportError:
+            print("{:<8}: SKIPPED ({} not installed)".format(encoder, ENCODERS_PACKAGES[encoder]))
+            continue
+        for compression in args.compression:
+            filename = os.path.join(tmpdir, "windows." + ndjson_io.output_extension(compression, encoder))
+            writer = ndjson_io.WindowsNdjsonWriter(filename, compression=compression, encoder=encoder)
+            for window in windows:
+                writer.write(window)
+            writer.close()
+            read = list(ndjson_io.iter_windows(filename))
+            errors = []
+            if len(read) != len(windows):
+                errors.append("{} windows read instead of {}".format(len(read), len(windows)))
+            else:
+                errors += [ "window {}: {}".format(i, d) for i, (w, r) in enumerate(zip(windows, read))
+                            for d in [diff(w, r)] if d is not None ][:10]
+                try:
+                    table = to_parquet(read, os.path.join(tmpdir, "windows.parquet"), features_dict)
+                    if not table.equals(reference):
+                        errors.append("parquet table different from the reference")
+                except Exception as e:
+                    errors.append("parquet conversion failed: {}".format(e))
+            print("{:<8} {:<5}: {} windows, {:.1f} kB, {}".format(encoder, compression, len(read),
+                    os.path.getsize(filename) / 1024, "OK" if not errors else "FAILED"))
+            for e in errors:
+                print("   " + e)
+            ok = ok and not errors
+
+if not ok:
+    raise SystemExit(1)
+print("Round-trip OK")
@@ -0,0 +1,378 @@
+import json
+import collections
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+'''
+Direct Parquet output of the windows, with the same layout of the files produced by
+convert_awkward_dataset.py from the ndjson files: one column for each group of the
+features definition (cl_features, cl_labels, window_features, window_metadata, ...)
+plus the selected hits of the clusters (cl_h) and the flavour in the window_metadata.
+
+The windows are buffered and written as a new row group every `row_group_size` windows,
+so that the memory used by the writer stays bounded.
+
+With `compact=True` the floats are saved as float32 and the detector indices and counters as int16 (int8 for iz):
+the files are about half the size and the loader (awk_data.py) reads them in the same way.
+The labels are always booleans, bit-packed in the parquet pages.
+
+The statistics of the windows written in each file (number of windows, histograms of the number of clusters
+and of hits, mean/variance/min/max of all the fields) can be saved in a json sidecar of the file (`stats_file`): 
+the statistics of the parts of a dataset are merged by finalize_awkward_dataset.py without reading the data again. 
+
+The EventsParquetWriter writes instead one row per event (normalized schema): the clusters
+are saved only once in the event table (`clusters`, `cl_h`) and each window contains the
+indices of its clusters (`cl_index`) and only the window-relative cluster features (`cl_window`)
+and labels (`cl_labels`). The windows are expanded back by `expand_windows` in awk_data.py.
+'''
+
+# Value used for NaN in the dataset (as done when parsing the ndjson files)
+NAN_VALUE = -999.
+
+# Fields saved as integers, all the other (non-label) fields are saved as float64.
+# The types are fixed in advance so that all the row groups have the same schema
+INT_FIELDS = set(["cluster_ieta", "cluster_iphi", "cluster_iz",
+                  "seed_ieta", "seed_iphi", "seed_iz",
+                  "ncls", "nclusters_insc", "nVtx",
+                  "cl_nxtals", "seed_nxtals", "calo_nxtals_PU"])
+# Integer types of the compact schema (int16 for the other INT_FIELDS)
+COMPACT_INT_TYPES = {"cluster_iz": pa.int8(), "seed_iz": pa.int8()}
+
+
+# Cluster features depending on the window (saved for each window in the event-level schema)
+CL_WINDOW_FIELDS = ["cluster_deta", "cluster_dphi", "cluster_den_seed", "cluster_det_seed",
+                    "calo_simen_sig", "cluster_PUfrac"]
+
+
+def field_type(group, name, compact=False):
+    if group.endswith("_labels"):
+        return pa.bool_()
+    if name in INT_FIELDS:
+        return COMPACT_INT_TYPES.get(name, pa.int16()) if compact else pa.int64()
+    return float_type(compact)
+
+
+def float_type(compact=False):
+    return pa.float32() if compact else pa.float64()
+
+
+def list_type(value_type):
+    return pa.list_(pa.field("item", value_type, nullable=False))
+
+
+def get_schema(features_dict, compact=False):
+    '''
+    Arrow schema of the output file given the features definition dictionary.
+    compact: float32 and int16/int8 fields instead of float64 and int64 
+    '''
+    fields = []
+    for group, names in features_dict.items():
+        if group == "hits_indices": continue
+        if group == "window_metadata":
+            names = names + ["flavour"]
+        struct = pa.struct([ pa.field(n, field_type(group, n, compact), nullable=False) for n in names ])
+        if "cl_" in group:
+            fields.append(pa.field(group, list_type(struct), nullable=False))
+        else:
+            fields.append(pa.field(group, struct, nullable=False))
+    # The hits contain (ieta, iphi, iz, energy): the indices are exact also in float32
+    fields.append(pa.field("cl_h", list_type(list_type(list_type(float_type(compact)))), nullable=False))
+    return pa.schema(fields)
+
+
+# Groups of the features of the normalization factors
+NORM_FACTORS_GROUPS = {"cluster": "cl_features", "window": "window_features"}
+# Extension of the statistics sidecar of the parquet files
+STATS_EXTENSION = ".stats.json"
+
+
+def merge_moments(a, b):
+    '''
+    Merge the [count, mean, M2, min, max] of two sets of values (Chan et al. parallel algorithm)
+    '''
+    na, nb = a[0], b[0]
+    if na == 0: return list(b)
+    if nb == 0: return list(a)
+    n = na + nb
+    delta = b[1] - a[1]
+    return [n, a[1] + delta * nb / n, a[2] + b[2] + delta**2 * na * nb / n, min(a[3], b[3]), max(a[4], b[4])]
+
+
+class FeaturesStats():
+    '''
+    Mergeable statistics of the windows: number of windows, histograms of the number of clusters of the windows
+    and of the number of hits of the clusters, [count, mean, M2, min, max] of each field of each group.
+    '''
+    def __init__(self):
+        self.nwindows = 0
+        self.ncls_hist = collections.Counter()
+        self.nhits_hist = collections.Counter()
+        # group -> field -> [count, mean, M2, min, max]
+        self.features = {}
+
+    def fill(self, table):
+        '''
+        Add the windows of a table with the WindowsParquetWriter schema
+        '''
+        self.nwindows += table.num_rows
+        for name in table.column_names:
+            column = table.column(name).combine_chunks()
+            if name == "cl_h":
+                self.fill_hist(self.ncls_hist, column.value_lengths())
+                self.fill_hist(self.nhits_hist, column.flatten().value_lengths())
+                continue
+            if pa.types.is_list(column.type):
+                column = column.flatten()
+            group = self.features.setdefault(name, {})
+            for field, values in zip(column.type, column.flatten()):
+                values = values.to_numpy(zero_copy_only=False).astype(np.float64)
+                if len(values) == 0: continue
+                moments = [len(values), values.mean(), ((values - values.mean())**2).sum(), values.min(), values.max()]
+                group[field.name] = merge_moments(group.get(field.name, [0, 0., 0., np.inf, -np.inf]), moments)
+
+    @staticmethod
+    def fill_hist(hist, values):
+        bins, counts = np.unique(values.to_numpy(zero_copy_only=False), return_counts=True)
+        hist.update(dict(zip(bins.tolist(), counts.tolist())))
+
+    def merge(self, other):
+        self.nwindows += other.nwindows
+        self.ncls_hist.update(other.ncls_hist)
+        self.nhits_hist.update(other.nhits_hist)
+        for group, fields in other.features.items():
+            merged = self.features.setdefault(group, {})
+            for field, moments in fields.items():
+                merged[field] = merge_moments(merged.get(field, [0, 0., 0., np.inf, -np.inf]), moments)
+
+    def to_dict(self):
+        return {
+            "nwindows": self.nwindows,
+            "ncls_hist": { str(k): v for k, v in sorted(self.ncls_hist.items()) },
+            "nhits_hist": { str(k): v for k, v in sorted(self.nhits_hist.items()) },
+            "features": { group: { field: dict(zip(["count", "mean", "m2", "min", "max"], map(float, moments)))
+                                   for field, moments in fields.items() }
+                          for group, fields in self.features.items() }
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.nwindows = data["nwindows"]
+        stats.ncls_hist.update({ int(k): v for k, v in data["ncls_hist"].items() })
+        stats.nhits_hist.update({ int(k): v for k, v in data["nhits_hist"].items() })
+        stats.features = { group: { field: [m["count"], m["mean"], m["m2"], m["min"], m["max"]] for field, m in fields.items() }
+                           for group, fields in data["features"].items() }
+        return stats
+
+    def save(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename) as f:
+            return cls.from_dict(json.load(f))
+
+    def get_norm_factors(self, groups=NORM_FACTORS_GROUPS):
+        '''
+        Normalization factors (mean, std, min, max) of the features, 
+        in the format of Training/global_model/normalization_factors/awk_normalize_features.py
+        '''
+        norm_factors = {}
+        for name, group in groups.items():
+            fields = self.features[group]
+            norm_factors[name] = {
+                "mean": { f: m[1] for f, m in fields.items() },
+                "max": { f: m[4] for f, m in fields.items() },
+                "min": { f: m[3] for f, m in fields.items() },
+                "std": { f: float(np.sqrt(m[2] / m[0])) for f, m in fields.items() },
+            }
+        return norm_factors
+
+
+class WindowsParquetWriter():
+
+    def __init__(self, outputfile, features_dict, flavour=11, row_group_size=5000, compression="snappy",
+                 cluster_by=None, sort_by=None, sort_row_groups=1, compact=False, compression_level=None, stats_file=None):
+        '''
+        stats_file: json file where the FeaturesStats of the windows are saved when the writer is closed
+        compact: compact schema (float32, int16/int8) instead of float64 and int64 
+        compression: parquet compression codec (snappy, zstd, gzip, lz4, brotli, none)
+        cluster_by: window fields (e.g. seed_iz, is_seed_calo_matched) used to cluster the windows:
+                    each row group contains only windows with the same values of these fields, so that 
+                    the row groups can be skipped at read time using their min/max statistics.
+        sort_by: window field (e.g. et_seed) used to sort the windows of each cluster before writing them
+        sort_row_groups: number of row groups of each cluster buffered and sorted together
+                         (larger buffers give narrower ranges of the sort field in each row group)
+        '''
+        self.features_dict = features_dict
+        self.flavour = flavour
+        self.row_group_size = row_group_size
+        self.hits_indices = features_dict["hits_indices"]
+        self.schema = get_schema(features_dict, compact)
+        # (group, [(field, is float)]) of each column
+        self.groups = []
+        for group, names in features_dict.items():
+            if group == "hits_indices": continue
+            self.groups.append((group, [ (n, pa.types.is_floating(field_type(group, n, compact))) for n in names ]))
+        self.writer = pq.ParquetWriter(outputfile, self.schema, compression=compression, 
+                                       compression_level=compression_level, write_statistics=True)
+        self.cluster_by = cluster_by or []
+        self.sort_by = sort_by
+        self.buffer_size = row_group_size * (sort_row_groups if sort_by else 1)
+        # buffer of windows for each cluster
+        self.buffers = {}
+        self.nwindows = 0
+        self.stats_file = stats_file
+        self.stats = FeaturesStats() if stats_file else None
+
+    @staticmethod
+    def get_values(obj, fields):
+        # NaN != NaN. The NaN written as null by orjson are read back as None
+        return { n: (NAN_VALUE if is_float and (obj[n] is None or obj[n] != obj[n]) else obj[n]) for n, is_float in fields }
+
+    def write(self, window):
+        key = tuple(window[f] for f in self.cluster_by)
+        buffer = self.buffers.setdefault(key, [])
+        buffer.append(window)
+        if len(buffer) >= self.buffer_size:
+            self.flush_cluster(key)
+
+    def flush_cluster(self, key):
+        buffer = self.buffers.pop(key)
+        if self.sort_by:
+            buffer.sort(key=lambda w: w[self.sort_by])
+        for i in range(0, len(buffer), self.row_group_size):
+            self.write_row_group(buffer[i:i+self.row_group_size])
+
+    def flush(self):
+        for key in list(self.buffers):
+            self.flush_cluster(key)
+
+    def write_row_group(self, windows):
+        columns = []
+        for group, fields in self.groups:
+            if "cl_" in group:
+                values = [ [ self.get_values(cl, fields) for cl in w["clusters"] ] for w in windows ]
+            else:
+                values = [ self.get_values(w, fields) for w in windows ]
+                if group == "window_metadata":
+                    for v in values:
+                        v["flavour"] = float(self.flavour)
+            columns.append(pa.array(values, type=self.schema.field(group).type))
+        cl_h = [ [ [ [ hit[i] for i in self.hits_indices ] for hit in cl["cl_hits"] ]
+                   for cl in w["clusters"] ] for w in windows ]
+        columns.append(pa.array(cl_h, type=self.schema.field("cl_h").type))
+        table = pa.Table.from_arrays(columns, schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(windows))
+        self.nwindows += len(windows)
+        if self.stats:
+            self.stats.fill(table)
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        if self.stats:
+            self.stats.save(self.stats_file)
+
+
+def get_events_schema(features_dict):
+    '''
+    Arrow schema of the event-level output file given the features definition dictionary
+    '''
+    cl_fields = []
+    cl_window_fields = []
+    window_fields = [ pa.field("cl_index", list_type(pa.int32()), nullable=False) ]
+    for group, names in features_dict.items():
+        if group == "hits_indices": continue
+        if group == "window_metadata":
+            names = names + ["flavour"]
+        fields = [ pa.field(n, field_type(group, n), nullable=False) for n in names ]
+        if group == "cl_labels":
+            window_fields.append(pa.field(group, list_type(pa.struct(fields)), nullable=False))
+        elif "cl_" in group:
+            cl_fields += [ f for f in fields if f.name not in CL_WINDOW_FIELDS ]
+            cl_window_fields += [ f for f in fields if f.name in CL_WINDOW_FIELDS ]
+        else:
+            window_fields.append(pa.field(group, pa.struct(fields), nullable=False))
+    window_fields.insert(1, pa.field("cl_window", list_type(pa.struct(cl_window_fields)), nullable=False))
+    return pa.schema([
+        pa.field("clusters", list_type(pa.struct(cl_fields)), nullable=False),
+        pa.field("cl_h", list_type(list_type(list_type(pa.float64()))), nullable=False),
+        pa.field("windows", list_type(pa.struct(window_fields)), nullable=False),
+    ])
+
+
+class EventsParquetWriter():
+
+    def __init__(self, outputfile, features_dict, flavour=11, row_group_size=500, compression="snappy"):
+        '''
+        row_group_size: number of events in each row group
+        '''
+        self.flavour = flavour
+        self.row_group_size = row_group_size
+        self.hits_indices = features_dict["hits_indices"]
+        self.schema = get_events_schema(features_dict)
+        windows_type = self.schema.field("windows").type.value_type
+        self.cl_fields = self.get_fields(self.schema.field("clusters").type.value_type)
+        self.cl_window_fields = self.get_fields(windows_type["cl_window"].type.value_type)
+        self.cl_labels_fields = self.get_fields(windows_type["cl_labels"].type.value_type)
+        self.window_groups = [ (windows_type[i].name, self.get_fields(windows_type[i].type))
+                               for i in range(windows_type.num_fields)
+                               if windows_type[i].name not in ["cl_index", "cl_window", "cl_labels"] ]
+        self.writer = pq.ParquetWriter(outputfile, self.schema, compression=compression)
+        self.buffer = []
+        self.nevents = 0
+
+    @staticmethod
+    def get_fields(struct_type):
+        return [ (struct_type[i].name, struct_type[i].type == pa.float64()) for i in range(struct_type.num_fields) ]
+
+    def write(self, windows):
+        '''
+        Add the event given the list of its windows (events without windows are not saved)
+        '''
+        if len(windows) == 0:
+            return
+        clusters = []
+        cl_h = []
+        cl_local_index = {}
+        out_windows = []
+        for w in windows:
+            cl_index = []
+            for cl in w["clusters"]:
+                icl = cl["cl_index"]
+                if icl not in cl_local_index:
+                    # The window-independent cluster features are saved once for the event
+                    cl_local_index[icl] = len(clusters)
+                    clusters.append(WindowsParquetWriter.get_values(cl, self.cl_fields))
+                    cl_h.append([ [ hit[i] for i in self.hits_indices ] for hit in cl["cl_hits"] ])
+                cl_index.append(cl_local_index[icl])
+            out_w = {
+                "cl_index": cl_index,
+                "cl_window": [ WindowsParquetWriter.get_values(cl, self.cl_window_fields) for cl in w["clusters"] ],
+                "cl_labels": [ WindowsParquetWriter.get_values(cl, self.cl_labels_fields) for cl in w["clusters"] ],
+            }
+            for group, fields in self.window_groups:
+                if group == "window_metadata":
+                    out_w[group] = WindowsParquetWriter.get_values(dict(w, flavour=float(self.flavour)), fields)
+                else:
+                    out_w[group] = WindowsParquetWriter.get_values(w, fields)
+            out_windows.append(out_w)
+        self.buffer.append({"clusters": clusters, "cl_h": cl_h, "windows": out_windows})
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) == 0:
+            return
+        table = pa.Table.from_arrays([ pa.array([ ev[f.name] for ev in self.buffer ], type=f.type) for f in self.schema ],
+                                     schema=self.schema)
+        self.writer.write_table(table, row_group_size=len(self.buffer))
+        self.nevents += len(self.buffer)
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
@@ -0,0 +1,70 @@
+from __future__ import print_function
+import numpy as np
+
+'''
+Simfraction thresholds WP table (h2_Minimum_simScore_seedBins).
+
+The TH2 is loaded once in numpy arrays of bin edges and contents: the lookups of the thresholds
+are done with `searchsorted` on arrays of (seed Et, |seed eta|), without calling the ROOT
+histogram for each cluster.
+'''
+
+WP_HISTO = "h2_Minimum_simScore_seedBins"
+
+
+class SimfractionThresholds():
+
+    def __init__(self, et_edges, eta_edges, thresholds):
+        '''
+        et_edges, eta_edges: bin edges of the seed Et (X axis) and |seed eta| (Y axis)
+        thresholds: (n et bins, n eta bins) array of the minimum simfraction
+        '''
+        self.et_edges = np.asarray(et_edges, dtype=np.float64)
+        self.eta_edges = np.asarray(eta_edges, dtype=np.float64)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        if self.thresholds.shape != (len(self.et_edges) - 1, len(self.eta_edges) - 1):
+            raise ValueError("Thresholds table shape {} not matching the bin edges ({}, {})".format(
+                self.thresholds.shape, len(self.et_edges) - 1, len(self.eta_edges) - 1))
+
+    @classmethod
+    def from_TH2(cls, h2):
+        '''
+        Load the table from a ROOT TH2
+        '''
+        xaxis, yaxis = h2.GetXaxis(), h2.GetYaxis()
+        nx, ny = h2.GetNbinsX(), h2.GetNbinsY()
+        et_edges = [ xaxis.GetBinLowEdge(i) for i in range(1, nx + 2) ]
+        eta_edges = [ yaxis.GetBinLowEdge(j) for j in range(1, ny + 2) ]
+        thresholds = [ [ h2.GetBinContent(i, j) for j in range(1, ny + 1) ] for i in range(1, nx + 1) ]
+        return cls(et_edges, eta_edges, thresholds)
+
+    @classmethod
+    def from_file(cls, filename, histo=WP_HISTO):
+        '''
+        Load the table from the WP file with uproot (no ROOT needed)
+        '''
+        import uproot
+        with uproot.open(filename) as f:
+            h2 = f[histo]
+            return cls(h2.axis(0).edges(), h2.axis(1).edges(), h2.values(flow=False))
+
+    @staticmethod
+    def find_bin(edges, values):
+        # Same bin of TAxis::FindBin, but the underflow/overflow are moved to the first/last bin
+        return np.clip(np.searchsorted(edges, values, side="right") - 1, 0, len(edges) - 2)
+
+    def get_threshold(self, seed_eta, seed_et):
+        '''
+        Simfraction thresholds for arrays (or scalars) of seed eta and seed Et
+        '''
+        iX = self.find_bin(self.et_edges, np.asarray(seed_et, dtype=np.float64))
+        iY = self.find_bin(self.eta_edges, np.abs(np.asarray(seed_eta, dtype=np.float64)))
+        return self.thresholds[iX, iY]
+
+    def pass_threshold(self, seed_eta, seed_et, cluster_calo_score):
+        '''
+        Boolean mask of the clusters passing the simfraction threshold of the seed.
+        The seed and cluster arrays are broadcasted together: e.g. a scalar seed eta/Et
+        and the calo scores of all the clusters of a window.
+        '''
+        return np.asarray(cluster_calo_score, dtype=np.float64) >= self.get_threshold(seed_eta, seed_et)
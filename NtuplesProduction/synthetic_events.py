@@ -0,0 +1,245 @@
+from __future__ import print_function
+from math import pi
+import numpy as np
+from windows_creator_general import get_branches
+
+'''
+Synthetic RecoSimDumper events, to test and benchmark the windows creation without the dumper ROOT files.
+
+Each event contains a few signal caloparticles (electrons/photons) creating a seed cluster and some bremsstrahlung
+clusters spread in phi, on top of a number of low energy PU clusters proportional to the pileup level.
+The hits of the clusters, the simenergy fractions, the PU simenergy and the refined superclusters are generated
+consistently with the clusters.
+
+The events are returned as `SyntheticEvent` objects with the branches as attributes (python floats rounded
+at float32, ints and lists as read by PyROOT from the caloTree), so that they can be passed directly
+to `WindowCreator.get_windows`. They can also be saved in a local parquet file with `save_events`.
+
+    rng = np.random.default_rng(0)
+    event = generate_event(rng, pileup=60)
+    windows, metadata = windows_creator.get_windows(event)
+'''
+
+# Average number of PU clusters in ECAL for each pileup interaction
+PU_CLUSTERS_PER_INTERACTION = 4.
+# Half width of the barrel in eta
+EB_ETA_MAX = 1.479
+# Z of the endcap front face [cm] and size of the endcap crystals [cm]
+EE_Z = 315.4
+EE_XTAL_SIZE = 2.862
+
+
+class SyntheticEvent():
+    '''
+    Dumper event with the branches as attributes, duck-typing the PyROOT TTree event
+    '''
+    def __init__(self, branches):
+        self.__dict__.update(branches)
+
+
+def get_iz(eta):
+    return np.where(np.abs(eta) < EB_ETA_MAX, 0, np.sign(eta)).astype(np.int64)
+
+
+def get_crystal_coordinates(eta, phi):
+    '''
+    Approximated (ieta, iphi, iz) of the crystals: (ix, iy) in the endcaps
+    '''
+    iz = get_iz(eta)
+    ieta = (np.sign(eta) * (np.floor(np.abs(eta) / 0.0174) + 1)).astype(np.int64)
+    iphi = (np.floor((phi + pi) / (2 * pi / 360)) % 360 + 1).astype(np.int64)
+    # Endcaps: position on the front face
+    r = EE_Z / np.sinh(np.maximum(np.abs(eta), EB_ETA_MAX))
+    ix = np.clip(np.floor(r * np.cos(phi) / EE_XTAL_SIZE + 50.5), 1, 100).astype(np.int64)
+    iy = np.clip(np.floor(r * np.sin(phi) / EE_XTAL_SIZE + 50.5), 1, 100).astype(np.int64)
+    return np.where(iz == 0, ieta, ix), np.where(iz == 0, iphi, iy), iz
+
+
+def wrap_phi(phi):
+    return (phi + pi) % (2 * pi) - pi
+
+
+def float_list(a):
+    # Float branches are read as python floats of the float32 value
+    return np.asarray(a, dtype=np.float32).tolist()
+
+
+def generate_event(rng, pileup=60, n_signal=2, et_range=(1., 100.), eta_max=2.9,
+                   pu_clusters_per_interaction=PU_CLUSTERS_PER_INTERACTION):
+    '''
+    Generate a synthetic dumper event.
+
+    rng: numpy random Generator
+    pileup: number of pileup interactions: the number of PU clusters is Poisson(pileup * pu_clusters_per_interaction)
+    n_signal: number of signal caloparticles
+    et_range: range of the uniform Et distribution of the signal caloparticles
+    eta_max: |eta| acceptance of the caloparticles and of the PU clusters
+    '''
+    ###################
+    # Signal caloparticles
+    calo_eta = rng.uniform(-eta_max + 0.1, eta_max - 0.1, n_signal)
+    calo_phi = rng.uniform(-pi, pi, n_signal)
+    calo_et = rng.uniform(et_range[0], et_range[1], n_signal)
+    calo_simE = calo_et * np.cosh(calo_eta)
+    charge = rng.choice([-1, 1], n_signal)
+
+    ###################
+    # Signal clusters: seed + brem clusters along phi
+    cl_calo, cl_simE, cl_eta, cl_phi = [], [], [], []
+    for icalo in range(n_signal):
+        nbrem = rng.poisson(1.5)
+        # Fraction of the caloparticle energy in each cluster, the seed takes the largest part
+        shares = rng.dirichlet([6.] + [1.] * nbrem) * rng.uniform(0.85, 0.98)
+        dphi = np.concatenate([[0.], charge[icalo] * rng.uniform(0.02, 0.4, nbrem) * min(1., 10. / calo_et[icalo])])
+        deta = np.concatenate([[0.], rng.normal(0., 0.015, nbrem)])
+        cl_calo.append(np.full(nbrem + 1, icalo))
+        cl_simE.append(shares * calo_simE[icalo])
+        cl_eta.append(calo_eta[icalo] + deta + rng.normal(0., 0.003, nbrem + 1))
+        cl_phi.append(calo_phi[icalo] + dphi + rng.normal(0., 0.003, nbrem + 1))
+    cl_calo = np.concatenate(cl_calo) if n_signal else np.zeros(0, dtype=np.int64)
+    cl_simE = np.concatenate(cl_simE) if n_signal else np.zeros(0)
+    cl_eta = np.concatenate(cl_eta) if n_signal else np.zeros(0)
+    cl_phi = np.concatenate(cl_phi) if n_signal else np.zeros(0)
+    nsig = len(cl_calo)
+
+    ###################
+    # PU clusters: low Et, uniform in the detector
+    npu = rng.poisson(pileup * pu_clusters_per_interaction)
+    pu_eta = rng.uniform(-eta_max, eta_max, npu)
+    pu_phi = rng.uniform(-pi, pi, npu)
+    pu_et = rng.exponential(0.6, npu) + 0.1
+
+    ncl = nsig + npu
+    eta = np.concatenate([cl_eta, pu_eta])
+    phi = wrap_phi(np.concatenate([cl_phi, pu_phi]))
+    # Signal clusters collect also some PU energy
+    pu_simE = np.concatenate([rng.exponential(0.05, nsig) * np.cosh(cl_eta), pu_et * np.cosh(pu_eta)])
+    raw_energy = np.concatenate([cl_simE * rng.uniform(0.9, 1.02, nsig), np.zeros(npu)]) + pu_simE * rng.uniform(0.8, 1.1, ncl)
+    energy = raw_energy * rng.uniform(1.0, 1.1, ncl)
+    ieta, iphi, iz = get_crystal_coordinates(eta, phi)
+
+    # Sim energy shared with each caloparticle and simfraction (shared simenergy / caloparticle simenergy)
+    shared_simE = np.zeros((ncl, n_signal))
+    shared_simE[np.arange(nsig), cl_calo] = cl_simE
+    # Tails of the caloparticles in the PU clusters close to them
+    if npu and n_signal:
+        dR2 = (pu_eta[:, None] - calo_eta[None, :])**2 + wrap_phi(pu_phi[:, None] - calo_phi[None, :])**2
+        leak = (dR2 < 0.3**2) & (rng.random(dR2.shape) < 0.5)
+        shared_simE[nsig:] = np.where(leak, calo_simE[None, :] * rng.uniform(1e-5, 5e-3, dR2.shape), 0.)
+    sim_fraction = shared_simE / calo_simE[None, :]
+
+    ###################
+    # Hits of the clusters: (ieta, iphi) around the cluster position, energies summing to the raw energy
+    nhits = np.clip(np.round(1 + 3 * np.log1p(raw_energy) + rng.poisson(1, ncl)), 1, 60).astype(np.int64)
+    hit_offset = np.cumsum(nhits) - nhits
+    hit_ieta = np.repeat(ieta, nhits) + rng.integers(-2, 3, nhits.sum())
+    hit_iphi = np.repeat(iphi, nhits) + rng.integers(-2, 3, nhits.sum())
+    hit_weight = rng.exponential(1., nhits.sum())
+    hit_weight[hit_offset] += 3.
+    hit_energy = hit_weight / np.repeat(np.add.reduceat(hit_weight, hit_offset), nhits) * np.repeat(raw_energy, nhits)
+    hit_fraction = np.where(rng.random(nhits.sum()) < 0.8, 1., rng.uniform(0.2, 1., nhits.sum()))
+    splits = hit_offset[1:]
+
+    ###################
+    # Refined superclusters: one for each signal caloparticle with Et > 1 GeV,
+    # seeded by the signal seed cluster and including the clusters of the caloparticle (and some PU)
+    sc_seeds, sc_clusters = [], []
+    for icalo in range(n_signal):
+        members = np.nonzero(cl_calo == icalo)[0]
+        seed = int(members[0])
+        if raw_energy[seed] / np.cosh(eta[seed]) < 1.: continue
+        if npu:
+            near = nsig + np.nonzero((np.abs(pu_eta - eta[seed]) < 0.05) & (np.abs(wrap_phi(pu_phi - phi[seed])) < 0.3))[0]
+            members = np.concatenate([members, near])
+        sc_seeds.append(seed)
+        sc_clusters.append(sorted(members.tolist()))
+    sc_raw = np.array([ raw_energy[cls].sum() for cls in sc_clusters ])
+
+    def cl_uniform(low, high):
+        return float_list(rng.uniform(low, high, ncl))
+
+    is_EB = iz == 0
+    branches = {
+        "pfCluster_energy": float_list(energy),
+        "pfCluster_rawEnergy": float_list(raw_energy),
+        "pfCluster_eta": float_list(eta),
+        "pfCluster_phi": float_list(phi),
+        "pfCluster_ieta": ieta.tolist(),
+        "pfCluster_iphi": iphi.tolist(),
+        "pfCluster_iz": iz.tolist(),
+        "pfCluster_noise": float_list(0.04 * np.sqrt(nhits) * (1 + rng.random(ncl))),
+        "pfCluster_noiseUncalib": float_list(0.04 * np.sqrt(nhits)),
+        "pfCluster_noiseNoFractions": float_list(0.05 * np.sqrt(nhits) * (1 + rng.random(ncl))),
+        "pfCluster_noiseUncalibNoFractions": float_list(0.05 * np.sqrt(nhits)),
+        "pfCluster_full5x5_r9": cl_uniform(0.5, 1.),
+        "pfCluster_full5x5_sigmaIetaIeta": float_list(np.where(is_EB, 0.009, 0.025) * rng.uniform(0.7, 1.4, ncl)),
+        "pfCluster_full5x5_sigmaIetaIphi": cl_uniform(-1e-4, 1e-4),
+        "pfCluster_full5x5_sigmaIphiIphi": float_list(np.where(is_EB, 0.01, 0.03) * rng.uniform(0.5, 2., ncl)),
+        "pfCluster_full5x5_swissCross": cl_uniform(0., 1.),
+        "pfCluster_r9": cl_uniform(0.5, 1.),
+        "pfCluster_sigmaIetaIeta": float_list(np.where(is_EB, 0.009, 0.025) * rng.uniform(0.7, 1.4, ncl)),
+        "pfCluster_sigmaIetaIphi": cl_uniform(-1e-4, 1e-4),
+        "pfCluster_sigmaIphiIphi": float_list(np.where(is_EB, 0.01, 0.03) * rng.uniform(0.5, 2., ncl)),
+        "pfCluster_swissCross": cl_uniform(0., 1.),
+        "pfCluster_nXtals": nhits.tolist(),
+        "pfCluster_etaWidth": cl_uniform(0.001, 0.02),
+        "pfCluster_phiWidth": cl_uniform(0.001, 0.05),
+        "pfClusterHit_rechitEnergy": [ float_list(h) for h in np.split(hit_energy, splits) ],
+        "pfClusterHit_fraction": [ float_list(h) for h in np.split(hit_fraction, splits) ],
+        "pfClusterHit_ieta": [ h.tolist() for h in np.split(hit_ieta, splits) ],
+        "pfClusterHit_iphi": [ h.tolist() for h in np.split(hit_iphi, splits) ],
+        "pfClusterHit_iz": [ [iz_cl] * n for iz_cl, n in zip(iz.tolist(), nhits.tolist()) ],
+        "pfCluster_sim_fraction": [ float_list(f) for f in sim_fraction ],
+        "pfCluster_simEnergy_sharedXtals": [ float_list(s) for s in shared_simE ],
+        "pfCluster_simEnergy_sharedXtalsPU": float_list(pu_simE),
+        "pfCluster_recoEnergy_sharedXtalsPU": float_list(pu_simE * rng.uniform(0.8, 1.1, ncl)),
+        "pfCluster_simPU_nSharedXtals": np.minimum(nhits, rng.poisson(1 + pu_simE)).tolist(),
+        "caloParticle_simEnergy": float_list(calo_simE),
+        "caloParticle_simEnergyGoodStatus": float_list(calo_simE * rng.uniform(0.98, 1., n_signal)),
+        "caloParticle_genEnergy": float_list(calo_simE * rng.uniform(1., 1.05, n_signal)),
+        "caloParticle_simEta": float_list(calo_eta),
+        "caloParticle_simPhi": float_list(calo_phi),
+        "caloParticle_genEta": float_list(calo_eta + rng.normal(0., 0.002, n_signal)),
+        "caloParticle_genPhi": float_list(wrap_phi(calo_phi + rng.normal(0., 0.002, n_signal))),
+        "caloParticle_simIz": get_iz(calo_eta).tolist(),
+        "caloParticlePU_totEnergy": float(np.float32(pu_simE.sum() * 1.2)),
+        "superCluster_seedIndex": sc_seeds,
+        "superCluster_rawEnergy": float_list(sc_raw),
+        "superCluster_energy": float_list(sc_raw * 1.03),
+        "superCluster_eta": float_list(eta[sc_seeds]),
+        "superCluster_pfClustersIndex": sc_clusters,
+        "nVtx": int(max(1, rng.poisson(pileup * 0.7))),
+        "rho": float(np.float32(0.5 * pileup * rng.uniform(0.8, 1.2))),
+        "obsPU": float(np.float32(rng.poisson(pileup))),
+        "truePU": float(np.float32(pileup)),
+    }
+    return SyntheticEvent(branches)
+
+
+def generate_events(nevents, seed=None, **kwargs):
+    '''
+    Generator of `nevents` synthetic events (the other arguments are passed to `generate_event`)
+    '''
+    rng = np.random.default_rng(seed)
+    for _ in range(nevents):
+        yield generate_event(rng, **kwargs)
+
+
+def save_events(events, outputfile, assoc_strategy="sim_fraction"):
+    '''
+    Save the events in a parquet file with one row per event (one column per dumper branch)
+    '''
+    import awkward as ak
+    branches = get_branches(assoc_strategy)
+    ak.to_parquet(ak.Array([ { br: getattr(event, br) for br in branches } for event in events ]), outputfile)
+
+
+def load_events(inputfile):
+    '''
+    Generator of the SyntheticEvent saved in a parquet file by `save_events`
+    '''
+    import awkward as ak
+    data = ak.from_parquet(inputfile)
+    columns = { br: ak.to_list(data[br]) for br in data.fields }
+    for iev in range(len(data)):
+        yield SyntheticEvent({ br: col[iev] for br, col in columns.items() })
@@ -0,0 +1,198 @@
+from __future__ import print_function
+import argparse
+import numpy as np
+import tensorflow as tf
+from windows_creator_general import WindowCreator
+from simfraction_thresholds import SimfractionThresholds
+from synthetic_events import generate_event
+from tfrecord_writer import (encode_windows, SEED_FEATURES, SEED_LABELS, SEED_METADATA, WINDOW_FEATURES,
+                             WINDOW_METADATA, CLS_FEATURES, CLS_LABELS, CLS_METADATA, HITS_INDICES)
+
+'''
+Parity check between the batched protobuf encoding of the windows (tfrecord_writer.encode_windows)
+and the tf.train.SequenceExample objects built window by window as in the original `make_example_window`
+of convert_tfrecord_dataset_allinfo.py, on the windows of synthetic events (synthetic_events.py).
+
+Both sets of records are parsed with tf.io.parse_single_sequence_example using the features of
+tf_data.parse_windows_batch (with hits and metadata, plus the serialized seed hits tensor) and all the tensors
+must be equal. Edge cases are added to the windows: empty seed and cluster hits, negative and large (multi-byte varint)
+integer labels, NaN features, with and without weights and with a negative flag or without the flag.
+Run it from the NtuplesProduction folder:
+
+    python tfrecord_parity.py -n 20 --pileup 60
+'''
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n","--nevents", type=int, help="Number of synthetic events", default=20)
+parser.add_argument("--pileup", type=float, help="Pileup level of the events", default=60)
+parser.add_argument("-s", "--seed", type=int, help="Random seed", default=0)
+args = parser.parse_args()
+
+
+def _int64_features(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+def _int64_feature(value):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+def _float_features(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+def _float_feature(value):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+def _tensor_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[tf.io.serialize_tensor(value).numpy()]))
+
+
+def make_example_window(window, weight=1.0, flag=None):
+    '''
+    Reference SequenceExample of a window, built with the tf.train objects as in the original conversion script
+    '''
+    seed_f = np.array( [window[f] for f in SEED_FEATURES],dtype='float32')
+    seed_l = np.array( [window[f] for f in SEED_LABELS],dtype='int')
+    seed_m = np.array( [window[f] for f in SEED_METADATA],dtype='float32')
+    window_f = np.array( [window[f] for f in WINDOW_FEATURES],dtype='float32')
+    window_m = np.array( [window[f] for f in WINDOW_METADATA],dtype='float32')
+    seed_hits = np.array([ [r[i] for i in HITS_INDICES] for r in  window['seed_hits']], dtype='float32')
+
+    # Class division
+    if not window['is_seed_calo_matched']:
+        class_ = 0
+    elif window['is_seed_calo_matched'] and not window["is_seed_calo_seed"]:
+        class_ = 1
+    elif window['is_seed_calo_matched'] and window["is_seed_calo_seed"]:
+        class_ = 2
+
+    context_features = {
+        's_f': _float_features(seed_f),
+        's_l': _int64_features(seed_l),
+        's_m': _float_features(seed_m),
+        's_h': _tensor_feature(seed_hits),
+        'w_f': _float_features(window_f),
+        'w_m': _float_features(window_m),
+        'w_cl' : _int64_feature(class_),
+        'n_cl' : _int64_feature(window["ncls"]),
+        'wi' :  _float_feature(weight)
+    }
+    if flag != None:
+        if window["is_seed_calo_matched"]:
+            context_features['f'] = _int64_feature(flag)
+        else:
+            context_features['f'] = _int64_feature(0)
+
+    clusters_features = [ _float_features(np.array([ cl[feat] for feat in CLS_FEATURES],dtype='float32'))  for cl in window["clusters"] ]
+    clusters_metadata = [ _float_features(np.array([ cl[m] for m in CLS_METADATA],dtype='float32'))  for cl in window["clusters"] ]
+    clusters_labels =   [ _int64_features(np.array([ cl[l] for l in CLS_LABELS],dtype='int'))  for cl in window["clusters"] ]
+    clusters_hits = { "cl_h{}".format(i): [ _float_features(np.array([r[i] for r in cl['cl_hits']],dtype="float32"))
+                                            for cl in window["clusters"] ] for i in HITS_INDICES }
+
+    clusters_list = tf.train.FeatureLists(
+        feature_list={
+            "cl_f" : tf.train.FeatureList(feature=clusters_features),
+            "cl_m" : tf.train.FeatureList(feature=clusters_metadata),
+            "cl_l" : tf.train.FeatureList(feature=clusters_labels),
+            **{ name: tf.train.FeatureList(feature=features) for name, features in clusters_hits.items() }
+        }
+    )
+    example = tf.train.SequenceExample(context=tf.train.Features(feature=context_features),
+                                       feature_lists=clusters_list)
+    return example, class_
+
+
+def get_features_spec(flag):
+    '''
+    Features of tf_data.parse_windows_batch(read_hits=True, read_metadata=True) and the seed hits
+    '''
+    context_features = {
+        's_f': tf.io.FixedLenFeature([len(SEED_FEATURES)], tf.float32),
+        's_l': tf.io.FixedLenFeature([len(SEED_LABELS)], tf.int64),
+        's_m': tf.io.FixedLenFeature([len(SEED_METADATA)], tf.float32),
+        's_h': tf.io.FixedLenFeature([], tf.string),
+        'w_f': tf.io.FixedLenFeature([len(WINDOW_FEATURES)], tf.float32),
+        'w_m': tf.io.FixedLenFeature([len(WINDOW_METADATA)], tf.float32),
+        'w_cl' : tf.io.FixedLenFeature([], tf.int64),
+        'n_cl' : tf.io.FixedLenFeature([], tf.int64),
+        'wi': tf.io.FixedLenFeature([], tf.float32)
+    }
+    if flag is not None:
+        context_features['f'] = tf.io.FixedLenFeature([], tf.int64)
+    clusters_features = {
+        "cl_f" : tf.io.FixedLenSequenceFeature([len(CLS_FEATURES)], dtype=tf.float32),
+        "cl_m" : tf.io.FixedLenSequenceFeature([len(CLS_METADATA)], dtype=tf.float32),
+        "cl_l" : tf.io.FixedLenSequenceFeature([len(CLS_LABELS)], dtype=tf.int64),
+    }
+    for i in HITS_INDICES:
+        clusters_features["cl_h{}".format(i)] = tf.io.RaggedFeature(dtype=tf.float32)
+    return context_features, clusters_features
+
+
+def parse(record, flag):
+    context_features, clusters_features = get_features_spec(flag)
+    context, lists = tf.io.parse_single_sequence_example(record, context_features=context_features,
+                                                         sequence_features=clusters_features)
+    tensors = { k: v.numpy() for k, v in context.items() if k != "s_h" }
+    tensors["s_h"] = tf.io.parse_tensor(context["s_h"], out_type=tf.float32).numpy()
+    for k, v in lists.items():
+        tensors[k] = v.to_list() if isinstance(v, tf.RaggedTensor) else v.numpy()
+    return tensors
+
+
+def equal(a, b):
+    if isinstance(a, list):
+        return isinstance(b, list) and len(a) == len(b) and all(equal(x, y) for x, y in zip(a, b))
+    a, b = np.asarray(a), np.asarray(b)
+    return a.dtype == b.dtype and a.shape == b.shape and np.array_equal(a, b, equal_nan=a.dtype.kind == "f")
+
+
+def get_windows():
+    rng = np.random.default_rng(args.seed)
+    windows_creator = WindowCreator(SimfractionThresholds([0., 1e6], [0., 5.], [[0.05]]), 1e-2,
+                                    cl_min_fraction=1e-4, nocalowNmax=5, random_seed=args.seed)
+    windows = []
+    for _ in range(args.nevents):
+        windows += windows_creator.get_windows(generate_event(rng, pileup=args.pileup), dump_json=False)[0]
+    # Edge cases
+    for i, window in enumerate(windows):
+        if i % 3 == 0:
+            window["seed_hits"] = []
+            window["clusters"][-1]["cl_hits"] = []
+        if i % 4 == 1:
+            window["is_seed_mustache_matched"] = -1
+            window["clusters"][0]["in_mustache"] = -3
+            window["clusters"][-1]["in_scluster"] = 300
+        if i % 5 == 2:
+            window["seed_PUfrac"] = float("nan")
+            window["clusters"][0]["cluster_PUfrac"] = float("nan")
+    return windows
+
+
+def weights(et_seed, ncls):
+    return 1. + 0.01 * et_seed + 0.1 * ncls
+
+
+windows = get_windows()
+print("{} windows of {} events".format(len(windows), args.nevents))
+
+ok = True
+for use_weights, flag in [(False, None), (True, -11), (False, 11)]:
+    records, classes = encode_windows(windows, weights if use_weights else None, flag)
+    nerrors = 0
+    for iw, (window, record) in enumerate(zip(windows, records)):
+        weight = float(np.float32(weights(np.float64(window["et_seed"]), window["ncls"]))) if use_weights else 1.0
+        example, class_ = make_example_window(window, weight, flag)
+        reference = parse(example.SerializeToString(), flag)
+        encoded = parse(record, flag)
+        diffs = [ k for k in reference if not equal(reference[k], encoded[k]) ]
+        if class_ != classes[iw]:
+            diffs.append("class")
+        if diffs:
+            nerrors += 1
+            if nerrors <= 10:
+                print("   window {}: different {}".format(iw, diffs))
+    print("weights={} flag={}: {} windows, {} differences".format(use_weights, flag, len(windows), nerrors))
+    ok = ok and nerrors == 0
+
+if not ok:
+    raise SystemExit(1)
+print("Parity OK")
@@ -0,0 +1,318 @@
+import numpy as np
+
+'''
+Batched encoder of the windows in the tf.train.SequenceExample records read by
+tf_data.parse_windows_batch (Training/global_model/tf_data.py).
+
+The protobuf messages (SequenceExample, Features, FeatureLists, Feature, FloatList, Int64List, TensorProto)
+are serialized directly in the protobuf wire format instead of building the tf.train objects window by window:
+the features of a batch of windows are extracted in numpy arrays at once (one array for each group of features,
+all the clusters of the batch are stacked) and the fixed size features (e.g. the cluster features of all the clusters)
+are encoded with a single numpy operation. The records decode to the same messages of the tf.train objects:
+the parity of the parsed tensors is checked by tfrecord_parity.py.
+
+The ShardedRecordWriter writes the records round-robin in N TFRecord files, with an optional target size of the files.
+'''
+
+SEED_FEATURES = ["seed_eta","seed_phi", "seed_ieta","seed_iphi", "seed_iz",
+                 "en_seed", "et_seed","en_seed_calib","et_seed_calib",
+                 "seed_f5_r9","seed_f5_sigmaIetaIeta", "seed_f5_sigmaIetaIphi",
+                 "seed_f5_sigmaIphiIphi","seed_f5_swissCross",
+                 "seed_r9","seed_sigmaIetaIeta", "seed_sigmaIetaIphi",
+                 "seed_sigmaIphiIphi","seed_swissCross",
+                 "seed_nxtals","seed_etaWidth","seed_phiWidth",
+                 ]
+
+SEED_LABELS =   [ "is_seed_calo_matched", "is_seed_calo_seed", "is_seed_mustache_matched"]
+SEED_METADATA = [ "seed_score", "seed_simen_sig", "seed_simen_PU", "seed_PUfrac"]
+
+# features that can be used in the training
+WINDOW_FEATURES = [  "max_en_cluster","max_et_cluster","max_deta_cluster","max_dphi_cluster","max_den_cluster","max_det_cluster",
+                     "min_en_cluster","min_et_cluster","min_deta_cluster","min_dphi_cluster","min_den_cluster","min_det_cluster",
+                     "mean_en_cluster","mean_et_cluster","mean_deta_cluster","mean_dphi_cluster","mean_den_cluster","mean_det_cluster" ]
+# Metadata about the window like true energy, true calo position, useful info
+WINDOW_METADATA = ["nVtx", "rho", "obsPU", "truePU",
+                    "sim_true_eta", "sim_true_phi",
+                    "en_true_sim","et_true_sim", "en_true_gen", "et_true_gen",
+                    "en_true_sim_good", "et_true_sim_good",
+                    "sim_true_eta","sim_true_phi","gen_true_eta","gen_true_phi",
+                    "en_mustache_raw", "et_mustache_raw","en_mustache_calib", "et_mustache_calib", "nclusters_insc",
+                    "max_en_cluster_insc","max_deta_cluster_insc","max_dphi_cluster_insc",
+                    "event_tot_simen_PU","wtot_simen_PU","wtot_simen_sig" ]
+
+CLS_FEATURES = [    "en_cluster","et_cluster",
+                    "cluster_eta", "cluster_phi",
+                    "cluster_ieta","cluster_iphi","cluster_iz",
+                    "cluster_deta", "cluster_dphi",
+                    "cluster_den_seed","cluster_det_seed",
+                    "en_cluster_calib", "et_cluster_calib",
+                    "cl_f5_r9", "cl_f5_sigmaIetaIeta", "cl_f5_sigmaIetaIphi",
+                    "cl_f5_sigmaIphiIphi","cl_f5_swissCross",
+                    "cl_r9", "cl_sigmaIetaIeta", "cl_sigmaIetaIphi",
+                    "cl_sigmaIphiIphi","cl_swissCross",
+                    "cl_nxtals", "cl_etaWidth","cl_phiWidth",
+                ]
+
+CLS_LABELS = ["is_seed","is_calo_matched","is_calo_seed", "in_scluster","in_geom_mustache","in_mustache"]
+CLS_METADATA = [ "calo_score", "calo_simen_sig", "calo_simen_PU", "cluster_PUfrac","calo_nxtals_PU",
+                "noise_en","noise_en_uncal","noise_en_nofrac","noise_en_uncal_nofrac"]
+
+# Indices of the hits coordinates saved for each cluster (ieta, iphi, iz, energy*fraction)
+HITS_INDICES = [0, 1, 2, 4]
+
+# tensorflow DataType of float32 tensors (TensorProto.dtype)
+DT_FLOAT = 1
+
+
+########################################
+# Protobuf wire format
+
+def varint(value):
+    '''
+    Varint encoding of an integer (negative int64 are encoded in 10 bytes as in protobuf)
+    '''
+    if 0 <= value < SMALL_VARINTS_MAX:
+        return SMALL_VARINTS[value]
+    return encode_varint(value)
+
+
+def encode_varint(value):
+    if value < 0:
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# The lengths of the messages are mostly small: their encodings are cached
+SMALL_VARINTS_MAX = 1 << 14
+SMALL_VARINTS = [ encode_varint(i) for i in range(SMALL_VARINTS_MAX) ]
+
+
+def length_delimited(field, payload):
+    '''
+    Length delimited field (submessage, bytes, string, packed array)
+    '''
+    return varint((field << 3) | 2) + varint(len(payload)) + payload
+
+
+def float_list(data):
+    '''
+    Feature with a FloatList given the little-endian float32 bytes of the values
+    '''
+    return length_delimited(2, length_delimited(1, data) if data else b"")
+
+
+def int64_list(values):
+    '''
+    Feature with an Int64List of the values
+    '''
+    data = b"".join(varint(int(v)) for v in values)
+    return length_delimited(3, length_delimited(1, data) if data else b"")
+
+
+def bytes_list(value):
+    '''
+    Feature with a BytesList of one value
+    '''
+    return length_delimited(1, length_delimited(1, value))
+
+
+def tensor_proto(array):
+    '''
+    Serialized TensorProto of a float32 array, as tf.io.serialize_tensor
+    '''
+    shape = b"".join(length_delimited(2, varint(0x08) + varint(d) if d else b"") for d in array.shape)
+    content = np.ascontiguousarray(array, dtype="<f4").tobytes()
+    return (varint(0x08) + varint(DT_FLOAT) + length_delimited(2, shape)
+            + (length_delimited(4, content) if content else b""))
+
+
+def map_entry(key, value):
+    '''
+    Entry of the map<string, Feature(List)> of the Features and FeatureLists messages
+    '''
+    return length_delimited(1, length_delimited(1, key) + length_delimited(2, value))
+
+
+def rows_float_features(array):
+    '''
+    FloatList features of the rows of a 2D array, all encoded at once: the header is the same for all the rows
+    '''
+    nrows, ncols = array.shape
+    if nrows == 0 or ncols == 0:
+        return [float_list(b"")] * nrows
+    header = np.frombuffer(float_list(b"\x00" * 4 * ncols)[:-4 * ncols], dtype=np.uint8)
+    data = np.ascontiguousarray(array, dtype="<f4").view(np.uint8).reshape(nrows, -1)
+    encoded = np.hstack([np.broadcast_to(header, (nrows, len(header))), data])
+    return encoded
+
+
+def rows_int64_features(array):
+    '''
+    Int64List features of the rows of a 2D array of small non-negative integers (labels),
+    for which the varint encoding is one byte for each value
+    '''
+    nrows, ncols = array.shape
+    values = np.asarray(array, dtype=np.int64)
+    if nrows == 0 or ncols == 0 or values.min(initial=0) < 0 or values.max(initial=0) > 0x7f:
+        return [int64_list(row) for row in values]
+    header = np.frombuffer(int64_list([0] * ncols)[:-ncols], dtype=np.uint8)
+    encoded = np.hstack([np.broadcast_to(header, (nrows, len(header))), values.astype(np.uint8)])
+    return encoded
+
+
+def feature_list_items(features):
+    '''
+    Items of the FeatureList (repeated Feature) of the encoded features of the rows
+    '''
+    if isinstance(features, np.ndarray):
+        # All the features have the same length: same prefix for all the items
+        prefix = np.frombuffer(varint((1 << 3) | 2) + varint(features.shape[1]), dtype=np.uint8)
+        items = np.hstack([np.broadcast_to(prefix, (features.shape[0], len(prefix))), features])
+        data = items.tobytes()
+        size = items.shape[1]
+        return [ data[i*size:(i+1)*size] for i in range(features.shape[0]) ]
+    return [ length_delimited(1, f) for f in features ]
+
+
+def rows_bytes(features):
+    if isinstance(features, np.ndarray):
+        data = features.tobytes()
+        size = features.shape[1]
+        return [ data[i*size:(i+1)*size] for i in range(features.shape[0]) ]
+    return features
+
+
+########################################
+# Windows encoding
+
+def get_windows_class(seed_calo_matched, seed_calo_seed):
+    '''
+    Class of the windows: 0 not calo matched, 1 calo matched, 2 calo matched and seed of the caloparticle
+    '''
+    return np.where(~seed_calo_matched, 0, np.where(seed_calo_seed, 2, 1))
+
+
+def encode_windows(windows, weights=None, flag=None):
+    '''
+    Encode a batch of windows dictionaries in serialized SequenceExample records.
+
+    weights: function returning the weights given the arrays of et_seed and ncls of the windows
+    flag: flag (pdgId) saved for the calo matched windows (0 for the others), not saved if None
+
+    Returns the list of records and the array of the classes of the windows.
+    '''
+    nwindows = len(windows)
+    clusters = [ cl for w in windows for cl in w["clusters"] ]
+    # Offsets of the clusters of each window in the stacked clusters arrays
+    cl_offsets = np.cumsum([0] + [ len(w["clusters"]) for w in windows ])
+
+    # Extract all the features at once
+    seed_f = np.array([ [w[f] for f in SEED_FEATURES] for w in windows ], dtype="float32").reshape(nwindows, -1)
+    seed_l = np.array([ [w[f] for f in SEED_LABELS] for w in windows ], dtype="int").reshape(nwindows, -1)
+    seed_m = np.array([ [w[f] for f in SEED_METADATA] for w in windows ], dtype="float32").reshape(nwindows, -1)
+    window_f = np.array([ [w[f] for f in WINDOW_FEATURES] for w in windows ], dtype="float32").reshape(nwindows, -1)
+    window_m = np.array([ [w[f] for f in WINDOW_METADATA] for w in windows ], dtype="float32").reshape(nwindows, -1)
+    ncls = np.array([ w["ncls"] for w in windows ], dtype="int")
+    classes = get_windows_class(seed_l[:,0].astype(bool), seed_l[:,1].astype(bool))
+    if weights is not None:
+        weight = np.asarray(weights(np.array([ w["et_seed"] for w in windows ], dtype="float64"), ncls), dtype="float32")
+    else:
+        weight = np.ones(nwindows, dtype="float32")
+
+    cl_f = np.array([ [cl[f] for f in CLS_FEATURES] for cl in clusters ], dtype="float32").reshape(len(clusters), -1)
+    cl_m = np.array([ [cl[m] for m in CLS_METADATA] for cl in clusters ], dtype="float32").reshape(len(clusters), -1)
+    cl_l = np.array([ [cl[l] for l in CLS_LABELS] for cl in clusters ], dtype="int").reshape(len(clusters), -1)
+    # Hits of all the clusters: one array for each coordinate
+    nhits = np.array([ len(cl["cl_hits"]) for cl in clusters ], dtype="int")
+    hits_offsets = np.cumsum(np.concatenate([[0], nhits]))
+    hits = np.array([ [r[i] for i in HITS_INDICES] for cl in clusters for r in cl["cl_hits"] ], dtype="float32").reshape(-1, len(HITS_INDICES))
+    hits_data = [ np.ascontiguousarray(hits[:, i], dtype="<f4").tobytes() for i in range(len(HITS_INDICES)) ]
+
+    # Encoded context features
+    context = {
+        # Seed features (for training)
+        b's_f': rows_bytes(rows_float_features(seed_f)),
+        # Seed labels
+        b's_l': rows_bytes(rows_int64_features(seed_l)),
+        #Seed metadata
+        b's_m': rows_bytes(rows_float_features(seed_m)),
+        # Seed hits
+        b's_h': [ bytes_list(tensor_proto(np.array([ [r[i] for i in HITS_INDICES] for r in w['seed_hits'] ], dtype='float32')))
+                  for w in windows ],
+        # window features (for training)
+        b'w_f': rows_bytes(rows_float_features(window_f)),
+        # window metadata and truth info
+        b'w_m': rows_bytes(rows_float_features(window_m)),
+        # window class
+        b'w_cl' : rows_bytes(rows_int64_features(classes[:, None])),
+        # number of clusters
+        b'n_cl' : [ int64_list([n]) for n in ncls ],
+        # Weight
+        b'wi' : rows_bytes(rows_float_features(weight[:, None])),
+    }
+    # flag for flavour
+    if flag != None:
+        context[b'f'] = [ int64_list([flag if matched else 0]) for matched in seed_l[:,0] ]
+
+    # Encoded clusters features (items of the feature lists)
+    clusters_lists = {
+        b"cl_f" : feature_list_items(rows_float_features(cl_f)),
+        b"cl_m" : feature_list_items(rows_float_features(cl_m)),
+        b"cl_l" : feature_list_items(rows_int64_features(cl_l)),
+    }
+    for i, name in enumerate([b"cl_h0", b"cl_h1", b"cl_h2", b"cl_h4"]):
+        data = hits_data[i]
+        clusters_lists[name] = [ length_delimited(1, float_list(data[4*hits_offsets[icl]:4*hits_offsets[icl+1]]))
+                                 for icl in range(len(clusters)) ]
+
+    records = []
+    for iw in range(nwindows):
+        context_msg = b"".join(map_entry(key, values[iw]) for key, values in context.items())
+        start, end = cl_offsets[iw], cl_offsets[iw+1]
+        lists_msg = b"".join(map_entry(key, b"".join(items[start:end])) for key, items in clusters_lists.items())
+        records.append(length_delimited(1, context_msg) + length_delimited(2, lists_msg))
+    return records, classes
+
+
+class ShardedRecordWriter():
+    '''
+    Write the records round-robin in `nshards` TFRecord files.
+    If `shard_size` (bytes) is given, a file reaching the size is closed and replaced by a new file.
+    '''
+    def __init__(self, get_filename, nshards=1, shard_size=None):
+        '''
+        get_filename: function returning the name of the i-th file
+        '''
+        import tensorflow as tf
+        self.tf = tf
+        self.get_filename = get_filename
+        self.shard_size = shard_size
+        self.files = []
+        self.writers = [ self.open() for _ in range(nshards) ]
+        self.sizes = [0] * nshards
+        self.ishard = 0
+
+    def open(self):
+        filename = self.get_filename(len(self.files))
+        self.files.append(filename)
+        return self.tf.io.TFRecordWriter(filename)
+
+    def write(self, record):
+        i = self.ishard
+        self.writers[i].write(record)
+        # length, crc of the length, data, crc of the data
+        self.sizes[i] += len(record) + 16
+        if self.shard_size and self.sizes[i] >= self.shard_size:
+            self.writers[i].close()
+            self.writers[i] = self.open()
+            self.sizes[i] = 0
+        self.ishard = (i + 1) % len(self.writers)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
@@ -0,0 +1,71 @@
+import numpy as np
+
+'''
+Window-level features aggregated over the clusters of the window (max, min, mean of the cluster
+quantities, max of the clusters in the supercluster and total PU/signal simenergy).
+
+All the aggregates are computed in a single pass on a (n clusters, n quantities) numpy array,
+so that the same definitions can be used by the windows creator of the dataset production and
+by any other tool building the windows (e.g. the reco_dumper.py or inference-time windows).
+'''
+
+# Cluster quantities used for the aggregates: columns of the array passed to get_window_aggregates
+CLUSTER_QUANTITIES = ["en_cluster", "et_cluster", "cluster_deta", "cluster_dphi",
+                      "cluster_den_seed", "cluster_det_seed",
+                      "calo_simen_PU", "calo_recoen_PU", "calo_simen_sig"]
+
+# Window feature suffix and column of the quantity for the max/min/mean aggregates
+MINMAX_FEATURES = [("en_cluster", 0), ("et_cluster", 1), ("deta_cluster", 2),
+                   ("dphi_cluster", 3), ("den_cluster", 4), ("det_cluster", 5)]
+# Max of the clusters in the supercluster (only for calo-matched windows)
+INSC_FEATURES = [("max_en_cluster_insc", 0), ("max_deta_cluster_insc", 2), ("max_dphi_cluster_insc", 3)]
+# Total in the window
+WTOT_FEATURES = [("wtot_simen_PU", 6), ("wtot_recoen_PU", 7), ("wtot_simen_sig", 8)]
+
+
+def get_cluster_quantities(clusters):
+    '''
+    (n clusters, len(CLUSTER_QUANTITIES)) array from the list of the clusters dictionaries of a window
+    '''
+    return np.array([ [ cl[q] for q in CLUSTER_QUANTITIES ] for cl in clusters ], dtype=np.float64)
+
+
+def get_window_aggregates(cl_quantities, in_scluster, calo_matched=True):
+    '''
+    Window features from the clusters quantities of a window.
+
+    cl_quantities: (n clusters, len(CLUSTER_QUANTITIES)) array, at least one cluster (the seed)
+    in_scluster: boolean mask of the clusters in the supercluster
+    calo_matched: if False the supercluster features are set to 0 clusters and -1
+
+    Returns a dictionary with the features, in the same order of the windows output.
+    '''
+    ncls = len(cl_quantities)
+    # Quantities on the rows: the mean is computed on contiguous rows as np.mean on each list of values
+    values = np.ascontiguousarray(cl_quantities.T)
+    out = {}
+    if calo_matched:
+        in_scluster = np.asarray(in_scluster, dtype=bool)
+        out["nclusters_insc"] = int(in_scluster.sum())
+        insc_max = values[:, in_scluster].max(axis=1).tolist()
+        for name, iq in INSC_FEATURES:
+            out[name] = insc_max[iq]
+    else:
+        out["nclusters_insc"] = 0
+        for name, _ in INSC_FEATURES:
+            out[name] = -1
+    out["ncls"] = ncls
+    vmax = values.max(axis=1).tolist()
+    vmin = values.min(axis=1).tolist()
+    vmean = values.mean(axis=1).tolist()
+    for name, iq in MINMAX_FEATURES:
+        out["max_" + name] = vmax[iq]
+    for name, iq in MINMAX_FEATURES:
+        out["min_" + name] = vmin[iq]
+    for name, iq in MINMAX_FEATURES:
+        out["mean_" + name] = vmean[iq]
+    # Sums accumulated in the order of the clusters
+    vsum = (np.cumsum(cl_quantities[:, [ iq for _, iq in WTOT_FEATURES ]], axis=0)[-1] + 0.).tolist()
+    for (name, _), s in zip(WTOT_FEATURES, vsum):
+        out[name] = s
+    return out
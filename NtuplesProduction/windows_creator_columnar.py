@@ -0,0 +1,556 @@
+from __future__ import print_function
+from math import pi, cosh
+from itertools import repeat
+import string
+import json
+import numpy as np
+import awkward as ak
+import uproot
+import mustache
+import calo_association
+from windows_creator_general import WindowCreator, StageTimer, SCALAR_BRANCHES
+from window_features import CLUSTER_QUANTITIES, MINMAX_FEATURES, INSC_FEATURES, WTOT_FEATURES
+
+'''
+Columnar (uproot + numpy) version of the WindowCreator.
+
+The events are read from the RecoSimDumper caloTree in chunks of thousands of events with uproot
+and the windows of all the events of a chunk are created at once on the flat arrays of the chunk
+(clusters, caloparticles, superclusters and hits of all the events, with the offsets of each event):
+- calo association: `calo_association.get_calo_association_chunk` on the jagged scores
+- seeds: Et ordering and non-overlapping check on all the (candidate, candidate) pairs of each event
+- window/cluster matching on all the (window, cluster) pairs of each event
+- labels of the clusters (calo matching, PU fraction, simfraction thresholds, mustache) on the (window, cluster) pairs
+- window aggregates with segmented reductions on the clusters of each window
+
+Only the random windows ids and the sampling of the no calo-matched windows are drawn event by event,
+with the same draws of WindowCreator.get_windows, and the windows/clusters dictionaries are built
+only at the end for the output. The output is identical to the PyROOT path (see columnar_parity.py).
+'''
+
+CALOTREE = "recosimdumper/caloTree"
+# Max number of pairs tested at once: the pairs are built in blocks of windows
+MAX_PAIRS = 2**22
+
+# Optional per-cluster branches (feature: branch), saved as None if the branch is not read.
+# The shower shapes are saved for the clusters as cl_{name} and for the seed as seed_{name}
+NOISE_BRANCHES = [("noise_en", "pfCluster_noise"), ("noise_en_uncal", "pfCluster_noiseUncalib"),
+                  ("noise_en_nofrac", "pfCluster_noiseNoFractions"),
+                  ("noise_en_uncal_nofrac", "pfCluster_noiseUncalibNoFractions")]
+SHAPES_BRANCHES = [("f5_r9", "pfCluster_full5x5_r9"), ("f5_sigmaIetaIeta", "pfCluster_full5x5_sigmaIetaIeta"),
+                   ("f5_sigmaIetaIphi", "pfCluster_full5x5_sigmaIetaIphi"),
+                   ("f5_sigmaIphiIphi", "pfCluster_full5x5_sigmaIphiIphi"),
+                   ("f5_swissCross", "pfCluster_full5x5_swissCross"), ("r9", "pfCluster_r9"),
+                   ("sigmaIetaIeta", "pfCluster_sigmaIetaIeta"), ("sigmaIetaIphi", "pfCluster_sigmaIetaIphi"),
+                   ("sigmaIphiIphi", "pfCluster_sigmaIphiIphi"), ("swissCross", "pfCluster_swissCross"),
+                   ("etaWidth", "pfCluster_etaWidth"), ("phiWidth", "pfCluster_phiWidth"), ("nxtals", "pfCluster_nXtals")]
+
+# Keys of the clusters in the output, in the order of WindowCreator.get_windows
+# (the window dependent labels are filled for each window, cluster_deta, cluster_den_seed and cluster_det_seed are added at the end)
+CLUSTER_KEYS = ["cl_index", "is_seed", "in_geom_mustache", "is_calo_matched", "is_calo_seed", "in_scluster",
+                "in_mustache", "calo_score", "calo_simen_sig", "calo_simen_PU", "calo_recoen_PU", "calo_nxtals_PU",
+                "cluster_PUfrac", "cluster_ieta", "cluster_iphi", "cluster_eta", "cluster_phi", "cluster_dphi",
+                "cluster_iz", "en_cluster", "et_cluster", "en_cluster_calib", "et_cluster_calib"] + \
+               [ name for name, _ in NOISE_BRANCHES ] + [ "cl_" + name for name, _ in SHAPES_BRANCHES ] + ["cl_hits"]
+
+
+def events_chunk(events, branches):
+    '''
+    Awkward array (chunk) of a list of events with the branches as attributes (e.g. synthetic_events.SyntheticEvent)
+    '''
+    return ak.zip({ br: ak.Array([ getattr(event, br) for event in events ]) for br in branches
+                    if hasattr(events[0], br) }, depth_limit=1)
+
+
+def offsets(counts):
+    '''
+    Start of each list in the flat array from the counts
+    '''
+    return np.cumsum(counts) - counts
+
+
+def local_index(counts):
+    '''
+    Index of each element of the flat array inside its list
+    '''
+    return np.arange(counts.sum()) - np.repeat(offsets(counts), counts)
+
+
+def masked_take(values, index, mask, fill):
+    '''
+    values[index] where mask, fill elsewhere (the index is not used where not mask)
+    '''
+    out = np.full(len(index), fill, dtype=np.result_type(values, np.asarray(fill)))
+    out[mask] = values[index[mask]]
+    return out
+
+
+def iter_pairs(a_event, b_start, b_count, max_pairs=MAX_PAIRS):
+    '''
+    Generator of the (ia, ib) arrays of the pairs of each item a with all the items b of its event,
+    from the event of the a items and the start and number of the b items of each event.
+    The pairs are ordered by a and then b, and generated in blocks of consecutive a items of about max_pairs pairs.
+    '''
+    n = b_count[a_event]
+    block = np.cumsum(n) // max_pairs
+    bounds = [0] + (np.nonzero(np.diff(block))[0] + 1).tolist() + [len(a_event)]
+    for a0, a1 in zip(bounds[:-1], bounds[1:]):
+        nb = n[a0:a1]
+        yield np.repeat(np.arange(a0, a1), nb), local_index(nb) + np.repeat(b_start[a_event[a0:a1]], nb)
+
+
+def dynamic_window_array(eta):
+    '''
+    Vectorized WindowCreator.dynamic_window (version 2): arrays of (deta_up, deta_down, dphi)
+    '''
+    aeta = np.abs(eta)
+    barrel = aeta <= 1.5
+    deta_up = np.where(barrel, (0.1/1.5)*aeta + 0.1, (0.1/1.5)*(aeta-1.5) + 0.2)
+    deta_down = np.where(barrel, -0.1, (-0.1/1.5)*(aeta-1.5) -0.1)
+    dphi = 0.7 + (-0.1/3)*aeta
+    return deta_up, deta_down, dphi
+
+
+def in_window_array(seed_eta, seed_phi, seed_iz, eta, phi, iz, window_deta_up, window_deta_down, window_dphi):
+    '''
+    Vectorized `in_window` on arrays broadcasted together (e.g. the (window, cluster) pairs).
+    Returns the mask and the etaw, phiw arrays.
+    '''
+    # Delta Eta ordering
+    etaw = eta - seed_eta
+    etaw = np.where(seed_eta < 0, -etaw, etaw)
+    # Delta Phi with the same wrapping of DeltaPhi
+    phiw = seed_phi - phi
+    phiw = np.where(phiw > pi, phiw - 2*pi, phiw)
+    phiw = np.where(phiw < -pi, phiw + 2*pi, phiw)
+    mask = ((seed_iz == iz) & (etaw >= window_deta_down) & (etaw <= window_deta_up) &
+            (np.abs(phiw) <= window_dphi))
+    return mask, etaw, phiw
+
+
+def segments_mean(values, starts, counts):
+    '''
+    Means on the segments (start, count) of the rows of the (n quantities, n values) array.
+    The segments with the same length are gathered in a contiguous (n quantities * n segments, length) array,
+    so that the sums are done as np.mean on each window (same pairwise summation)
+    '''
+    out = np.empty((len(values), len(starts)), dtype=np.float64)
+    for n in np.unique(counts).tolist():
+        sel = np.nonzero(counts == n)[0]
+        gathered = np.ascontiguousarray(values[:, starts[sel][:, None] + np.arange(n)].reshape(-1, n))
+        out[:, sel] = gathered.mean(axis=1).reshape(len(values), len(sel))
+    return out
+
+
+def segments_cumsum(values, starts, counts):
+    '''
+    Sums on the segments (start, count) of the rows of the (n quantities, n values) array, accumulated
+    in the order of the values as the np.cumsum of get_window_aggregates (same rounding)
+    '''
+    total = values[:, starts].copy()
+    for k in range(1, int(counts.max(initial=0))):
+        sel = counts > k
+        total[:, sel] += values[:, starts[sel] + k]
+    return total + 0.
+
+
+class ChunkTimer(StageTimer):
+    '''
+    StageTimer of a chunk of events: the time of each stage is shared equally by the events of the chunk
+    '''
+    def __init__(self, metadata_list, enabled=True):
+        super().__init__({}, enabled)
+        self.metadata_list = metadata_list
+
+    def stage(self, name):
+        super().stage(name)
+        if not self.enabled: return
+        t = self.metadata["t_" + name] / max(len(self.metadata_list), 1)
+        for metadata in self.metadata_list:
+            metadata["t_" + name] = t
+
+
+class ColumnarWindowCreator(WindowCreator):
+    '''
+    WindowCreator working on chunks of events read with uproot: the windows of all the events of a chunk
+    are created with numpy operations on the flat arrays of the chunk (see get_windows_chunk).
+    '''
+
+    def iterate_chunks(self, inputfile, step_size=1000, entry_start=None, entry_stop=None):
+        '''
+        Generator of the awkward arrays of the needed branches of the input file,
+        in chunks of `step_size` events in the range of entries (entry_start, entry_stop)
+        '''
+        with uproot.open(inputfile) as f:
+            for chunk in f[CALOTREE].iterate(filter_name=self.branches, step_size=step_size,
+                                             entry_start=entry_start, entry_stop=entry_stop, library="ak"):
+                yield chunk
+
+    def get_windows(self, event, debug=False, dump_json=True):
+        '''
+        Windows of a single event with the branches as attributes, processed as a chunk of one event (no debug printouts)
+        '''
+        return self.get_windows_chunk(events_chunk([event], self.branches), dump_json=dump_json)[0]
+
+    def get_flat(self, chunk, name, dtype=None, depth=1):
+        '''
+        Flat numpy array of the values of a jagged branch of the chunk (None if the branch is not read).
+        Without dtype the type of the branch is kept (the values are converted to python as PyROOT does)
+        '''
+        if name not in self.branches:
+            return None
+        values = ak.flatten(chunk[name], axis=None) if depth > 1 else ak.flatten(chunk[name])
+        values = ak.to_numpy(values)
+        return values.astype(dtype) if dtype is not None else values
+
+    def get_windows_chunk(self, chunk, events_keys=None, dump_json=False):
+        '''
+        Returns the list of (windows, metadata) of each event of the chunk, as WindowCreator.get_windows
+        (json strings, or dictionaries if not dump_json).
+        If events_keys is given, the random generator is seeded for each event with `seed_event(*key)`.
+        '''
+        nev = len(chunk)
+        metadata_list = [ {
+            "n_windows_matched" : 0,
+            "n_windows_nomatched" : 0,
+            "n_seeds_good":0,
+            "n_seeds_bad_calo_position": 0,
+            "n_seeds_in_other_window": 0,
+        } for _ in range(nev) ]
+        timer = ChunkTimer(metadata_list, enabled=self.timing)
+        # Flat arrays of the branches, converted once
+        flat_cache = {}
+        def flat(name, dtype=None, depth=1):
+            if (name, dtype) not in flat_cache:
+                flat_cache[(name, dtype)] = self.get_flat(chunk, name, dtype, depth)
+            return flat_cache[(name, dtype)]
+
+        # Clusters of all the events: flat arrays with the event of each cluster and the start of each event
+        ncl = ak.to_numpy(ak.num(chunk.pfCluster_energy)).astype(np.int64)
+        ncalo = ak.to_numpy(ak.num(chunk.caloParticle_simEnergy)).astype(np.int64)
+        for iev, metadata in enumerate(metadata_list):
+            # Size of the event
+            metadata["n_pfclusters"] = int(ncl[iev])
+            metadata["n_caloparticles"] = int(ncalo[iev])
+        if ncl.sum() == 0:
+            # No clusters in the chunk: no windows
+            for stage in ["branches", "association", "seeding", "clusters", "aggregates", "json" if dump_json else "output"]:
+                timer.stage(stage)
+            return [ ([], metadata) for metadata in metadata_list ]
+        cl_start = offsets(ncl)
+        cl_event = np.repeat(np.arange(nev), ncl)
+        cl_local = local_index(ncl)
+        cl_energy = flat("pfCluster_energy", np.float64)
+        cl_rawen = flat("pfCluster_rawEnergy", np.float64)
+        cl_eta = flat("pfCluster_eta", np.float64)
+        cl_phi = flat("pfCluster_phi", np.float64)
+        cl_iz = flat("pfCluster_iz", np.int64)
+        cl_PU_simen = flat("pfCluster_simEnergy_sharedXtalsPU", np.float64)
+        cl_PU_recoen = flat("pfCluster_recoEnergy_sharedXtalsPU", np.float64)
+        # Same cosh of the python path (np.cosh can differ in the last digit)
+        cl_cosh = np.array(list(map(cosh, cl_eta.tolist())), dtype=np.float64)
+        cl_et_calib = cl_energy / cl_cosh
+        cl_et = cl_rawen / cl_cosh
+        # Signal simenergy of each (cluster, calo): flat array and start of each cluster
+        sig_simen = flat("pfCluster_simEnergy_sharedXtals", np.float64, depth=2)
+        cl_sig_start = offsets(ak.to_numpy(ak.flatten(ak.num(chunk.pfCluster_simEnergy_sharedXtals, axis=2))))
+        # Caloparticles
+        calo_start = offsets(ncalo)
+        # Superclusters (mustache): seed and list of clusters
+        nsc = ak.to_numpy(ak.num(chunk.superCluster_seedIndex)).astype(np.int64)
+        sc_start = offsets(nsc)
+        sc_event = np.repeat(np.arange(nev), nsc)
+        sc_seed = flat("superCluster_seedIndex", np.int64)
+        sc_ncls = ak.to_numpy(ak.flatten(ak.num(chunk.superCluster_pfClustersIndex, axis=2))).astype(np.int64)
+        sc_cls = flat("superCluster_pfClustersIndex", np.int64, depth=2)
+        timer.stage("branches")
+
+        # Association between clusters and calos of all the events (scores compared in double precision).
+        # Index of the main cluster (highest score) of each calo slot of the association (-1 if none)
+        cluster_calo, cluster_score, calo_clusters = calo_association.get_calo_association_chunk(
+                                        ak.values_astype(chunk["pfCluster_" + self.assoc_strategy], np.float64),
+                                        min_sim_fraction=self.cluster_min_fraction)
+        cl_calo = ak.to_numpy(ak.flatten(cluster_calo)).astype(np.int64)
+        cl_score = ak.to_numpy(ak.flatten(cluster_score)).astype(np.float64)
+        calo_slot_start = offsets(ak.to_numpy(ak.num(calo_clusters)).astype(np.int64))
+        calo_first = ak.to_numpy(ak.flatten(ak.fill_none(ak.firsts(calo_clusters, axis=2), -1))).astype(np.int64)
+        timer.stage("association")
+
+        # 1) Clusters ordered by Et in each event (stable: equal Et in the clusters order)
+        order = np.lexsort((-cl_et_calib, cl_event))
+        # 2) Seeds: clusters with Et >= min_et_seed in order of Et
+        seeds = order[cl_et_calib[order] >= self.min_et_seed]
+        if not self.overlapping_window and len(seeds):
+            # Non-overlapping mode: stop at the first candidate inside the window of a previous candidate of the event
+            cand_event = cl_event[seeds]
+            ncand = np.bincount(cand_event, minlength=nev)
+            cand_up, cand_down, cand_dphi = dynamic_window_array(cl_eta[seeds])
+            in_previous = np.zeros(len(seeds), dtype=bool)
+            for ia, ib in iter_pairs(cand_event, offsets(ncand), ncand):
+                ia, ib = ia[ib > ia], ib[ib > ia]
+                mask, _, _ = in_window_array(cl_eta[seeds[ia]], cl_phi[seeds[ia]], cl_iz[seeds[ia]],
+                                             cl_eta[seeds[ib]], cl_phi[seeds[ib]], cl_iz[seeds[ib]],
+                                             cand_up[ia], cand_down[ia], cand_dphi[ia])
+                in_previous[ib[mask]] = True
+            cand_local = local_index(ncand)
+            first = np.full(nev, np.iinfo(np.int64).max)
+            np.minimum.at(first, cand_event[in_previous], cand_local[in_previous])
+            seeds = seeds[cand_local < first[cand_event]]
+        seed_event = cl_event[seeds]
+
+        # Seeds with a signal calo with score > seed_min_fraction
+        seed_calo = cl_calo[seeds]
+        has_calo = (seed_calo != -1) & (cl_score[seeds] > self.seed_min_fraction)
+        seed_sig_simen = masked_take(sig_simen, cl_sig_start[seeds] + seed_calo, has_calo, 1.)
+        # The PU fraction is not checked on the seed
+        with np.errstate(divide="ignore", invalid="ignore"):
+            seed_PUfrac = np.where(has_calo, cl_PU_simen[seeds] / seed_sig_simen, -1.)
+        # The calo (GEN position) in the window of the seed is not required: in WindowCreator.get_windows
+        # the check is `if in_window(...)` on the returned (bool, (etaw, phiw)) tuple, which is always true
+        calo_matched = has_calo
+        seed_calo = np.where(calo_matched, seed_calo, -1)
+        # The seed is the main cluster of the calo
+        seed_calo_first = masked_take(calo_first, calo_slot_start[seed_event] + seed_calo, calo_matched, -1)
+        seed_caloseed = calo_matched & (seed_calo_first == cl_local[seeds])
+        n_seeds_good = np.bincount(seed_event[calo_matched], minlength=nev).tolist()
+        # Mustache seed index: first supercluster seeded by the cluster
+        no_sc = np.iinfo(np.int64).max
+        cl_mustache = np.full(len(cl_event), no_sc)
+        valid = (sc_seed >= 0) & (sc_seed < ncl[sc_event])
+        np.minimum.at(cl_mustache, cl_start[sc_event[valid]] + sc_seed[valid], local_index(nsc)[valid])
+        seed_mustache = np.where(cl_mustache[seeds] == no_sc, -1, cl_mustache[seeds])
+
+        # Random windows ids and sampling of the no calo-matched windows to keep: event by event,
+        # with the same random draws of WindowCreator.get_windows
+        nseeds = np.bincount(seed_event, minlength=nev).tolist()
+        calo_matched_list = calo_matched.tolist()
+        windex = []
+        keep = []
+        iseed = 0
+        for iev, metadata in enumerate(metadata_list):
+            if events_keys is not None:
+                self.seed_event(*events_keys[iev])
+            windows_calomatched, windows_nocalomatched = [], []
+            for iseed in range(iseed, iseed + nseeds[iev]):
+                windex.append("".join([ self.rng.choice(string.ascii_lowercase) for _ in range(9)]))
+                if calo_matched_list[iseed]:
+                    windows_calomatched.append(iseed)
+                else:
+                    windows_nocalomatched.append(iseed)
+            iseed = len(windex)
+            metadata["n_seeds_good"] = n_seeds_good[iev]
+            metadata["n_windows_matched"] = len(windows_calomatched)
+            metadata["n_windows_nomatched"] = len(windows_nocalomatched)
+            if len(windows_nocalomatched)> len(windows_calomatched):
+                keep += windows_calomatched + windows_nocalomatched[:len(windows_calomatched)] + \
+                        self.rng.sample(windows_nocalomatched[len(windows_calomatched):],
+                                        min(self.nocalowNmax, len(windows_nocalomatched) - len(windows_calomatched)))
+            else:
+                keep += windows_calomatched + windows_nocalomatched
+        # Windows kept, in the order of the seeds
+        keep = np.sort(np.array(keep, dtype=np.int64))
+        w_seed = seeds[keep]
+        w_event = seed_event[keep]
+        w_eta = cl_eta[w_seed]
+        w_phi = cl_phi[w_seed]
+        w_en = cl_rawen[w_seed]
+        w_et = cl_et[w_seed]
+        w_calo = seed_calo[keep]
+        w_matched = calo_matched[keep]
+        w_calo_first = seed_calo_first[keep]
+        w_mustache = seed_mustache[keep]
+        timer.stage("seeding")
+
+        # 3) Clusters of each window, in order of Et: all the (window, cluster) pairs of each event are tested
+        w_up, w_down, w_dphi = dynamic_window_array(w_eta)
+        p_w, p_cl, p_dphi = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+        for ia, ib in iter_pairs(w_event, cl_start, ncl):
+            icl = order[ib]
+            mask, _, phiw = in_window_array(w_eta[ia], w_phi[ia], cl_iz[w_seed[ia]], cl_eta[icl], cl_phi[icl], cl_iz[icl],
+                                            w_up[ia], w_down[ia], w_dphi[ia])
+            p_w.append(ia[mask])
+            p_cl.append(icl[mask])
+            p_dphi.append(phiw[mask])
+        p_w, p_cl, p_dphi = np.concatenate(p_w), np.concatenate(p_cl), np.concatenate(p_dphi)
+        p_seed_eta = w_eta[p_w]
+        p_eta = cl_eta[p_cl]
+        # Labels of the clusters in each window
+        p_in_geom_mustache = mustache.in_geom_mustache(p_seed_eta, w_phi[p_w], p_eta, cl_phi[p_cl], cl_rawen[p_cl])
+        p_calo = w_calo[p_w]
+        p_calo_matched = (p_calo != -1) & (cl_calo[p_cl] == p_calo)
+        p_sig_simen = masked_take(sig_simen, cl_sig_start[p_cl] + p_calo, p_calo_matched, 0.)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            p_PUfrac = np.where(p_calo_matched, cl_PU_simen[p_cl] / np.where(p_calo_matched, p_sig_simen, 1.), -1.)
+        # Clusters of the same calo of the seed passing the PU simenergy limit:
+        # simfraction thresholds by seed eta/Et and main cluster of the calo
+        p_pass_pu = p_calo_matched & (p_PUfrac < self.simenergy_pu_limit)
+        p_pass_simfrac = p_pass_pu & self.simfraction_thresholds.pass_threshold(p_seed_eta, w_et[p_w], cl_score[p_cl])
+        p_calo_seed = p_pass_pu & (w_calo_first[p_w] == cl_local[p_cl])
+        p_is_seed = p_cl == w_seed[p_w]
+        p_in_scluster = p_pass_simfrac | p_is_seed
+        # Clusters in the same (legacy) mustache of the seed: lookup of the (supercluster, cluster) keys
+        nkeys = int(ncl.max(initial=0)) + 1
+        sc_keys = np.repeat(np.arange(len(sc_ncls)), sc_ncls) * nkeys + sc_cls
+        sc_keys = sc_keys[(sc_cls >= 0) & (sc_cls < nkeys)]
+        p_mustache = w_mustache[p_w]
+        p_in_mustache = (p_mustache != -1) & np.isin((sc_start[w_event[p_w]] + p_mustache) * nkeys + cl_local[p_cl], sc_keys)
+        p_deta = np.where(p_seed_eta > 0, p_eta - p_seed_eta, p_seed_eta - p_eta)
+        p_den = w_en[p_w] - cl_rawen[p_cl]
+        p_det = w_et[p_w] - cl_et[p_cl]
+        timer.stage("clusters")
+
+        # 4) Window aggregates (see window_features.py): segmented reductions on the clusters of each window
+        quantities = {"en_cluster": cl_rawen[p_cl], "et_cluster": cl_et[p_cl], "cluster_deta": p_deta,
+                      "cluster_dphi": p_dphi, "cluster_den_seed": p_den, "cluster_det_seed": p_det,
+                      "calo_simen_PU": cl_PU_simen[p_cl],
+                      "calo_recoen_PU": cl_PU_recoen[p_cl] if cl_PU_recoen is not None else np.full(len(p_cl), np.nan),
+                      "calo_simen_sig": p_sig_simen}
+        values = np.stack([ quantities[q] for q in CLUSTER_QUANTITIES ])
+        w_ncls = np.bincount(p_w, minlength=len(w_seed))
+        w_start = offsets(w_ncls)
+        aggregates = {}
+        if len(w_seed):
+            w_matched_list = w_matched.tolist()
+            aggregates["nclusters_insc"] = np.where(w_matched, np.add.reduceat(p_in_scluster.astype(np.int64), w_start), 0).tolist()
+            insc_max = np.maximum.reduceat(np.where(p_in_scluster, values, -np.inf), w_start, axis=1)
+            for name, iq in INSC_FEATURES:
+                aggregates[name] = [ v if matched else -1 for v, matched in zip(insc_max[iq].tolist(), w_matched_list) ]
+            aggregates["ncls"] = w_ncls.tolist()
+            for prefix, reduced in [("max_", np.maximum.reduceat(values, w_start, axis=1)),
+                                    ("min_", np.minimum.reduceat(values, w_start, axis=1)),
+                                    ("mean_", segments_mean(values, w_start, w_ncls))]:
+                for name, iq in MINMAX_FEATURES:
+                    aggregates[prefix + name] = reduced[iq].tolist()
+            wtot = segments_cumsum(values[[ iq for _, iq in WTOT_FEATURES ]], w_start, w_ncls)
+            for (name, _), total in zip(WTOT_FEATURES, wtot):
+                aggregates[name] = total.tolist() if name not in self.missing_wtot else [None]*len(w_seed)
+        timer.stage("aggregates")
+
+        # 5) Conversion to python objects
+        # Window-independent features and hits of the clusters in at least one window
+        ucl = np.unique(p_cl)
+
+        def column(name, dtype=None, index=ucl):
+            values = flat(name, dtype)
+            return values[index].tolist() if values is not None else repeat(None)
+
+        cl_nhits = ak.to_numpy(ak.flatten(ak.num(chunk.pfClusterHit_rechitEnergy, axis=2)))
+        hit_count = cl_nhits[ucl]
+        hit_index = local_index(hit_count) + np.repeat(offsets(cl_nhits)[ucl], hit_count)
+        hit_energy = flat("pfClusterHit_rechitEnergy", np.float64, depth=2)[hit_index]
+        hit_fraction = flat("pfClusterHit_fraction", np.float64, depth=2)[hit_index]
+        hits = list(map(list, zip(flat("pfClusterHit_ieta", depth=2)[hit_index].tolist(),
+                                  flat("pfClusterHit_iphi", depth=2)[hit_index].tolist(),
+                                  flat("pfClusterHit_iz", depth=2)[hit_index].tolist(),
+                                  hit_energy.tolist(), (hit_energy * hit_fraction).tolist(), hit_fraction.tolist())))
+        hit_bounds = np.cumsum(hit_count).tolist()
+        cl_hits = dict(zip(ucl.tolist(), ( hits[h0:h1] for h0, h1 in zip([0] + hit_bounds[:-1], hit_bounds) )))
+        # Score of the associated calo (-1 if absent)
+        cl_calo_score = [ score if calo != -1 else -1 for score, calo in zip(cl_score.tolist(), cl_calo.tolist()) ]
+        columns = [cl_local[ucl].tolist()] + [repeat(None)]*6 + \
+                  [[ cl_calo_score[icl] for icl in ucl.tolist() ], repeat(None),
+                   column("pfCluster_simEnergy_sharedXtalsPU"), column("pfCluster_recoEnergy_sharedXtalsPU"),
+                   column("pfCluster_simPU_nSharedXtals"), repeat(None),
+                   column("pfCluster_ieta"), column("pfCluster_iphi"), column("pfCluster_eta"), column("pfCluster_phi"),
+                   repeat(None), column("pfCluster_iz"), column("pfCluster_rawEnergy"), cl_et[ucl].tolist(),
+                   column("pfCluster_energy"), cl_et_calib[ucl].tolist()] + \
+                  [ column(br) for _, br in NOISE_BRANCHES + SHAPES_BRANCHES ] + [cl_hits.values()]
+        clusters_cache = dict(zip(ucl.tolist(), ( dict(zip(CLUSTER_KEYS, values)) for values in zip(*columns) )))
+
+        windows_clusters = [ [] for _ in range(len(w_seed)) ]
+        for iw, icl, is_seed, in_geom_mustache, is_calo_matched, is_calo_seed, in_scluster, in_mustache, \
+                simen_sig, PUfrac, dphi, deta, den, det in zip(p_w.tolist(), p_cl.tolist(), p_is_seed.tolist(),
+                p_in_geom_mustache.tolist(), p_calo_matched.tolist(), p_calo_seed.tolist(), p_in_scluster.tolist(),
+                p_in_mustache.tolist(), p_sig_simen.tolist(), p_PUfrac.tolist(), p_dphi.tolist(), p_deta.tolist(),
+                p_den.tolist(), p_det.tolist()):
+            cevent = dict(clusters_cache[icl])
+            cevent["is_seed"] = is_seed
+            cevent["in_geom_mustache"] = in_geom_mustache
+            cevent["is_calo_matched"] = is_calo_matched
+            cevent["is_calo_seed"] = is_calo_seed
+            cevent["in_scluster"] = in_scluster
+            cevent["in_mustache"] = in_mustache
+            cevent["calo_simen_sig"] = simen_sig
+            cevent["cluster_PUfrac"] = PUfrac
+            cevent["cluster_dphi"] = dphi
+            cevent["cluster_deta"] = deta
+            cevent["cluster_den_seed"] = den
+            cevent["cluster_det_seed"] = det
+            windows_clusters[iw].append(cevent)
+
+        # Windows: values of the calo and of the mustache only for the matched windows (0 otherwise)
+        w_calo_g = calo_start[w_event] + w_calo
+        calo_columns = [ column(br, index=w_calo_g[w_matched]) for br in ["caloParticle_simEta", "caloParticle_simPhi",
+                         "caloParticle_genEta", "caloParticle_genPhi", "caloParticle_simEnergy",
+                         "caloParticle_genEnergy", "caloParticle_simEnergyGoodStatus"] ]
+        w_sc_g = (sc_start[w_event] + w_mustache)[w_mustache != -1]
+        sc_columns = [ column(br, index=w_sc_g) for br in ["superCluster_rawEnergy", "superCluster_energy", "superCluster_eta"] ]
+        calo_values = iter(zip(*calo_columns))
+        sc_values = iter(zip(*sc_columns))
+        scalars = { br: ak.to_list(chunk[br]) if br in self.branches else [None]*nev for br in SCALAR_BRANCHES }
+        seed_columns = zip(*([w_seed.tolist(), [ windex[i] for i in keep.tolist() ], w_event.tolist(), w_matched.tolist(),
+                              w_calo.tolist(), seed_caloseed[keep].tolist(), w_mustache.tolist(),
+                              [ cl_calo_score[icl] for icl in w_seed.tolist() ], seed_sig_simen[keep].tolist(),
+                              column("pfCluster_simEnergy_sharedXtalsPU", index=w_seed),
+                              column("pfCluster_recoEnergy_sharedXtalsPU", index=w_seed), seed_PUfrac[keep].tolist(),
+                              column("pfCluster_eta", index=w_seed), column("pfCluster_phi", index=w_seed),
+                              column("pfCluster_iz", index=w_seed), column("pfCluster_ieta", index=w_seed),
+                              column("pfCluster_iphi", index=w_seed), column("pfCluster_rawEnergy", index=w_seed),
+                              w_et.tolist(), column("pfCluster_energy", index=w_seed), cl_et_calib[w_seed].tolist()] +
+                             [ column(br, index=w_seed) for _, br in SHAPES_BRANCHES ]))
+        output = [ [] for _ in range(nev) ]
+        for iw, (icl, window_index, iev, calomatched, caloid, caloseed, mustache_seed_index, seed_score, seed_simen_sig,
+                 seed_simen_PU, seed_recoen_PU, seed_PUfrac_w, cl_eta_w, cl_phi_w, cl_iz_w, cl_ieta_w, cl_iphi_w,
+                 en_seed, et_seed, en_seed_calib, et_seed_calib, *seed_shapes) in enumerate(seed_columns):
+            if calomatched:
+                simeta, simphi, geneta, genphi, simenergy, genenergy, simenergy_good = next(calo_values)
+                gencosh = cosh(geneta)
+                calo_window = [simeta, simphi, geneta, genphi, simenergy, simenergy/gencosh, genenergy, genenergy/gencosh,
+                               simenergy_good, simenergy_good/gencosh]
+            else:
+                calo_window = [0]*10
+            if mustache_seed_index != -1:
+                rawen, calib_en, sc_eta = next(sc_values)
+                mustache_window = [rawen, rawen/cosh(sc_eta), calib_en, calib_en/cosh(sc_eta)]
+            else:
+                mustache_window = [0]*4
+            window = {
+                "window_index": window_index,
+                "is_seed_calo_matched": calomatched,
+                "calo_index": caloid,
+                "is_seed_calo_seed": caloseed,
+                "is_seed_mustache_matched": mustache_seed_index != -1,
+                "mustache_seed_index": mustache_seed_index,
+                "seed_score": seed_score,
+                "seed_simen_sig": seed_simen_sig if calomatched else 0.,
+                "seed_simen_PU": seed_simen_PU,
+                "seed_recoen_PU": seed_recoen_PU,
+                "seed_PUfrac": seed_PUfrac_w,
+                "seed_eta": cl_eta_w,
+                "seed_phi": cl_phi_w,
+                "seed_iz": cl_iz_w,
+                "seed_ieta": cl_ieta_w,
+                "seed_iphi": cl_iphi_w,
+            }
+            window.update(zip(["sim_true_eta", "sim_true_phi", "gen_true_eta", "gen_true_phi"], calo_window[:4]))
+            window["en_seed"] = en_seed
+            window["et_seed"] = et_seed
+            window["en_seed_calib"] = en_seed_calib
+            window["et_seed_calib"] = et_seed_calib
+            window.update(zip(["en_true_sim", "et_true_sim", "en_true_gen", "et_true_gen", "en_true_sim_good",
+                               "et_true_sim_good"], calo_window[4:]))
+            window.update(zip(["en_mustache_raw", "et_mustache_raw", "en_mustache_calib", "et_mustache_calib"],
+                              mustache_window))
+            window["nVtx"] = scalars["nVtx"][iev]
+            window["rho"] = scalars["rho"][iev]
+            window["obsPU"] = scalars["obsPU"][iev]
+            window["truePU"] = scalars["truePU"][iev]
+            window["event_tot_simen_PU"] = scalars["caloParticlePU_totEnergy"][iev]
+            window.update(zip([ "seed_" + name for name, _ in SHAPES_BRANCHES ], seed_shapes))
+            window["seed_hits"] = cl_hits[icl]
+            window["clusters"] = windows_clusters[iw]
+            for name, values in aggregates.items():
+                window[name] = values[iw]
+            output[iev].append(json.dumps(window) if dump_json else window)
+        timer.stage("json" if dump_json else "output")
+        return list(zip(output, metadata_list))
@@ -1,16 +1,19 @@
 from __future__ import print_function
-from math import pi, sqrt, cosh
+from math import pi, sqrt, cosh, floor
 import random
 import string
 from collections import OrderedDict, defaultdict
 from operator import itemgetter, attrgetter
+from itertools import chain
 import calo_association
 import random
 from pprint import pprint
 import json
+from time import perf_counter
 import numpy as np
-import ROOT as R
-R.gROOT.ProcessLine(".L Mustache.C+")
+import mustache
+from simfraction_thresholds import SimfractionThresholds
+from window_features import get_cluster_quantities, get_window_aggregates, WTOT_FEATURES
 
 '''
 This script extracts the windows and associated clusters from events
@@ -20,6 +23,103 @@ All windows are created:  seeds inside other windows creates their window
 '''
 
 
+# Branches of the dumper caloTree always read by get_windows
+# (the association strategy branch is added by the creator)
+BRANCHES = [
+    "pfCluster_energy", "pfCluster_rawEnergy", "pfCluster_eta", "pfCluster_phi",
+    "pfCluster_ieta", "pfCluster_iphi", "pfCluster_iz",
+    "caloParticle_simEnergy", "caloParticle_simEnergyGoodStatus", "caloParticle_genEnergy",
+    "caloParticle_simEta", "caloParticle_simPhi", "caloParticle_genEta", "caloParticle_genPhi", "caloParticle_simIz",
+    "pfClusterHit_rechitEnergy", "pfClusterHit_fraction",
+    "pfClusterHit_ieta", "pfClusterHit_iphi", "pfClusterHit_iz",
+    "pfCluster_simEnergy_sharedXtalsPU", "pfCluster_simEnergy_sharedXtals",
+    "superCluster_seedIndex", "superCluster_rawEnergy", "superCluster_energy",
+    "superCluster_eta", "superCluster_pfClustersIndex",
+]
+
+# Branches read only for some output features (feature: branches)
+FEATURES_BRANCHES = {
+    "noise_en": ["pfCluster_noise"],
+    "noise_en_uncal": ["pfCluster_noiseUncalib"],
+    "noise_en_nofrac": ["pfCluster_noiseNoFractions"],
+    "noise_en_uncal_nofrac": ["pfCluster_noiseUncalibNoFractions"],
+    "calo_nxtals_PU": ["pfCluster_simPU_nSharedXtals"],
+    "calo_recoen_PU": ["pfCluster_recoEnergy_sharedXtalsPU"],
+    "seed_recoen_PU": ["pfCluster_recoEnergy_sharedXtalsPU"],
+    "wtot_recoen_PU": ["pfCluster_recoEnergy_sharedXtalsPU"],
+    "event_tot_simen_PU": ["caloParticlePU_totEnergy"],
+    "nVtx": ["nVtx"], "rho": ["rho"], "obsPU": ["obsPU"], "truePU": ["truePU"],
+}
+# Shower shapes of the clusters and of the seed
+for feature, branch in [("f5_r9", "full5x5_r9"), ("f5_sigmaIetaIeta", "full5x5_sigmaIetaIeta"),
+                        ("f5_sigmaIetaIphi", "full5x5_sigmaIetaIphi"), ("f5_sigmaIphiIphi", "full5x5_sigmaIphiIphi"),
+                        ("f5_swissCross", "full5x5_swissCross"), ("r9", "r9"), ("sigmaIetaIeta", "sigmaIetaIeta"),
+                        ("sigmaIetaIphi", "sigmaIetaIphi"), ("sigmaIphiIphi", "sigmaIphiIphi"),
+                        ("swissCross", "swissCross"), ("nxtals", "nXtals"), ("etaWidth", "etaWidth"),
+                        ("phiWidth", "phiWidth")]:
+    FEATURES_BRANCHES["cl_" + feature] = ["pfCluster_" + branch]
+    FEATURES_BRANCHES["seed_" + feature] = ["pfCluster_" + branch]
+
+# Branches with one value per event
+SCALAR_BRANCHES = ["nVtx", "rho", "obsPU", "truePU", "caloParticlePU_totEnergy"]
+
+
+def get_branches(assoc_strategy="sim_fraction", features_dict=None):
+    '''
+    Minimal list of branches needed to create the windows with the association strategy.
+    If the features definition dictionary is given, only the optional branches of the features 
+    in the definition are included (otherwise the branches of all the features).
+    '''
+    if features_dict is None:
+        features = FEATURES_BRANCHES.keys()
+    else:
+        features = [ f for group, names in features_dict.items() if group != "hits_indices" for f in names ]
+    branches = BRANCHES + ["pfCluster_" + assoc_strategy]
+    for feature in features:
+        for branch in FEATURES_BRANCHES.get(feature, []):
+            if branch not in branches:
+                branches.append(branch)
+    return branches
+
+
+def enable_branches(tree, branches):
+    '''
+    Disable all the branches of the TTree except the given ones, 
+    so that only the baskets of the needed branches are read and decompressed by GetEntry
+    '''
+    tree.SetBranchStatus("*", 0)
+    for branch in branches:
+        tree.SetBranchStatus(branch, 1)
+
+
+class StageTimer():
+    '''
+    Time spent in each stage of the windows creation, saved in the event metadata as t_{stage} (seconds).
+    If not enabled nothing is measured.
+    '''
+    def __init__(self, metadata, enabled=True):
+        self.metadata = metadata
+        self.enabled = enabled
+        self.last = perf_counter() if enabled else None
+
+    def stage(self, name):
+        '''
+        Closes the stage started at the end of the previous one
+        '''
+        if not self.enabled: return
+        now = perf_counter()
+        self.metadata["t_" + name] = now - self.last
+        self.last = now
+
+
+class MissingBranch():
+    '''
+    Placeholder of a branch not read because not needed by the features definition: all the values are None
+    '''
+    def __getitem__(self, index):
+        return None
+
+
 def DeltaR(phi1, eta1, phi2, eta2):
     dphi = phi1 - phi2
     if dphi > pi: dphi -= 2*pi
@@ -39,11 +139,7 @@ def is_in_geom_mustache(seed_eta, seed_phi, cl_eta, cl_phi, cl_en ):
     This functions associates a cluster as true matched only if it is in the mustache
     and if it passes a threshold in simfraction
     '''
-    is_in_mustache = False 
-    if R.inMustache(seed_eta, seed_phi, cl_en,cl_eta,cl_phi):
-        if R.inDynamicDPhiWindow(seed_eta, seed_phi, cl_en, cl_eta, cl_phi):
-            is_in_mustache = True
-    return is_in_mustache
+    return bool(mustache.in_geom_mustache(seed_eta, seed_phi, cl_eta, cl_phi, cl_en))
 
 # Check if a xtal is in the window
 def in_window(seed_eta, seed_phi, seed_iz, eta, phi, iz, window_deta_up, windows_deta_down, window_dphi):
@@ -73,29 +169,98 @@ def get_cluster_hits(pfclhit_ieta,pfclhit_iphi,pfclhit_iz,pfclhit_energy, pfclhi
     return data
 
 
+class SpatialIndex():
+    '''
+    Per-event index of objects bucketed by (iz, eta bin, phi bin).
+    The window membership is then tested only on the objects in the buckets
+    overlapping the window, instead of all the (window, cluster) pairs.
+    The buckets overlapping a window are a superset of the window: the exact
+    check is always done with `in_window`.
+    '''
+    # Margin on the window edges to be safe against rounding
+    margin = 1e-6
+
+    def __init__(self, eta_size=0.2, nphi=18):
+        self.eta_size = eta_size
+        self.nphi = nphi
+        self.phi_size = 2*pi / nphi
+        self.buckets = defaultdict(list)
+
+    def key(self, eta, phi, iz):
+        return (iz, int(floor(eta / self.eta_size)), int(floor((phi + pi) / self.phi_size)) % self.nphi)
+
+    def window_keys(self, seed_eta, seed_phi, seed_iz, deta_up, deta_down, dphi):
+        # The deta of the window is flipped for negative eta seeds
+        if seed_eta < 0:
+            eta_min, eta_max = seed_eta - deta_up, seed_eta - deta_down
+        else:
+            eta_min, eta_max = seed_eta + deta_down, seed_eta + deta_up
+        ietas = range(int(floor((eta_min - self.margin) / self.eta_size)),
+                      int(floor((eta_max + self.margin) / self.eta_size)) + 1)
+        iphi_min = int(floor((seed_phi - dphi - self.margin + pi) / self.phi_size))
+        iphi_max = int(floor((seed_phi + dphi + self.margin + pi) / self.phi_size))
+        if iphi_max - iphi_min + 1 >= self.nphi:
+            iphis = range(self.nphi)
+        else:
+            # wrap-around in phi
+            iphis = [ iphi % self.nphi for iphi in range(iphi_min, iphi_max + 1) ]
+        return [ (seed_iz, ieta, iphi) for ieta in ietas for iphi in iphis ]
+
+    def add(self, key, item):
+        self.buckets[key].append(item)
+
+    def get(self, keys):
+        # The keys are unique, so an object added once is returned at most once
+        return list(chain.from_iterable(self.buckets.get(key, []) for key in keys))
+
+
 class WindowCreator():
 
     def __init__(self, simfraction_thresholds,  seed_min_fraction=1e-2, cl_min_fraction=1e-4, simenergy_pu_limit = 1.5,
-                 min_et_seed=1., assoc_strategy="sim_fraction", overlapping_window=False,  nocalowNmax=0):
+                 min_et_seed=1., assoc_strategy="sim_fraction", overlapping_window=False,  nocalowNmax=0, random_seed=None,
+                 features_dict=None, timing=False):
         self.seed_min_fraction = seed_min_fraction
         self.cluster_min_fraction = cl_min_fraction
+        # The WP TH2 is converted once in a numpy table
+        if not isinstance(simfraction_thresholds, SimfractionThresholds):
+            simfraction_thresholds = SimfractionThresholds.from_TH2(simfraction_thresholds)
         self.simfraction_thresholds = simfraction_thresholds
         self.simenergy_pu_limit = simenergy_pu_limit
         self.min_et_seed=min_et_seed
         self.assoc_strategy = assoc_strategy
         self.overlapping_window = overlapping_window
         self.nocalowNmax = nocalowNmax
+        # Random generator of the windows ids and of the sampling of the no calo-matched windows to keep
+        self.rng = random.Random(random_seed)
+        # Branches to read: the optional ones only for the features in the definition (if given)
+        self.branches = get_branches(assoc_strategy, features_dict)
+        # Window sums of cluster quantities whose branch is not read: saved as None like the cluster quantities
+        self.missing_wtot = [ name for name, _ in WTOT_FEATURES
+                              if any(br not in self.branches for br in FEATURES_BRANCHES.get(name, [])) ]
+        # Save the time spent in each stage of get_windows in the event metadata
+        self.timing = timing
+
+    def seed_event(self, *key):
+        '''
+        Seed the random generator (windows ids and sampling) from a key identifying the event,
+        e.g. (seed, input file, entry), so that the output does not depend on how the events are split in jobs
+        '''
+        self.rng.seed(":".join(str(k) for k in key))
+
+    def get_branch(self, event, name):
+        '''
+        Branch of the event, or a placeholder of None values if the branch is not read
+        '''
+        if name not in self.branches:
+            return None if name in SCALAR_BRANCHES else MissingBranch()
+        return getattr(event, name)
 
 
     def pass_simfraction_threshold(self, seed_eta, seed_et, cluster_calo_score ):
         '''
         This functions associates a cluster as true matched if it passes a threshold in simfraction
         '''
-        iX = min(max(1,self.simfraction_thresholds.GetXaxis().FindBin(seed_et)      ), self.simfraction_thresholds.GetNbinsX())
-        iY = min(max(1,self.simfraction_thresholds.GetYaxis().FindBin(abs(seed_eta))), self.simfraction_thresholds.GetNbinsY())
-        thre = self.simfraction_thresholds.GetBinContent(iX,iY)
-        #print(seed_eta, seed_et, cluster_calo_score, thre, cluster_calo_score >= thre )
-        return cluster_calo_score >= thre
+        return bool(self.simfraction_thresholds.pass_threshold(seed_eta, seed_et, cluster_calo_score))
 
     def dynamic_window(self,eta, version=2):
         aeta = abs(eta)
@@ -139,7 +304,74 @@ class WindowCreator():
             return deta_up, deta_down, dphi
 
 
-    def get_windows(self, event, debug=False):
+    def get_seeds(self, clenergies_ordered, pfCluster_eta, pfCluster_phi, pfCluster_iz, debug=False):
+        '''
+        Returns the list of clusters creating a window, in order of Et.
+        In non-overlapping mode the search stops at the first cluster already inside
+        the window of a more energetic seed.
+        '''
+        seeds = []
+        # Index of the windows already created, by the buckets they overlap
+        windows_index = SpatialIndex()
+        for icl, clenergy_T in clenergies_ordered:
+            # No seeds with Et< min_et_seed GeV
+            if clenergy_T < self.min_et_seed: continue
+
+            cl_eta = pfCluster_eta[icl]
+            cl_phi = pfCluster_phi[icl]
+            cl_iz =  pfCluster_iz[icl]
+
+            is_in_window = False
+            # Check if it is already in one windows: only the windows overlapping the cluster bucket are tested
+            for iseed, seed_window in windows_index.get([windows_index.key(cl_eta, cl_phi, cl_iz)]):
+                is_in_this_window, (etaw, phiw) = in_window(pfCluster_eta[iseed], pfCluster_phi[iseed], pfCluster_iz[iseed],
+                                                    cl_eta, cl_phi, cl_iz, *seed_window)
+                if is_in_this_window:
+                    is_in_window = True
+                    if debug: print("Cluster {} already in window of seed {}! skipping window".format(icl, iseed))
+                    break
+
+            if not self.overlapping_window and is_in_window:
+                # If we are in non-overlapping mode
+                # Create new window ONLY IF THE CLUSTER IS NOT ALREADY IN ANOTHER WINDOW
+                break
+            seeds.append(icl)
+            seed_window = self.dynamic_window(cl_eta)
+            for key in windows_index.window_keys(cl_eta, cl_phi, cl_iz, *seed_window):
+                windows_index.add(key, (icl, seed_window))
+        return seeds
+
+
+    def get_windows_clusters(self, windows_seeds, clenergies_ordered, pfCluster_eta, pfCluster_phi, pfCluster_iz):
+        '''
+        For each window seed (eta, phi, iz) returns the list of (icl, etaw, phiw)
+        of the clusters inside the window, ordered by cluster Et.
+        '''
+        # Index of the clusters by their (iz, eta, phi) bucket.
+        # The position in the Et ordering is saved to keep the clusters ordered in the window
+        clusters_index = SpatialIndex()
+        for iorder, (icl, clenergy_T) in enumerate(clenergies_ordered):
+            clusters_index.add(clusters_index.key(pfCluster_eta[icl], pfCluster_phi[icl], pfCluster_iz[icl]), (iorder, icl))
+
+        output = []
+        for seed in windows_seeds:
+            seed_window = self.dynamic_window(seed[0])
+            clusters = []
+            # Test only the clusters in the buckets overlapping the window
+            for iorder, icl in sorted(clusters_index.get(clusters_index.window_keys(*seed, *seed_window))):
+                isin, (etaw, phiw) = in_window(*seed, pfCluster_eta[icl], pfCluster_phi[icl], pfCluster_iz[icl],
+                                                *seed_window)
+                if isin:
+                    clusters.append((icl, etaw, phiw))
+            output.append(clusters)
+        return output
+
+
+    def get_windows(self, event, debug=False, dump_json=True):
+        '''
+        Returns the list of windows of the event (json strings, or dictionaries if not dump_json)
+        and the event metadata
+        '''
         # Metadata for debugging
         metadata = {
             "n_windows_matched" : 0,
@@ -148,6 +380,7 @@ class WindowCreator():
             "n_seeds_bad_calo_position": 0,
             "n_seeds_in_other_window": 0,
         }
+        timer = StageTimer(metadata, enabled=self.timing)
         # Branches
         pfCluster_energy = event.pfCluster_energy
         pfCluster_rawEnergy = event.pfCluster_rawEnergy
@@ -156,10 +389,10 @@ class WindowCreator():
         pfCluster_ieta = event.pfCluster_ieta
         pfCluster_iphi = event.pfCluster_iphi
         pfCluster_iz = event.pfCluster_iz
-        pfCluster_noise = event.pfCluster_noise
-        pfCluster_noise_uncalib  = event.pfCluster_noiseUncalib
-        pfCluster_noise_nofrac = event.pfCluster_noiseNoFractions
-        pfCluster_noise_uncalib_uncalib = event.pfCluster_noiseUncalibNoFractions
+        pfCluster_noise = self.get_branch(event, "pfCluster_noise")
+        pfCluster_noise_uncalib  = self.get_branch(event, "pfCluster_noiseUncalib")
+        pfCluster_noise_nofrac = self.get_branch(event, "pfCluster_noiseNoFractions")
+        pfCluster_noise_uncalib_uncalib = self.get_branch(event, "pfCluster_noiseUncalibNoFractions")
         calo_simenergy = event.caloParticle_simEnergy
         calo_simenergy_goodstatus = event.caloParticle_simEnergyGoodStatus
         calo_genenergy = event.caloParticle_genEnergy
@@ -171,32 +404,36 @@ class WindowCreator():
         # calo_geniz = event.caloParticle_genIz
         # calo_isPU = event.caloParticle_isPU
         # calo_isOOTPU = event.caloParticle_isOOTPU
-        pfcl_f5_r9 = event.pfCluster_full5x5_r9
-        pfcl_f5_sigmaIetaIeta = event.pfCluster_full5x5_sigmaIetaIeta
-        pfcl_f5_sigmaIetaIphi = event.pfCluster_full5x5_sigmaIetaIphi
-        pfcl_f5_sigmaIphiIphi = event.pfCluster_full5x5_sigmaIphiIphi
-        pfcl_f5_swissCross = event.pfCluster_full5x5_swissCross
-        pfcl_r9 = event.pfCluster_r9
-        pfcl_sigmaIetaIeta = event.pfCluster_sigmaIetaIeta
-        pfcl_sigmaIetaIphi = event.pfCluster_sigmaIetaIphi
-        pfcl_sigmaIphiIphi = event.pfCluster_sigmaIphiIphi
-        pfcl_swissCross = event.pfCluster_swissCross
-        pfcl_nxtals = event.pfCluster_nXtals
-        pfcl_etaWidth = event.pfCluster_etaWidth
-        pfcl_phiWidth = event.pfCluster_phiWidth
+        pfcl_f5_r9 = self.get_branch(event, "pfCluster_full5x5_r9")
+        pfcl_f5_sigmaIetaIeta = self.get_branch(event, "pfCluster_full5x5_sigmaIetaIeta")
+        pfcl_f5_sigmaIetaIphi = self.get_branch(event, "pfCluster_full5x5_sigmaIetaIphi")
+        pfcl_f5_sigmaIphiIphi = self.get_branch(event, "pfCluster_full5x5_sigmaIphiIphi")
+        pfcl_f5_swissCross = self.get_branch(event, "pfCluster_full5x5_swissCross")
+        pfcl_r9 = self.get_branch(event, "pfCluster_r9")
+        pfcl_sigmaIetaIeta = self.get_branch(event, "pfCluster_sigmaIetaIeta")
+        pfcl_sigmaIetaIphi = self.get_branch(event, "pfCluster_sigmaIetaIphi")
+        pfcl_sigmaIphiIphi = self.get_branch(event, "pfCluster_sigmaIphiIphi")
+        pfcl_swissCross = self.get_branch(event, "pfCluster_swissCross")
+        pfcl_nxtals = self.get_branch(event, "pfCluster_nXtals")
+        pfcl_etaWidth = self.get_branch(event, "pfCluster_etaWidth")
+        pfcl_phiWidth = self.get_branch(event, "pfCluster_phiWidth")
         pfclhit_energy = event.pfClusterHit_rechitEnergy
         pfclhit_fraction = event.pfClusterHit_fraction
         pfclhit_ieta = event.pfClusterHit_ieta
         pfclhit_iphi = event.pfClusterHit_iphi
         pfclhit_iz = event.pfClusterHit_iz
-        nVtx = event.nVtx
-        rho = event.rho
-        obsPU = event.obsPU
-        truePU = event.truePU
+        nVtx = self.get_branch(event, "nVtx")
+        rho = self.get_branch(event, "rho")
+        obsPU = self.get_branch(event, "obsPU")
+        truePU = self.get_branch(event, "truePU")
         # pfclhit_eta = event.pfClusterHit_eta
         # pfclhit_phi = event.pfClusterHit_phi
 
         clusters_scores = getattr(event, "pfCluster_"+self.assoc_strategy)
+        # Size of the event
+        metadata["n_pfclusters"] = len(pfCluster_energy)
+        metadata["n_caloparticles"] = len(calo_simenergy)
+        timer.stage("branches")
         # Get Association between pfcluster and calo
         # Sort the clusters for each calo in order of score. 
         # # This is needed to understand which cluster is the seed of the calo
@@ -204,11 +441,11 @@ class WindowCreator():
         pfcluster_calo_map, pfcluster_calo_score, calo_pfcluster_map = \
                                 calo_association.get_calo_association(clusters_scores, sort_calo_cl=True, debug=False, min_sim_fraction=self.cluster_min_fraction)
         # CaloParticle Pileup information
-        cluster_nXtalsPU = event.pfCluster_simPU_nSharedXtals 
+        cluster_nXtalsPU = self.get_branch(event, "pfCluster_simPU_nSharedXtals") 
         cluster_PU_simenergy = event.pfCluster_simEnergy_sharedXtalsPU
         cluster_signal_simenergy = event.pfCluster_simEnergy_sharedXtals
-        cluster_PU_recoenergy = event.pfCluster_recoEnergy_sharedXtalsPU
-        total_PU_simenergy = event.caloParticlePU_totEnergy
+        cluster_PU_recoenergy = self.get_branch(event, "pfCluster_recoEnergy_sharedXtalsPU")
+        total_PU_simenergy = self.get_branch(event, "caloParticlePU_totEnergy")
 
         # #total PU simenergy in all clusters in the event
         # total_PU_simenergy = sum([simPU for cl, simPU in cluster_PU_simenergy.items()])
@@ -226,6 +463,8 @@ class WindowCreator():
                     print("\t> cl: {}, Et: {:.2f}, eta: {:.2f}, phi:{:.2f}, score: {:.4f}, simEnPU: {:.3f}".format(cl,pfCluster_rawEnergy[cl]/ cosh(pfCluster_eta[cl]), pfCluster_eta[cl],pfCluster_phi[cl], sc,cluster_PU_simenergy[cl]))
             print()
 
+        timer.stage("association")
+
         #Mustache info
         mustacheseed_pfcls = [s for s in event.superCluster_seedIndex]
         mustache_rawEn = event.superCluster_rawEnergy
@@ -245,168 +484,168 @@ class WindowCreator():
                                 )], key=itemgetter(1), reverse=True)
 
         if debug: print(">> Windows formation")
-        # Now iterate over clusters in order of energies
-        for icl, clenergy_T in clenergies_ordered:
-            #print(icl, clenergy_T)
-
-            # No seeds with Et< min_et_seed GeV
-            if clenergy_T < self.min_et_seed: continue
-
+        # Now iterate over the seeds in order of energies
+        for icl in self.get_seeds(clenergies_ordered, pfCluster_eta, pfCluster_phi, pfCluster_iz, debug=debug):
             cl_eta = pfCluster_eta[icl]
             cl_phi = pfCluster_phi[icl]
             cl_ieta = pfCluster_ieta[icl]
             cl_iphi = pfCluster_iphi[icl]
             cl_iz =  pfCluster_iz[icl]
 
-            is_in_window = False
-            # Check if it is already in one windows
-            for window in windows_map.values():
-                is_in_this_window, (etaw, phiw) = in_window(*window["seed"], cl_eta, cl_phi, cl_iz, 
-                                                    *self.dynamic_window(window["seed"][0])) 
-                if is_in_this_window:
-                    is_in_window = True
-                    if debug: print("Cluster {} already in window {}! skipping window".format(icl, window["window_index"]))
-                    break
-
-                
-            if not self.overlapping_window and is_in_window:
-                # If we are in non-overlapping mode 
-                # Create new window ONLY IF THE CLUSTER IS NOT ALREADY IN ANOTHER WINDOW
-                break
-            else:
-                # - Check if the seed simFraction with the signal calo is at least seed_min_fraction
-                # - Check if the seed is associated with a calo in the window: calomatched 
-                # - Check if the seed is the main cluster of the calo:  caloseed
-                # It is required to have seed_min_fraction% of the calo energy and to be "in the window" of the seed
-                if pfcluster_calo_map[icl] !=-1 and pfcluster_calo_score[icl] > self.seed_min_fraction:
-                    # ID of the associated caloparticle
-                    caloid = pfcluster_calo_map[icl] 
-                    # Do not check PU fraction on the seed
-                    PU_simenfrac = cluster_PU_simenergy[icl] / cluster_signal_simenergy[icl][caloid]
-                    #Check if the caloparticle is in the same window with GEN info
-                    if in_window(calo_geneta[caloid],calo_genphi[caloid],calo_simiz[caloid], cl_eta, cl_phi, cl_iz, 
-                                                    *self.dynamic_window(cl_eta)):
-                        calomatched = caloid
-                        metadata["n_seeds_good"] +=1
-                        # Now check if the seed cluster is the main cluster of the calo
-                        if calo_pfcluster_map[caloid][0][0] == icl:
-                            caloseed = True
-                        else:
-                            caloseed =False
-                        if debug: 
-                            print("Seed-to-calo: cluster: {}, calo: {}, seed_eta: {:.3f}, calo_genEta : {:.3f}, seed_score: {:.5f}, is caloseed: {}".format(
-                                                icl,caloid,cl_eta,calo_geneta[caloid], pfcluster_calo_score[icl], caloseed))
+            # - Check if the seed simFraction with the signal calo is at least seed_min_fraction
+            # - Check if the seed is associated with a calo in the window: calomatched 
+            # - Check if the seed is the main cluster of the calo:  caloseed
+            # It is required to have seed_min_fraction% of the calo energy and to be "in the window" of the seed
+            if pfcluster_calo_map[icl] !=-1 and pfcluster_calo_score[icl] > self.seed_min_fraction:
+                # ID of the associated caloparticle
+                caloid = pfcluster_calo_map[icl] 
+                # Do not check PU fraction on the seed
+                PU_simenfrac = cluster_PU_simenergy[icl] / cluster_signal_simenergy[icl][caloid]
+                #Check if the caloparticle is in the same window with GEN info
+                if in_window(calo_geneta[caloid],calo_genphi[caloid],calo_simiz[caloid], cl_eta, cl_phi, cl_iz, 
+                                                *self.dynamic_window(cl_eta)):
+                    calomatched = caloid
+                    metadata["n_seeds_good"] +=1
+                    # Now check if the seed cluster is the main cluster of the calo
+                    if calo_pfcluster_map[caloid][0][0] == icl:
+                        caloseed = True
                     else:
-                        metadata["n_seeds_bad_calo_position"] +=1
-                        calomatched = -1
-                        caloseed = False
-                        if debug: 
-                            print("Seed-to-calo [Failed window cut]: cluster: {}, calo: {}, seed_eta: {:.3f}, calo_eta : {:.3f}, seed_score: {:.5f}, is caloseed: {}".format(
-                                                icl, caloid,cl_eta,calo_geneta[caloid], pfcluster_calo_score[icl], caloseed))
-                
+                        caloseed =False
+                    if debug: 
+                        print("Seed-to-calo: cluster: {}, calo: {}, seed_eta: {:.3f}, calo_genEta : {:.3f}, seed_score: {:.5f}, is caloseed: {}".format(
+                                            icl,caloid,cl_eta,calo_geneta[caloid], pfcluster_calo_score[icl], caloseed))
                 else:
-                    metadata["n_windows_nomatched"] += 1
-                    calomatched = -1 
+                    metadata["n_seeds_bad_calo_position"] +=1
+                    calomatched = -1
                     caloseed = False
-                    PU_simenfrac = -1.
-
-                # Save the cluster in the list of associated clusters
-                seed_clusters.append(icl)
-                # Check if it is a mustache seed
-                if icl in mustacheseed_pfcls:
-                    mustache_seed_index = mustacheseed_pfcls.index(icl)
-                else:
-                    mustache_seed_index = -1
-
-                # Create a unique index
-                windex = "".join([ random.choice(string.ascii_lowercase) for _ in range(9)])
-                # Let's create  new window:
-                new_window = {
-                    "window_index": windex,
-                    "seed_index": icl,
-                    "seed": (cl_eta, cl_phi, cl_iz),
-                    # The seed of the window is associated with a caloparticle in the window
-                    "is_seed_calo_matched": calomatched != -1,
-                    # index of the associated caloparticle
-                    "calo_index": calomatched,
-                    # The seed is the cluster associated with the particle with the largest fraction
-                    "is_seed_calo_seed": caloseed,
-                    # Mustache info
-                    "is_seed_mustache_matched": mustache_seed_index != -1,
-                    "mustache_seed_index": mustache_seed_index,
-                    
-                    # Score of the seed cluster
-                    "seed_score": pfcluster_calo_score[icl],
-                    "seed_simen_sig": cluster_signal_simenergy[icl][calomatched] if calomatched!=-1 else 0.,
-                    "seed_simen_PU":  cluster_PU_simenergy[icl],
-                    "seed_recoen_PU":  cluster_PU_recoenergy[icl],
-                    "seed_PUfrac" : PU_simenfrac,
-
-                    "seed_eta": cl_eta,
-                    "seed_phi": cl_phi, 
-                    "seed_iz": cl_iz,
-                    "seed_ieta": cl_ieta,
-                    "seed_iphi": cl_iphi, 
-
-                    # Sim position
-                    "sim_true_eta" : calo_simeta[calomatched] if calomatched!=-1 else 0, 
-                    "sim_true_phi":  calo_simphi[calomatched] if calomatched!=-1 else 0, 
-                    "gen_true_eta" : calo_geneta[calomatched] if calomatched!=-1 else 0, 
-                    "gen_true_phi":  calo_genphi[calomatched] if calomatched!=-1 else 0, 
-
-                    # Energy of the seed
-                    "en_seed": pfCluster_rawEnergy[icl],
-                    "et_seed": pfCluster_rawEnergy[icl] / cosh(cl_eta),
-                    "en_seed_calib": pfCluster_energy[icl],
-                    "et_seed_calib": pfCluster_energy[icl] / cosh(cl_eta),
-
-                    # Sim energy and Gen Enerugy of the caloparticle
-                    "en_true_sim": calo_simenergy[calomatched] if calomatched!=-1 else 0, 
-                    "et_true_sim": calo_simenergy[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0, 
-                    "en_true_gen": calo_genenergy[calomatched] if calomatched!=-1 else 0, 
-                    "et_true_gen": calo_genenergy[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0,
-                    "en_true_sim_good": calo_simenergy_goodstatus[calomatched] if calomatched!=-1 else 0, 
-                    "et_true_sim_good": calo_simenergy_goodstatus[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0,
-                    
-                    # Energy of the mustache if present. Raw and regressed
-                    "en_mustache_raw": mustache_rawEn[mustache_seed_index] if mustache_seed_index!=-1 else 0, 
-                    "et_mustache_raw": mustache_rawEn[mustache_seed_index]/cosh(mustache_eta[mustache_seed_index]) if mustache_seed_index!=-1 else 0, 
-                    "en_mustache_calib": mustache_calibEn[mustache_seed_index]  if mustache_seed_index!=-1 else 0, 
-                    "et_mustache_calib": mustache_calibEn[mustache_seed_index]/cosh(mustache_eta[mustache_seed_index]) if mustache_seed_index!=-1 else 0,
-
-                    # PU information
-                    "nVtx": nVtx, 
-                    "rho": rho,
-                    "obsPU": obsPU, 
-                    "truePU": truePU,
-                    "event_tot_simen_PU": total_PU_simenergy,
-
-                    "seed_f5_r9": pfcl_f5_r9[icl],
-                    "seed_f5_sigmaIetaIeta" : pfcl_f5_sigmaIetaIeta[icl],
-                    "seed_f5_sigmaIetaIphi" : pfcl_f5_sigmaIetaIphi[icl],
-                    "seed_f5_sigmaIphiIphi" : pfcl_f5_sigmaIphiIphi[icl],
-                    "seed_f5_swissCross" : pfcl_f5_swissCross[icl],
-                    "seed_r9": pfcl_r9[icl],
-                    "seed_sigmaIetaIeta" : pfcl_sigmaIetaIeta[icl],
-                    "seed_sigmaIetaIphi" : pfcl_sigmaIetaIphi[icl],
-                    "seed_sigmaIphiIphi" : pfcl_sigmaIphiIphi[icl],
-                    "seed_swissCross" : pfcl_swissCross[icl],
-
-                    "seed_etaWidth" : pfcl_etaWidth[icl],
-                    "seed_phiWidth" : pfcl_phiWidth[icl],
-                    "seed_nxtals" : pfcl_nxtals[icl],
-                    "seed_hits" : get_cluster_hits(pfclhit_ieta[icl], pfclhit_iphi[icl],pfclhit_iz[icl], pfclhit_energy[icl], pfclhit_fraction[icl]), 
+                    if debug: 
+                        print("Seed-to-calo [Failed window cut]: cluster: {}, calo: {}, seed_eta: {:.3f}, calo_eta : {:.3f}, seed_score: {:.5f}, is caloseed: {}".format(
+                                            icl, caloid,cl_eta,calo_geneta[caloid], pfcluster_calo_score[icl], caloseed))
+            
+            else:
+                metadata["n_windows_nomatched"] += 1
+                calomatched = -1 
+                caloseed = False
+                PU_simenfrac = -1.
+
+            # Save the cluster in the list of associated clusters
+            seed_clusters.append(icl)
+            # Check if it is a mustache seed
+            if icl in mustacheseed_pfcls:
+                mustache_seed_index = mustacheseed_pfcls.index(icl)
+            else:
+                mustache_seed_index = -1
+
+            # Create a unique index
+            windex = "".join([ self.rng.choice(string.ascii_lowercase) for _ in range(9)])
+            # Let's create  new window:
+            new_window = {
+                "window_index": windex,
+                "seed_index": icl,
+                "seed": (cl_eta, cl_phi, cl_iz),
+                # The seed of the window is associated with a caloparticle in the window
+                "is_seed_calo_matched": calomatched != -1,
+                # index of the associated caloparticle
+                "calo_index": calomatched,
+                # The seed is the cluster associated with the particle with the largest fraction
+                "is_seed_calo_seed": caloseed,
+                # Mustache info
+                "is_seed_mustache_matched": mustache_seed_index != -1,
+                "mustache_seed_index": mustache_seed_index,
+                
+                # Score of the seed cluster
+                "seed_score": pfcluster_calo_score[icl],
+                "seed_simen_sig": cluster_signal_simenergy[icl][calomatched] if calomatched!=-1 else 0.,
+                "seed_simen_PU":  cluster_PU_simenergy[icl],
+                "seed_recoen_PU":  cluster_PU_recoenergy[icl],
+                "seed_PUfrac" : PU_simenfrac,
+
+                "seed_eta": cl_eta,
+                "seed_phi": cl_phi, 
+                "seed_iz": cl_iz,
+                "seed_ieta": cl_ieta,
+                "seed_iphi": cl_iphi, 
+
+                # Sim position
+                "sim_true_eta" : calo_simeta[calomatched] if calomatched!=-1 else 0, 
+                "sim_true_phi":  calo_simphi[calomatched] if calomatched!=-1 else 0, 
+                "gen_true_eta" : calo_geneta[calomatched] if calomatched!=-1 else 0, 
+                "gen_true_phi":  calo_genphi[calomatched] if calomatched!=-1 else 0, 
+
+                # Energy of the seed
+                "en_seed": pfCluster_rawEnergy[icl],
+                "et_seed": pfCluster_rawEnergy[icl] / cosh(cl_eta),
+                "en_seed_calib": pfCluster_energy[icl],
+                "et_seed_calib": pfCluster_energy[icl] / cosh(cl_eta),
+
+                # Sim energy and Gen Enerugy of the caloparticle
+                "en_true_sim": calo_simenergy[calomatched] if calomatched!=-1 else 0, 
+                "et_true_sim": calo_simenergy[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0, 
+                "en_true_gen": calo_genenergy[calomatched] if calomatched!=-1 else 0, 
+                "et_true_gen": calo_genenergy[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0,
+                "en_true_sim_good": calo_simenergy_goodstatus[calomatched] if calomatched!=-1 else 0, 
+                "et_true_sim_good": calo_simenergy_goodstatus[calomatched]/cosh(calo_geneta[calomatched]) if calomatched!=-1 else 0,
                 
-                    "clusters": [],
+                # Energy of the mustache if present. Raw and regressed
+                "en_mustache_raw": mustache_rawEn[mustache_seed_index] if mustache_seed_index!=-1 else 0, 
+                "et_mustache_raw": mustache_rawEn[mustache_seed_index]/cosh(mustache_eta[mustache_seed_index]) if mustache_seed_index!=-1 else 0, 
+                "en_mustache_calib": mustache_calibEn[mustache_seed_index]  if mustache_seed_index!=-1 else 0, 
+                "et_mustache_calib": mustache_calibEn[mustache_seed_index]/cosh(mustache_eta[mustache_seed_index]) if mustache_seed_index!=-1 else 0,
+
+                # PU information
+                "nVtx": nVtx, 
+                "rho": rho,
+                "obsPU": obsPU, 
+                "truePU": truePU,
+                "event_tot_simen_PU": total_PU_simenergy,
+
+                "seed_f5_r9": pfcl_f5_r9[icl],
+                "seed_f5_sigmaIetaIeta" : pfcl_f5_sigmaIetaIeta[icl],
+                "seed_f5_sigmaIetaIphi" : pfcl_f5_sigmaIetaIphi[icl],
+                "seed_f5_sigmaIphiIphi" : pfcl_f5_sigmaIphiIphi[icl],
+                "seed_f5_swissCross" : pfcl_f5_swissCross[icl],
+                "seed_r9": pfcl_r9[icl],
+                "seed_sigmaIetaIeta" : pfcl_sigmaIetaIeta[icl],
+                "seed_sigmaIetaIphi" : pfcl_sigmaIetaIphi[icl],
+                "seed_sigmaIphiIphi" : pfcl_sigmaIphiIphi[icl],
+                "seed_swissCross" : pfcl_swissCross[icl],
+
+                "seed_etaWidth" : pfcl_etaWidth[icl],
+                "seed_phiWidth" : pfcl_phiWidth[icl],
+                "seed_nxtals" : pfcl_nxtals[icl],
+                # filled only for the windows that are kept
+                "seed_hits" : None, 
+            
+                "clusters": [],
 
-                }
-                # Save the window
-                windows_map[windex] = new_window
-                if calomatched == -1:  
-                    windows_nocalomatched.append(windex)
-                else:
-                    # Save also the window index
-                    windows_calomatched.append(windex)
+            }
+            # Save the window
+            windows_map[windex] = new_window
+            if calomatched == -1:  
+                windows_nocalomatched.append(windex)
+            else:
+                # Save also the window index
+                windows_calomatched.append(windex)
+
+        ## Now save only the first N nocalomatched windows and then nocalowNMax of random ones.
+        ## The windows to keep are decided before filling them: the discarded windows are not processed further
+        metadata["n_windows_matched"] = len(windows_calomatched) 
+        metadata["n_windows_nomatched"] = len(windows_nocalomatched) 
+        if len(windows_nocalomatched)> len(windows_calomatched):
+            windows_to_keep_index = windows_calomatched + windows_nocalomatched[:len(windows_calomatched)] + \
+                          self.rng.sample(windows_nocalomatched[len(windows_calomatched):], min(self.nocalowNmax,len(windows_nocalomatched) - len(windows_calomatched) ))
+        else:
+            windows_to_keep_index = windows_calomatched + windows_nocalomatched
+
+        if debug: print("Windows to keep: ", windows_to_keep_index)
+
+        windows_to_keep_index = set(windows_to_keep_index)
+        windows_map = OrderedDict((windex, window) for windex, window in windows_map.items() if windex in windows_to_keep_index)
+        for window in windows_map.values():
+            icl = window["seed_index"]
+            window["seed_hits"] = get_cluster_hits(pfclhit_ieta[icl], pfclhit_iphi[icl],pfclhit_iz[icl], pfclhit_energy[icl], pfclhit_fraction[icl])
+
+        timer.stage("seeding")
 
         ####################################
         ## Now loop on clusters
@@ -414,98 +653,103 @@ class WindowCreator():
         # All the clusters will go in all the windows
         if debug: print(">> Associate clusters...")
         # Now that all the windows have been created let's add all the cluster
-        for icl, clenergy_T in clenergies_ordered:
-            
-            cl_eta = pfCluster_eta[icl]
-            cl_phi = pfCluster_phi[icl]
-            cl_ieta = pfCluster_ieta[icl]
-            cl_iphi = pfCluster_iphi[icl]
-            cl_iz = pfCluster_iz[icl]
-            cl_rawen = pfCluster_rawEnergy[icl]
-
-            # print("Checking cluster: ",icl)
-            # Fill all the windows
-            for window in windows_map.values():
-                isin, (etaw, phiw) = in_window(*window["seed"], cl_eta, cl_phi, cl_iz,
-                                                *self.dynamic_window(window["seed"][0]))
-                #print("\t w: ", window['window_index'], isin)
-                if isin:
-                    # First of all check is the cluster is geometrically in the mustache of the seed
-                    in_geom_mustache = is_in_geom_mustache(window["seed_eta"], 
-                                                window["seed_phi"], cl_eta, cl_phi, cl_rawen)
-                    # If the window is not associated to a calo then in_scluster is always false for the cluster
-                    if not window["is_seed_calo_matched"]:
-                        is_calo_matched = False   
-                        pass_simfrac_thres = False
-                        is_calo_seed = False
-                        PU_simenfrac = -1.
-                    else: 
-                        # We have to check the calo_matching using simfraction threshold
-                        # Check if the cluster is associated to the SAME calo as the seed
-                        is_calo_matched =  pfcluster_calo_map[icl] == window["calo_index"]  # we know at this point it is not -1
-                        # If the cluster is associated to the SAME CALO of the seed 
-                        # the simfraction threshold by seed eta/et is used
-                        if is_calo_matched: 
-                            # Check the fraction of sim energy and PU energy 
-                            # simenergy signal == linked to the caloparticle of the SEED
-                            PU_simenfrac = cluster_PU_simenergy[icl] / cluster_signal_simenergy[icl][window["calo_index"]]
-                            # First of all check the PU sim energy limit
-                            if PU_simenfrac < self.simenergy_pu_limit:
-                                #associate the cluster to the caloparticle with simfraction optimized thresholds 
-                                pass_simfrac_thres = self.pass_simfraction_threshold(window["seed_eta"], 
-                                                    window["et_seed"], pfcluster_calo_score[icl] )
-                                # Check if the cluster is the main cluster of the calo associated to the seed
-                                if calo_pfcluster_map[window["calo_index"]][0][0] == icl:
-                                    is_calo_seed = True
-                                else:
-                                    is_calo_seed =False
+        windows_clusters = self.get_windows_clusters([w["seed"] for w in windows_map.values()],
+                                                     clenergies_ordered, pfCluster_eta, pfCluster_phi, pfCluster_iz)
+        # Cache of the window-independent features of the clusters
+        clusters_cache = {}
+        # Fill all the windows
+        for window, clusters_inwindow in zip(windows_map.values(), windows_clusters):
+            # Geometrical mustache check of all the clusters of the window at once
+            icls = [ icl for icl, _, _ in clusters_inwindow ]
+            in_geom_mustache_window = mustache.in_geom_mustache(window["seed_eta"], window["seed_phi"],
+                                            [pfCluster_eta[icl] for icl in icls], [pfCluster_phi[icl] for icl in icls],
+                                            [pfCluster_rawEnergy[icl] for icl in icls]).tolist()
+            # Simfraction thresholds of the seed applied to all the clusters of the window at once
+            if window["is_seed_calo_matched"]:
+                pass_simfrac_thres_window = self.simfraction_thresholds.pass_threshold(window["seed_eta"], window["et_seed"],
+                                            [pfcluster_calo_score[icl] for icl in icls]).tolist()
+            else:
+                pass_simfrac_thres_window = [False]*len(icls)
+            # The clusters are ordered by Et inside each window
+            for (icl, etaw, phiw), in_geom_mustache, cl_pass_simfrac_thres in zip(clusters_inwindow,
+                                                        in_geom_mustache_window, pass_simfrac_thres_window):
+                cl_eta = pfCluster_eta[icl]
+                cl_phi = pfCluster_phi[icl]
+                cl_ieta = pfCluster_ieta[icl]
+                cl_iphi = pfCluster_iphi[icl]
+                cl_iz = pfCluster_iz[icl]
+                cl_rawen = pfCluster_rawEnergy[icl]
+
+                # If the window is not associated to a calo then in_scluster is always false for the cluster
+                if not window["is_seed_calo_matched"]:
+                    is_calo_matched = False   
+                    pass_simfrac_thres = False
+                    is_calo_seed = False
+                    PU_simenfrac = -1.
+                else: 
+                    # We have to check the calo_matching using simfraction threshold
+                    # Check if the cluster is associated to the SAME calo as the seed
+                    is_calo_matched =  pfcluster_calo_map[icl] == window["calo_index"]  # we know at this point it is not -1
+                    # If the cluster is associated to the SAME CALO of the seed 
+                    # the simfraction threshold by seed eta/et is used
+                    if is_calo_matched: 
+                        # Check the fraction of sim energy and PU energy 
+                        # simenergy signal == linked to the caloparticle of the SEED
+                        PU_simenfrac = cluster_PU_simenergy[icl] / cluster_signal_simenergy[icl][window["calo_index"]]
+                        # First of all check the PU sim energy limit
+                        if PU_simenfrac < self.simenergy_pu_limit:
+                            #associate the cluster to the caloparticle with simfraction optimized thresholds 
+                            pass_simfrac_thres = cl_pass_simfrac_thres
+                            # Check if the cluster is the main cluster of the calo associated to the seed
+                            if calo_pfcluster_map[window["calo_index"]][0][0] == icl:
+                                is_calo_seed = True
                             else:
-                                if debug: print("Cluster {} do not pass PU simenergy cut {:.3f}".format(icl, PU_simenfrac))
-                                pass_simfrac_thres = False   
-                                is_calo_seed = False
+                                is_calo_seed =False
                         else:
-                            # if the cluster is not associated to a caloparticle
-                            # or it is associated to a calo different from the seed
-                            # do not associate it
+                            if debug: print("Cluster {} do not pass PU simenergy cut {:.3f}".format(icl, PU_simenfrac))
                             pass_simfrac_thres = False   
                             is_calo_seed = False
-                            PU_simenfrac = -1.            
-                            
-                    # check if the cluster is inside the same mustache
-                    if window["mustache_seed_index"] != -1:
-                        in_mustache = icl in pfcl_in_mustache[window["mustache_seed_index"]]
                     else:
-                        in_mustache = False
-                
-                    cevent = {  
+                        # if the cluster is not associated to a caloparticle
+                        # or it is associated to a calo different from the seed
+                        # do not associate it
+                        pass_simfrac_thres = False   
+                        is_calo_seed = False
+                        PU_simenfrac = -1.            
+                        
+                # check if the cluster is inside the same mustache
+                if window["mustache_seed_index"] != -1:
+                    in_mustache = icl in pfcl_in_mustache[window["mustache_seed_index"]]
+                else:
+                    in_mustache = False
+            
+                # The window-independent features of the cluster are built once per event
+                # and shared by all the windows containing the cluster
+                if icl not in clusters_cache:
+                    clusters_cache[icl] = {  
                         # "window_index": window["window_index"],
                         "cl_index": icl,
-                        # Check if it is the seed
-                        "is_seed": window["seed_index"] == icl,
-                        # True if the cluster geometrically is in the mustache of the seed
-                        "in_geom_mustache" : in_geom_mustache,
-                        # True if the seed has a calo and the cluster is associated to the same calo
-                        "is_calo_matched": is_calo_matched,
-                        # True if the cluster is the main cluster of the calo associated with the seed
-                        "is_calo_seed": is_calo_seed,
-                        # is_calo_matched & (sim fraction optimized threshold) || cl it is the seed of the window 
-                        "in_scluster": pass_simfrac_thres or (window["seed_index"] == icl) ,
-                        # True if the cluster is associated with the same (legacy) mustache as the seed
-                        "in_mustache" : in_mustache,
+                        # Window dependent labels, filled for each window (the keys order is kept in the output)
+                        "is_seed": None,
+                        "in_geom_mustache" : None,
+                        "is_calo_matched": None,
+                        "is_calo_seed": None,
+                        "in_scluster": None,
+                        "in_mustache" : None,
                         # Score of association with the caloparticle of the seed, if present
                         "calo_score": pfcluster_calo_score[icl],
                         # Simenergy of the signal and PU in the cluster
-                        "calo_simen_sig": cluster_signal_simenergy[icl][window["calo_index"]] if is_calo_matched else 0.,
+                        "calo_simen_sig": None,
                         "calo_simen_PU":  cluster_PU_simenergy[icl],
                         "calo_recoen_PU": cluster_PU_recoenergy[icl],
                         "calo_nxtals_PU": cluster_nXtalsPU[icl],
-                        "cluster_PUfrac": PU_simenfrac,
+                        "cluster_PUfrac": None,
 
                         "cluster_ieta" : cl_ieta,
                         "cluster_iphi" : cl_iphi,
                         "cluster_eta" : cl_eta,
                         "cluster_phi" : cl_phi,
-                        "cluster_dphi":phiw ,
+                        "cluster_dphi": None,
                         "cluster_iz" : cl_iz,
                         "en_cluster": pfCluster_rawEnergy[icl],
                         "et_cluster": pfCluster_rawEnergy[icl] / cosh(cl_eta),
@@ -535,79 +779,52 @@ class WindowCreator():
 
                         "cl_hits":  get_cluster_hits(pfclhit_ieta[icl], pfclhit_iphi[icl],pfclhit_iz[icl], pfclhit_energy[icl], pfclhit_fraction[icl])
                     }
-                    if window["seed_eta"] > 0:
-                        cevent["cluster_deta"] = cl_eta - window["seed_eta"]
-                    else:
-                        cevent["cluster_deta"] = window["seed_eta"] - cl_eta
-                    # Delta energy with the seed
-                    cevent["cluster_den_seed"] = window["en_seed"] - cevent["en_cluster"]
-                    cevent["cluster_det_seed"] = window["et_seed"] - cevent["et_cluster"]
-                    
-                    # Save the cluster in the window
-                    window["clusters"].append(cevent)
-                    # In this script save all the clusters in all the windows
-                    # Uncomment the next line if instead you want to
-                    # save only the cluster in the first window encountered by Et
-                    #break
+                cevent = dict(clusters_cache[icl])
+                # Check if it is the seed
+                cevent["is_seed"] = window["seed_index"] == icl
+                # True if the cluster geometrically is in the mustache of the seed
+                cevent["in_geom_mustache"] = in_geom_mustache
+                # True if the seed has a calo and the cluster is associated to the same calo
+                cevent["is_calo_matched"] = is_calo_matched
+                # True if the cluster is the main cluster of the calo associated with the seed
+                cevent["is_calo_seed"] = is_calo_seed
+                # is_calo_matched & (sim fraction optimized threshold) || cl it is the seed of the window 
+                cevent["in_scluster"] = pass_simfrac_thres or (window["seed_index"] == icl)
+                # True if the cluster is associated with the same (legacy) mustache as the seed
+                cevent["in_mustache"] = in_mustache
+                # Simenergy of the signal in the cluster
+                cevent["calo_simen_sig"] = cluster_signal_simenergy[icl][window["calo_index"]] if is_calo_matched else 0.
+                cevent["cluster_PUfrac"] = PU_simenfrac
+                cevent["cluster_dphi"] = phiw
+                if window["seed_eta"] > 0:
+                    cevent["cluster_deta"] = cl_eta - window["seed_eta"]
+                else:
+                    cevent["cluster_deta"] = window["seed_eta"] - cl_eta
+                # Delta energy with the seed
+                cevent["cluster_den_seed"] = window["en_seed"] - cevent["en_cluster"]
+                cevent["cluster_det_seed"] = window["et_seed"] - cevent["et_cluster"]
+                
+                # Save the cluster in the window
+                window["clusters"].append(cevent)
+                # In this script save all the clusters in all the windows
+                # Uncomment the next line if instead you want to
+                # save only the cluster in the first window encountered by Et
+                #break
 
         ###############################
         #### Now that all the clusters have been put in all the windows
         ###  Add some global data for each window
-        
+        timer.stage("clusters")
+
         for window in windows_map.values():
-            calo_index = window["calo_index"]
-            # Check the type of events
-            # - Number of pfcluster associated, 
-            # - deltaR of the farthest cluster
-            # - Energy of the pfclusters
-            if calo_index != -1:
-                # Get number of associated clusters
-                assoc_clusters = list(filter(lambda cl: cl["in_scluster"], window["clusters"]))
-                window["nclusters_insc"] = len(assoc_clusters)
-                window["max_en_cluster_insc"] = max( [cl["en_cluster"] for cl in assoc_clusters ] )
-                window["max_deta_cluster_insc"] = max( [cl["cluster_deta"] for cl in assoc_clusters] )
-                window["max_dphi_cluster_insc"] = max( [cl["cluster_dphi"] for cl in assoc_clusters])
-            else:
-                window["nclusters_insc"] = 0
-                window["max_en_cluster_insc"] = -1
-                window["max_deta_cluster_insc"] = -1
-                window["max_dphi_cluster_insc"] = -1
-            #General info for all the windows
-            #max variable
-            window["ncls"] = len(window["clusters"])
-            window["max_en_cluster"] = max( cl["en_cluster"] for cl in window["clusters"])
-            window["max_et_cluster"] = max( cl["et_cluster"] for cl in window["clusters"])
-            window["max_deta_cluster"] = max( cl["cluster_deta"] for cl in window["clusters"])
-            window["max_dphi_cluster"] = max( cl["cluster_dphi"] for cl in window["clusters"])
-            window["max_den_cluster"] = max( cl["cluster_den_seed"] for cl in window["clusters"])
-            window["max_det_cluster"] = max( cl["cluster_det_seed"] for cl in window["clusters"])
-            #min variables
-            window["min_en_cluster"] = min( cl["en_cluster"] for cl in window["clusters"])
-            window["min_et_cluster"] = min( cl["et_cluster"] for cl in window["clusters"])
-            window["min_deta_cluster"] = min( cl["cluster_deta"] for cl in window["clusters"])
-            window["min_dphi_cluster"] = min( cl["cluster_dphi"] for cl in window["clusters"])
-            window["min_den_cluster"] = min( cl["cluster_den_seed"] for cl in window["clusters"])
-            window["min_det_cluster"] = min( cl["cluster_det_seed"] for cl in window["clusters"])
-            #mean variabes
-            window["mean_en_cluster"] = np.mean( list(cl["en_cluster"] for cl in window["clusters"]))
-            window["mean_et_cluster"] = np.mean( list(cl["et_cluster"] for cl in window["clusters"]))
-            window["mean_deta_cluster"] = np.mean( list(cl["cluster_deta"] for cl in window["clusters"]))
-            window["mean_dphi_cluster"] = np.mean( list(cl["cluster_dphi"] for cl in window["clusters"]))
-            window["mean_den_cluster"] = np.mean( list(cl["cluster_den_seed"] for cl in window["clusters"]))
-            window["mean_det_cluster"] = np.mean( list(cl["cluster_det_seed"] for cl in window["clusters"]))
-            # Compute total simEnergy of the signal and PU in the window    
-            # Take only the calo of the window
-            total_PU_simenergy_inwindow = 0. 
-            total_PU_recoenergy_inwindow = 0.
-            total_sig_simenergy_inwindow = 0.
-            for cl in window["clusters"]:
-                total_PU_simenergy_inwindow  +=  cl["calo_simen_PU"]
-                total_PU_recoenergy_inwindow  +=  cl["calo_recoen_PU"]
-                total_sig_simenergy_inwindow += cl["calo_simen_sig"]
-            # Saving window totals to differentiate from total in the event
-            window["wtot_simen_PU"] = total_PU_simenergy_inwindow
-            window["wtot_recoen_PU"] = total_PU_recoenergy_inwindow
-            window["wtot_simen_sig"] = total_sig_simenergy_inwindow
+            # Number of pfclusters associated, max/min/mean of the clusters features
+            # and total simEnergy of the signal and PU in the window (only the calo of the window).
+            # Computed in one pass on the array of the clusters quantities (see window_features.py)
+            window.update(get_window_aggregates(get_cluster_quantities(window["clusters"]),
+                                                [ cl["in_scluster"] for cl in window["clusters"] ],
+                                                calo_matched=window["calo_index"] != -1))
+            for name in self.missing_wtot:
+                window[name] = None
         
         if debug:
             print("ALL windows")
@@ -636,6 +853,8 @@ class WindowCreator():
             print(">>> TOT windows calomatched: ", len(calo_match))
             print(">>> Tot PU simEnergy in the event: ", total_PU_simenergy)
 
+        timer.stage("aggregates")
+
         # Check if there are more than one windows associated with the same caloparticle
         # windows_calomatched = []
         # for calo, ws in calo_windows.items():
@@ -651,18 +870,7 @@ class WindowCreator():
         
         # In this version we keep all the windows
 
-        ## Now save only the first N nocalomatched windows and then nocalowNMax of random ones
-        metadata["n_windows_matched"] = len(windows_calomatched) 
-        metadata["n_windows_nomatched"] = len(windows_nocalomatched) 
-        if len(windows_nocalomatched)> len(windows_calomatched):
-            windows_to_keep_index = windows_calomatched + windows_nocalomatched[:len(windows_calomatched)] + \
-                          random.sample(windows_nocalomatched[len(windows_calomatched):], min(self.nocalowNmax,len(windows_nocalomatched) - len(windows_calomatched) ))
-        else:
-            windows_to_keep_index = windows_calomatched + windows_nocalomatched
-
-        if debug: print("Windows to keep: ", windows_to_keep_index)
-        
-        windows_to_keep = list(filter(lambda w: w["window_index"] in windows_to_keep_index, windows_map.values()))
+        windows_to_keep = list(windows_map.values())
 
        
         output_data = []
@@ -671,8 +879,13 @@ class WindowCreator():
             outw = {k:v for k,v in window.items() if k not in ["seed","seed_index"]}
             # outw["clusters"] = self.summary_clusters_window(window)
             # let's keep AOS approach 
-            output_data.append(json.dumps(outw))
+            if dump_json:
+                output_data.append(json.dumps(outw))
+            else:
+                output_data.append(outw)
             # pprint(window)
+        # json stage only with the dump_json API (the production script times the serialization of the windows writer)
+        timer.stage("json" if dump_json else "output")
 
         # if debug: print(output_data)
         return output_data, metadata
@@ -1,6 +1,12 @@
+import os
+import json
 import awkward as ak
 import numpy as np
 import tensorflow as tf
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import operator
 from collections import namedtuple
 
 from glob import glob
@@ -70,7 +76,8 @@ class LoaderConfig():
     # Different files in each list will be interleaved and shuffled for each chunk.
     input_files : List[List[str]]  = field(default_factory=list)
     # in alternative a list of directories to be zipped together can be provided
-    # The files from each folder will be zipped and samples shuffled together.    
+    # The files from each folder will be zipped and samples shuffled together.
+    # If a folder contains the manifest of compact_awkward_dataset.py the largest files are zipped and read first.
     input_folders : List[str] = field(default_factory=list )
     # Group of records to read from awk files
     file_input_columns: List[str] = field(default_factory=lambda : ["cl_features", "cl_labels",
@@ -95,6 +102,18 @@ class LoaderConfig():
     norm_factors: dict = None     #normalization factors array dictionary
     nworkers: int = 2,   # number of parallele process to use to read files
     max_batches_in_memory: int = 30 #  number of batches to load at max in memory
+    # the input files have the event-level schema (clusters table + windows clusters indices)
+    # and the windows are expanded on the fly
+    event_level: bool = False
+    # filters on the windows fields (AND of all the filters), e.g.
+    # [("seed_features.seed_iz", "==", 0), ("seed_features.et_seed", ">", 10.)]
+    # operators: ==, !=, <, <=, >, >=, in, not in.
+    # The row groups of the files that cannot contain windows passing the filters (from their min/max statistics)
+    # are not read at all, then the windows are filtered exactly.
+    filters: List[tuple] = field(default_factory=list)
+    # format of the input files: parquet or arrow (uncompressed Arrow IPC files exported by 
+    # NtuplesProduction/export_arrow_dataset.py, memory mapped and converted one chunk at the time)
+    file_format: str = "parquet"
 
 
 
@@ -102,12 +121,15 @@ class LoaderConfig():
 ### Utility functions to build the generator chain   ###
 ########################################################
 
-def load_dataset_chunks(df, config, chunk_size, offset=0, maxevents=None):
+def select_columns(df, config):
     # Filtering the columns to keey only the requested ones
     cols = { key: df[key][v] for key, v in config.columns.items() }
     # Adding the clusters hits 
     cols['cl_h'] = df.cl_h
-    filtered_df = ak.zip(cols, depth_limit=1)
+    return ak.zip(cols, depth_limit=1)
+
+def load_dataset_chunks(df, config, chunk_size, offset=0, maxevents=None):
+    filtered_df = select_columns(df, config)
     # Now load in large chunks batching
     if maxevents:
         nchunks = maxevents // chunk_size
@@ -118,6 +140,192 @@ def load_dataset_chunks(df, config, chunk_size, offset=0, maxevents=None):
         yield chunk_size, ak.materialized(filtered_df[offset + i*chunk_size: offset + (i+1)*chunk_size])
         #yield batch_size, df[i*batch_size: (i+1)*batch_size]
         
+FILTER_OPS = {
+    "==": operator.eq, "!=": operator.ne,
+    "<": operator.lt, "<=": operator.le,
+    ">": operator.gt, ">=": operator.ge,
+    "in": lambda x, v: np.isin(x, v),
+    "not in": lambda x, v: ~np.isin(x, v),
+}
+
+def row_group_may_pass(vmin, vmax, op, value):
+    '''
+    Check if a row group with the [vmin, vmax] range of the filter field can contain windows passing the filter
+    '''
+    if op == "==": return vmin <= value <= vmax
+    if op == "!=": return not (vmin == vmax == value)
+    if op == "<": return vmin < value
+    if op == "<=": return vmin <= value
+    if op == ">": return vmax > value
+    if op == ">=": return vmax >= value
+    if op == "in": return any(vmin <= v <= vmax for v in value)
+    if op == "not in": return not (vmin == vmax and vmin in value)
+    raise Exception(f"Filter operator {op} not available: {list(FILTER_OPS)}")
+
+def select_row_groups(file, filters):
+    '''
+    Indices of the row groups of the parquet file which can contain windows passing the filters,
+    using the min/max statistics of the filter columns ("group.field") saved in the file metadata. 
+    The row groups without statistics are always kept.
+    '''
+    metadata = pq.ParquetFile(file).metadata
+    columns = { metadata.schema.column(i).path: i for i in range(metadata.num_columns) }
+    for column, op, value in filters:
+        if column not in columns:
+            raise Exception(f"Filter column {column} not available in file {file}")
+    selected = []
+    for irg in range(metadata.num_row_groups):
+        row_group = metadata.row_group(irg)
+        keep = True
+        for column, op, value in filters:
+            stats = row_group.column(columns[column]).statistics
+            if stats is None or not stats.has_min_max: continue
+            if not row_group_may_pass(stats.min, stats.max, op, value):
+                keep = False
+                break
+        if keep:
+            selected.append(irg)
+    return selected
+
+def filter_mask(df, filters):
+    '''
+    Mask of the windows passing all the filters
+    '''
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters:
+        group, name = column.split(".")
+        mask &= FILTER_OPS[op](np.asarray(df[group][name]), value)
+    return mask
+
+def read_filtered_file(file, config):
+    '''
+    Lazy reading of the windows of a file passing the config filters: only the selected row groups are read
+    and the groups of the filter fields are added to the columns to evaluate the exact mask.
+    Returns None if no row group can pass the filters. 
+    '''
+    row_groups = select_row_groups(file, config.filters)
+    if len(row_groups) == 0:
+        return None
+    columns = list(config.file_input_columns)
+    for column, op, value in config.filters:
+        group = column.split(".")[0]
+        if group not in columns:
+            columns.append(group)
+    df = ak.from_parquet(file, lazy=True, use_threads=True, columns=columns, row_groups=row_groups)
+    return df[filter_mask(df, config.filters)]
+        
+def read_arrow_table(file):
+    '''
+    Memory mapped Arrow IPC file: the data are not read nor decoded, 
+    the pages are loaded by the OS when the chunks are used.
+    '''
+    return pa.ipc.open_file(pa.memory_map(file, "r")).read_all()
+
+def arrow_filter_mask(table, filters):
+    '''
+    Mask of the windows of the Arrow table passing all the filters
+    '''
+    mask = np.ones(table.num_rows, dtype=bool)
+    for column, op, value in filters:
+        group, name = column.split(".")
+        if group not in table.column_names or table.schema.field(group).type.get_field_index(name) < 0:
+            raise Exception(f"Filter column {column} not available")
+        index = table.schema.field(group).type.get_field_index(name)
+        values = [ pc.struct_field(chunk, [index]).to_numpy(zero_copy_only=False) for chunk in table.column(group).chunks ]
+        mask &= FILTER_OPS[op](np.concatenate(values) if values else np.array([]), value)
+    return mask
+
+def load_arrow_file_chunks(file, config):
+    '''
+    Chunks of a memory mapped Arrow IPC file: each chunk is a slice of the table (or is taken at the indices
+    of the windows passing the filters) converted to an awkward array only when it is yielded,
+    so that only one chunk at the time is loaded in memory. 
+    The slices inside a record batch (row group of the parquet file) are not copied, 
+    the slices across two batches and the filtered chunks are copied.
+    '''
+    table = read_arrow_table(file)
+    indices = np.nonzero(arrow_filter_mask(table, config.filters))[0] if config.filters else None
+    table = table.select(config.file_input_columns)
+    nwindows = (len(indices) if indices is not None else table.num_rows) - config.offset
+    chunk_size = config.chunk_size
+    for i in range(nwindows // chunk_size):
+        start = config.offset + i*chunk_size
+        if indices is None:
+            chunk = table.slice(start, chunk_size)
+        else:
+            chunk = table.take(indices[start: start + chunk_size])
+        yield chunk_size, select_columns(ak.from_arrow(chunk), config)
+
+def expand_windows(df, columns):
+    '''
+    Expands the event-level records (normalized schema written by the EventsParquetWriter)
+    into windows records with the same format of the window-level dataset. 
+    For each event the clusters are saved only once (`clusters`, `cl_h`) and each window
+    contains the indices of its clusters (`cl_index`) and the window-relative cluster features (`cl_window`).
+    The clusters of each window are gathered with the indices and merged with the window-relative features.
+    '''
+    windows = ak.flatten(df.windows, axis=1)
+    # Index of the clusters in the flattened clusters table of all the events
+    ncls_event = ak.to_numpy(ak.num(df.clusters, axis=1))
+    offsets = np.cumsum(ncls_event) - ncls_event
+    cl_index = np.asarray(ak.flatten(df.windows.cl_index + offsets, axis=None))
+    counts = np.asarray(ak.num(windows.cl_index, axis=1))
+    clusters = ak.unflatten(ak.flatten(df.clusters, axis=1)[cl_index], counts)
+    cl_h = ak.unflatten(ak.flatten(df.cl_h, axis=1)[cl_index], counts)
+    cl_window = windows.cl_window
+
+    out = {}
+    for key, v in columns.items():
+        if key == "cl_labels":
+            out[key] = windows.cl_labels[v]
+        elif "cl_" in key:
+            out[key] = ak.zip({ f: cl_window[f] if f in cl_window.fields else clusters[f] for f in v })
+        elif key in windows.fields:
+            out[key] = windows[key][v]
+    out["cl_h"] = cl_h
+    return ak.zip(out, depth_limit=1)
+
+
+def load_event_dataset_chunks(df, config, chunk_size, offset=0, maxevents=None):
+    '''
+    Same as load_dataset_chunks for the event-level files. 
+    The events are read in blocks of `chunk_size` events, the windows are expanded and
+    yielded in chunks of `chunk_size` windows. `offset` and `maxevents` refer to the number of windows.
+    '''
+    nevents = ak.num(df.windows, axis=0)
+    blocks = ( df[i: i+chunk_size] for i in range(0, nevents, chunk_size) )
+    yield from load_event_blocks_chunks(blocks, config, chunk_size, offset, maxevents)
+
+def load_arrow_event_file_chunks(file, config):
+    '''
+    Same as load_event_dataset_chunks for a memory mapped event-level Arrow IPC file: 
+    each block of events is sliced from the table and converted to an awkward array only when it is expanded.
+    '''
+    table = read_arrow_table(file)
+    blocks = ( ak.from_arrow(table.slice(i, config.chunk_size)) for i in range(0, table.num_rows, config.chunk_size) )
+    yield from load_event_blocks_chunks(blocks, config, config.chunk_size, config.offset)
+
+def load_event_blocks_chunks(blocks, config, chunk_size, offset=0, maxevents=None):
+    '''
+    Chunks of `chunk_size` windows expanded from the blocks of events
+    '''
+    buffer = None
+    to_skip = offset
+    nwindows = 0
+    for block in blocks:
+        windows = expand_windows(block, config.columns)
+        if to_skip:
+            nskip = min(to_skip, len(windows))
+            windows = windows[nskip:]
+            to_skip -= nskip
+        buffer = windows if buffer is None else ak.concatenate([buffer, windows])
+        while len(buffer) >= chunk_size:
+            yield chunk_size, buffer[:chunk_size]
+            buffer = buffer[chunk_size:]
+            nwindows += chunk_size
+            if maxevents and nwindows >= maxevents:
+                return
+
 def split_batches(gen, batch_size):
     for size, df in gen:
         if size % batch_size == 0:
@@ -180,7 +388,11 @@ def concat_datasets(*iterables):
         yield concat_fn(dfs)
         
 def to_flat_numpy(X, axis=2, allow_missing=True):
-    return np.stack([ak.to_numpy(X[f], allow_missing=allow_missing) for f in X.fields], axis=axis)
+    out = np.stack([ak.to_numpy(X[f], allow_missing=allow_missing) for f in X.fields], axis=axis)
+    # The numerical fields of the compact datasets (float32, int16, int8) are converted to float64 as the standard ones
+    if out.dtype.kind in "fiu":
+        out = out.astype(np.float64, copy=False)
+    return out
 
 def convert_to_tf(df):
     return [ tf.convert_to_tensor(d) for d in df ]
@@ -268,10 +480,26 @@ def load_batches_from_files_generator(config, preprocessing_fn):
     N.B.: the chunk size must be a multiple of the batch size. 
     '''
     def _fn(files): 
-        # Parquet files
-        dfs_raw = [ ak.from_parquet(file, lazy=True, use_threads=True, columns=config.file_input_columns) for file in files if file!=None]
-        # Loading chunks from the files
-        initial_dfs = [ load_dataset_chunks(df, config, chunk_size=config.chunk_size, offset=config.offset) for df in dfs_raw] 
+        if config.file_format == "arrow":
+            # Arrow IPC files memory mapped
+            if config.event_level:
+                initial_dfs = [ load_arrow_event_file_chunks(file, config) for file in files if file!=None]
+            else:
+                initial_dfs = [ load_arrow_file_chunks(file, config) for file in files if file!=None]
+        elif config.event_level:
+            # Event-level parquet files: the windows are expanded while reading the chunks
+            dfs_raw = [ ak.from_parquet(file, lazy=True, use_threads=True) for file in files if file!=None]
+            initial_dfs = [ load_event_dataset_chunks(df, config, chunk_size=config.chunk_size, offset=config.offset) for df in dfs_raw] 
+        else:
+            # Parquet files
+            if config.filters:
+                # Skipping the row groups not passing the filters
+                dfs_raw = [ read_filtered_file(file, config) for file in files if file!=None]
+                dfs_raw = [ df for df in dfs_raw if df is not None]
+            else:
+                dfs_raw = [ ak.from_parquet(file, lazy=True, use_threads=True, columns=config.file_input_columns) for file in files if file!=None]
+            # Loading chunks from the files
+            initial_dfs = [ load_dataset_chunks(df, config, chunk_size=config.chunk_size, offset=config.offset) for df in dfs_raw] 
         # Contatenate the chunks from the list of files
         concat_df = concat_datasets(*initial_dfs)
         # Shuffle the axis=0
@@ -341,7 +569,7 @@ def preprocessing(config):
             cls_X_pad_n = to_flat_numpy(cls_X_pad, axis=2, allow_missing=True)
             cls_Y_pad_n = to_flat_numpy(cls_Y_pad, axis=2, allow_missing=True)
             is_seed_pad_n = ak.to_numpy(is_seed_pad, allow_missing=True)
-            cl_hits_pad_n = ak.to_numpy(cl_hits_padded, allow_missing=True)
+            cl_hits_pad_n = ak.to_numpy(cl_hits_padded, allow_missing=True).astype(np.float64, copy=False)
             wind_X_n = to_flat_numpy(wind_X, axis=1)
             wind_meta_n = to_flat_numpy(wind_meta, axis=1)
             
@@ -362,7 +590,7 @@ def preprocessing(config):
                 cls_X_pad_n = ((cls_X_pad_n - norm_fact["cluster"]["min"])/ (norm_fact["cluster"]["max"]-norm_fact["cluster"]["min"])) * cls_mask
                 wind_X_n =  ((wind_X_n - norm_fact["window"]["min"])/ (norm_fact["window"]["max"]-norm_fact["window"]["min"]) )  
             
-            flavour = np.asarray(df.window_metadata.flavour)
+            flavour = np.asarray(df.window_metadata.flavour, dtype=np.float64)
             
             return size, ( cls_X_pad_n, cls_Y_pad_n, is_seed_pad_n, cl_hits_pad_n,
                            wind_X_n, wind_meta_n, flavour, hits_mask, cls_mask)
@@ -436,15 +664,36 @@ def tf_generator(config):
 ################################
 # User API to get a dataset general
 
+# Manifest with the number of windows of the files written by NtuplesProduction/compact_awkward_dataset.py
+MANIFEST_NAME = "manifest.json"
+
+def get_folder_files(folder, file_format="parquet"):
+    '''
+    Parquet (or arrow) files of a dataset folder. If the manifest of the folder is available the files are sorted by
+    decreasing number of windows: the workers take the largest files first and finish at the same time.
+    '''
+    manifest_file = os.path.join(folder, MANIFEST_NAME)
+    if not os.path.exists(manifest_file):
+        return sorted(glob(folder+"/*." + file_format))
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    files = sorted(manifest["files"], key=lambda f: f["nwindows"], reverse=True)
+    return [ os.path.join(folder, f["file"]) for f in files ]
+
+
 def load_dataset (config: LoaderConfig):
     '''
     Function exposing to the end user the tensorflow dataset loading through the awkward chain. 
     '''
     # Check if folders instead of files have been provided
     if config.input_folders:
-        config.input_files = list(zip_longest([glob(folder+"/*.parquet") for folder in config.input_folders]))
+        config.input_files = list(zip_longest(*[get_folder_files(folder, config.file_format) for folder in config.input_folders]))
     if not config.input_folders and not config.input_files:
         raise Exception("No input folders or files provided! Please provide some input!")
+    if config.file_format not in ["parquet", "arrow"]:
+        raise Exception(f"File format {config.file_format} not available: parquet or arrow")
+    if config.filters and config.event_level:
+        raise Exception("The windows filters are not available for the event-level datasets")
     # Load the normalization factors
     if config.norm_factors == None and config.norm_factors_file:
         config.norm_factors = get_norm_factors(config.norm_factors_file, config.columns["cl_features"], config.columns["window_features"])